@@ -0,0 +1,216 @@
+import asyncio
+import random
+import traceback
+
+from punta_cana_festival import Menu_Bar, Menu_FoodTruck, Stage, DEFAULT_ARTISTS_INFO, create_attendees, festival_clock
+from festival_log import event_log, ConsoleSink, DEBUG, MILESTONE, ERROR
+
+# asyncio version of the festival: every attendee and every staff member is a coroutine on
+# one event loop instead of an OS thread, so tens of thousands of attendees fit in one process.
+# Times are festival times from festival_clock, like in the threaded run, and every pause is
+# festival seconds turned into real ones by the clock (see sleep), so time_scale works here too.
+
+
+async def sleep(seconds):
+    await asyncio.sleep(festival_clock.real_seconds(seconds))
+
+# Service stations, with the same methods the attendees call on the threaded ones:
+
+class AsyncStation:
+    def __init__(self, worker_count):
+        self.queue = asyncio.Queue()
+        self.worker_count = worker_count
+
+    def put(self, item):
+        self.queue.put_nowait(item)
+
+    def close(self):
+        # drop what is still waiting, then one stop signal (None) per worker
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        for _ in range(self.worker_count):
+            self.queue.put_nowait(None)
+
+
+class AsyncBar(AsyncStation):
+    def __init__(self, barista_count, name='Bar', menu=None):
+        super().__init__(barista_count)
+        self.name = name
+        self.menu = menu or Menu_Bar()
+
+    def add_order(self, order):
+        self.put(order)
+
+
+class AsyncFoodTruck(AsyncBar):
+    def __init__(self, cook_count, name='Food Truck'):
+        super().__init__(cook_count, name, menu=Menu_FoodTruck())
+
+
+class AsyncBathroom:
+    def __init__(self, stalls_per_gender):
+        self.persons = {gender: AsyncStation(stalls_per_gender) for gender in ['Male', 'Female']}
+
+    def request_use(self, person):
+        self.persons[person.gender].put(person)
+
+    def close(self):
+        for station in self.persons.values():
+            station.close()
+
+
+class AsyncEmergencyTruck(AsyncStation):
+    def admit_patient(self, patient):
+        self.put(patient)
+
+
+# Main simulation class:
+
+class AsyncFestivalSimulation:
+    def __init__(self, num_attendees, num_baristas, num_cooks, num_stalls, num_security, num_doctors, num_stages, artists_info, num_bars, num_food_trucks, festival_db=None,
+                 time_scale=1.0):
+        if time_scale <= 0:
+            raise ValueError(f"time_scale has to be positive, not {time_scale}")
+        self.time_scale = time_scale # set on festival_clock by start(), as in FestivalSimulation
+        self.attendees = create_attendees(num_attendees)
+        self.num_baristas = num_baristas
+        self.num_cooks = num_cooks
+        self.num_stalls = num_stalls
+        self.num_security = num_security
+        self.num_doctors = num_doctors
+        self.num_bars = num_bars
+        self.num_food_trucks = num_food_trucks
+        self.stage = Stage(num_stages, artists_info) # its show is driven by perform
+
+        self.festival_running = True
+        self.all_orders = []
+        self.festival_db = festival_db # optional FestivalDatabase, same tables as the threaded run
+        if self.festival_db:
+            self.festival_db.create_attendees_table()
+            self.festival_db.create_orders_table()
+
+    def collect_order(self, order):
+        self.all_orders.append(order)
+
+    # staff coroutines, one per Barista/Cook/BathroomStall/Doctor/SecurityStaff thread of the threaded model:
+
+    async def prepare_orders(self, name, station):
+        while True:
+            order = await station.queue.get()
+            if order is None:
+                break
+            order.status = 'in progress'
+            event_log.emit('order_started', name, station.name, lambda: f"{name} is working on {order}", DEBUG)
+            await sleep(order.estimated_time)
+            order.status = 'completed'
+            order.serve()
+            self.collect_order(order)
+
+    async def bathroom_stall(self, name, gender, station):
+        while True:
+            person = await station.queue.get()
+            if person is None:
+                break
+            event_log.emit('bathroom_use', name, f'{gender} Bathroom', lambda: f"Bathroom stall {name} for {gender} is being used by {person.id}", DEBUG)
+            await sleep(random.uniform(2, 5))
+            event_log.emit('bathroom_done', person.id, f'{gender} Bathroom', lambda: f"{person.id} has left the bathroom {name}", DEBUG)
+
+    async def doctor(self, name, station):
+        while True:
+            patient = await station.queue.get()
+            if patient is None:
+                break
+            event_log.emit('treatment', name, 'Emergency Truck', lambda: f"{name} is treating {patient.id}", DEBUG)
+            await sleep(random.uniform(0.5, 1.5))
+            patient.receive_notification('You have been treated! You can go back to the festival but do not drink more')
+
+    async def security(self, name, queue):
+        while True:
+            attendee = await queue.get()
+            if attendee is None:
+                break
+            event_log.emit('security_check', name, 'Entrance', lambda: f"{name} is checking {attendee.id}", DEBUG)
+            await sleep(random.uniform(0.2, 1))
+            if attendee.ticket.type != "No ticket":
+                attendee.is_inside = True
+                attendee.receive_notification('You are now inside! Enjoy the festival!')
+                attendee.entered_at = festival_clock.time()
+                attendee.display_entered_at = festival_clock.time_of_day()
+            else:
+                attendee.receive_notification('You are not allowed to enter the festival. You have no ticket:( sorry!')
+                attendee.display_entered_at = None # never entered
+
+    async def perform(self):
+        for pause in self.stage.show():
+            await sleep(pause)
+
+    async def attend(self, attendee, bar, food_truck, bathroom, emergency_truck):
+        try:
+            for pause in attendee.activity_loop(bar, food_truck, bathroom, emergency_truck, self.stage):
+                await sleep(pause)
+        except Exception as e:
+            event_log.emit('error', attendee.id, message=traceback.format_exc(), level=ERROR)
+
+    async def run(self):
+        # entrance first, like the threaded run
+        entrance = asyncio.Queue()
+        for attendee in self.attendees:
+            entrance.put_nowait(attendee)
+        for _ in range(self.num_security):
+            entrance.put_nowait(None)
+        await asyncio.gather(*[self.security(f'Security {i+1}', entrance) for i in range(self.num_security)])
+
+        bars = [AsyncBar(self.num_baristas, f'Bar {i+1}') for i in range(self.num_bars)]
+        food_trucks = [AsyncFoodTruck(self.num_cooks, f'Food Truck {i+1}') for i in range(self.num_food_trucks)]
+        bathroom = AsyncBathroom(self.num_stalls)
+        emergency_truck = AsyncEmergencyTruck(self.num_doctors)
+
+        staff = []
+        for bar in bars:
+            staff += [self.prepare_orders(f'Barista {i+1}', bar) for i in range(self.num_baristas)]
+        for truck in food_trucks:
+            staff += [self.prepare_orders(f'Cook {i+1}', truck) for i in range(self.num_cooks)]
+        for gender, station in bathroom.persons.items():
+            staff += [self.bathroom_stall(f'B{i+1}', gender, station) for i in range(self.num_stalls)]
+        staff += [self.doctor(f'Doctor {i+1}', emergency_truck) for i in range(self.num_doctors)]
+        staff = [asyncio.create_task(worker) for worker in staff]
+
+        show = asyncio.create_task(self.perform())
+
+        event_log.emit('festival_open', 'Festival', message="\n\nWELCOME TO PUNTA CANA FESTIVAL EVERYONE! Starting festival activities...\n\n", level=MILESTONE)
+        await asyncio.gather(*[self.attend(attendee, random.choice(bars), random.choice(food_trucks), bathroom, emergency_truck)
+                               for attendee in self.attendees if attendee.is_inside])
+        await show
+        self.festival_running = False
+
+        event_log.emit('festival_close', 'Festival', message="\n\nLast festival activities have ended...\n\n", level=MILESTONE)
+        for station in bars + food_trucks + [bathroom, emergency_truck]:
+            station.close()
+        await asyncio.gather(*staff)
+
+    def start(self):
+        festival_clock.use(self.time_scale)
+        try:
+            event_log.set_clock(festival_clock.time)
+            asyncio.run(self.run())
+            if self.festival_db:
+                self.festival_db.insert_attendees(self.attendees)
+                self.festival_db.clear_orders_table()
+                self.festival_db.insert_orders(self.all_orders)
+                self.festival_db.close()
+        except Exception as e:
+            event_log.emit('error', 'Festival', message=traceback.format_exc(), level=ERROR)
+        finally:
+            festival_clock.release()
+            event_log.flush()
+
+
+if __name__ == '__main__':
+
+    random.seed(0)
+    event_log.add_sink(ConsoleSink(level=MILESTONE))
+
+    festival = AsyncFestivalSimulation(num_attendees=500, num_baristas=8, num_cooks=8, num_stalls=10, num_security=20, num_doctors=5, num_stages=3,
+                                       artists_info=DEFAULT_ARTISTS_INFO, num_bars=3, num_food_trucks=3)
+    festival.start()
+    event_log.close()
@@ -0,0 +1,38 @@
+import sys
+
+from punta_cana_festival import BatchPolicy, DEFAULT_ARTISTS_INFO
+from festival_des import DiscreteEventFestival
+
+# Batching report: the same festivals (same seeds) on the discrete-event engine, with baristas and
+# cooks making one order at a time and with batches of same-item orders under a few prep-time models.
+
+METRICS = ['completed_orders', 'orders_per_minute', 'peak_orders_per_minute', 'bar_wait', 'bar_max_wait', 'food_wait', 'food_max_wait']
+
+POLICIES = {
+    'one at a time': None,
+    'batches of 4, n^0.8': BatchPolicy(max_batch=4, exponent=0.8),
+    'batches of 4, n^0.6': BatchPolicy(max_batch=4, exponent=0.6),
+    'batches of 8, n^0.6': BatchPolicy(max_batch=8, exponent=0.6, limits={'Gin Tonic': 2, 'Burger': 4}),
+}
+
+
+def compare_batching(seeds=range(5), policies=POLICIES, **parameters):
+    """Mean of the order metrics per batching policy over the seeds, as {name: {metric: value}}."""
+    results = {}
+    for name, batching in policies.items():
+        runs = [DiscreteEventFestival(seed=seed, batching=batching, **parameters).start() for seed in seeds]
+        results[name] = {metric: round(sum(run[metric] for run in runs) / len(runs), 3) for metric in METRICS}
+    return results
+
+
+if __name__ == '__main__':
+
+    # the opening rush with two baristas and two cooks per station, where batching matters
+    parameters = dict(num_attendees=1000, num_baristas=2, num_cooks=2, num_stalls=10, num_security=20, num_doctors=5, num_stages=3,
+                      artists_info=DEFAULT_ARTISTS_INFO, num_bars=4, num_food_trucks=4)
+    if len(sys.argv) > 1:
+        parameters['num_attendees'] = int(sys.argv[1])
+    results = compare_batching(**parameters)
+    print(f"{'batching':<24}" + ''.join(f"{metric:>24}" for metric in METRICS))
+    for name, values in results.items():
+        print(f"{name:<24}" + ''.join(f"{values[metric]:>24}" for metric in METRICS))
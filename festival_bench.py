@@ -0,0 +1,253 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+from punta_cana_festival import FestivalSimulation, DEFAULT_ARTISTS_INFO
+from festival_des import DiscreteEventFestival
+from festival_storage import SQLiteStorage
+from festival_sweep import BASE_PARAMETERS
+
+# Benchmark suite: standard scenarios run on the discrete-event engine (the accelerated mode of the
+# festival model), each in a fresh process so that its peak RSS is its own. Per scenario it records
+# simulated events per second, peak RSS, the time to flush the results to a database, and the lock
+# contention of the bar and food truck queues in a threaded run of the scenario at high time scale.
+#
+#   python festival_bench.py --output bench.json                 run and save the results
+#   python festival_bench.py --baseline bench.json               run and compare with saved results
+
+def scenario(num_attendees, **changes):
+    parameters = dict(BASE_PARAMETERS)
+    # staff grows with the crowd, so the bigger crowds are not just one long queue
+    scale = max(num_attendees // BASE_PARAMETERS['num_attendees'], 1)
+    for name in ['num_baristas', 'num_cooks', 'num_stalls', 'num_security', 'num_doctors']:
+        parameters[name] = BASE_PARAMETERS[name] * scale
+    parameters['num_attendees'] = num_attendees
+    parameters.update(changes)
+    return parameters
+
+SCENARIOS = {
+    'crowd-500': scenario(500),
+    'crowd-5k': scenario(5000),
+    'crowd-50k': scenario(50000),
+    'crowd-5k-few-baristas': scenario(5000, num_baristas=20),
+    'crowd-5k-many-baristas': scenario(5000, num_baristas=200),
+    'crowd-5k-few-stalls': scenario(5000, num_stalls=20),
+    'crowd-5k-few-security': scenario(5000, num_security=20),
+}
+
+# metric -> True if higher is better, for the regression check
+METRICS = {'events_per_second': True, 'peak_rss_mb': False, 'db_flush_seconds': False, 'lock_wait_seconds': False,
+           'contended_fraction': False}
+
+# metric -> smallest absolute change that counts, so a metric whose baseline is 0 can still regress
+# and a few milliseconds more on a tiny flush or a few MB of RSS are not a regression
+NOISE = {'lock_wait_seconds': 0.05, 'contended_fraction': 0.01, 'db_flush_seconds': 0.005, 'peak_rss_mb': 5.0}
+
+REPEATS = 3 # timings are the fastest of at least this many runs in a process...
+MIN_SECONDS = 1.0 # ...and of at least this much time in all
+PROCESSES = 3 # fresh processes per scenario, the best value of each metric counts
+TOLERANCE = 0.2 # relative change counted as a regression: the best of PROCESSES runs still moves by 10-15% on a busy machine
+
+THREADED_TIME_SCALE = 100 # the threaded run of the lock contention probe, 100 times faster than real time
+THREADED_ATTENDEES = 1000
+
+
+class ProbeLock:
+    """threading.Lock that counts how many acquisitions found it taken and how long they waited."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.owner = None
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.lock.acquire(False):
+            acquired = True
+        else:
+            if not blocking:
+                return False
+            started = time.perf_counter()
+            acquired = self.lock.acquire(True, timeout)
+            self.wait += time.perf_counter() - started
+            if acquired:
+                self.contended += 1 # counted while holding the lock, a timed out attempt is not an acquisition
+        if acquired:
+            self.acquisitions += 1
+            self.owner = threading.get_ident()
+        return acquired
+
+    def release(self):
+        self.owner = None
+        self.lock.release()
+
+    def _is_owned(self): # used by threading.Condition
+        return self.owner == threading.get_ident()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def queue_contention(parameters, seed=0, time_scale=THREADED_TIME_SCALE, max_attendees=THREADED_ATTENDEES):
+    """Lock contention of the bar and food truck WorkQueues during a threaded FestivalSimulation of the
+    scenario, sped up by time_scale. The threaded engine has a thread per attendee inside, so the crowd is
+    capped at max_attendees; the staff is the scenario's."""
+    parameters = dict(parameters, num_attendees=min(parameters['num_attendees'], max_attendees))
+    with tempfile.TemporaryDirectory() as directory:
+        festival = FestivalSimulation(artists_info=DEFAULT_ARTISTS_INFO, storage=SQLiteStorage(os.path.join(directory, 'bench.db')),
+                                      seed=seed, time_scale=time_scale, **parameters)
+        probes = []
+        for station in festival.bars + festival.food_trucks:
+            probes.append(ProbeLock())
+            station.orders.condition = threading.Condition(probes[-1]) # before the staff threads start
+        started = time.perf_counter()
+        festival.start()
+        elapsed = time.perf_counter() - started
+    acquisitions = sum(probe.acquisitions for probe in probes)
+    contended = sum(probe.contended for probe in probes)
+    return {
+        'threaded_attendees': parameters['num_attendees'],
+        'threaded_wall_seconds': round(elapsed, 3),
+        'threaded_orders': festival.completed_orders.value,
+        'lock_acquisitions': acquisitions,
+        'contended_fraction': round(contended / acquisitions, 4) if acquisitions else 0.0,
+        'lock_wait_seconds': round(sum(probe.wait for probe in probes), 4),
+    }
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process; ru_maxrss is in bytes on macOS and in kilobytes on Linux."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024, 1)
+
+
+def fastest_of(measure, repeats=REPEATS, min_seconds=MIN_SECONDS, max_repeats=50):
+    """Fastest of several measure() timings: at least repeats of them and min_seconds in all, so the small
+    scenarios, that take a few hundredths of a second, are not compared on a single noisy run. The work is
+    the same every time, the noise of a busy machine only ever adds to it."""
+    timings = []
+    while len(timings) < max_repeats and (len(timings) < repeats or sum(timings) < min_seconds):
+        timings.append(measure())
+    return min(timings)
+
+
+def run_scenario(parameters, seed=0, repeats=REPEATS):
+    """One scenario, meant to run in its own process. Timings are the fastest of several runs (see fastest_of),
+    the runs are identical since the seed is fixed."""
+    runs = []
+
+    def simulate():
+        runs[:] = [None] # let the previous festival go before building the next one, for the peak RSS
+        festival = DiscreteEventFestival(artists_info=DEFAULT_ARTISTS_INFO, seed=seed, **parameters)
+        started = time.perf_counter() # not the summary's wall_seconds, rounded to the millisecond
+        summary = festival.start()
+        runs[0] = (festival, summary)
+        return time.perf_counter() - started
+
+    wall_seconds = fastest_of(simulate, repeats)
+    festival, summary = runs[0]
+    result = {
+        'attendees': summary['attendees'],
+        'events': summary['events'],
+        'wall_seconds': round(wall_seconds, 4),
+        'events_per_second': round(summary['events'] / wall_seconds, 1) if wall_seconds else 0.0,
+    }
+
+    def store():
+        # the same inserts the threaded simulation does at the end of a run, on a throwaway SQLite file
+        with tempfile.TemporaryDirectory() as directory:
+            storage = SQLiteStorage(os.path.join(directory, 'bench.db'))
+            started = time.perf_counter()
+            festival.store(storage)
+            storage.close()
+            return time.perf_counter() - started
+
+    flush = fastest_of(store, repeats)
+    rows = len(festival.attendees) + len(festival.all_orders)
+    result['db_flush_seconds'] = round(flush, 4)
+    result['db_rows_per_second'] = round(rows / flush, 1) if flush else 0.0
+
+    result['peak_rss_mb'] = peak_rss_mb() # before the threaded run
+    result.update(queue_contention(parameters, seed))
+    return result
+
+
+def best_of(runs):
+    """The best value of every metric over several runs of a scenario, the other fields from the first run."""
+    best = dict(runs[0])
+    for metric, higher_is_better in METRICS.items():
+        best[metric] = (max if higher_is_better else min)(run[metric] for run in runs)
+    best['wall_seconds'] = min(run['wall_seconds'] for run in runs)
+    best['db_rows_per_second'] = max(run['db_rows_per_second'] for run in runs)
+    return best
+
+
+def run_benchmarks(names=None, seed=0, repeats=REPEATS, processes=PROCESSES):
+    results = {}
+    for name in names or SCENARIOS:
+        runs = []
+        for _ in range(processes):
+            # a fresh process per run: peak RSS is a high-water mark and would carry over otherwise, and how fast
+            # a process runs varies from one to the next (by 20% or more on a busy machine), not only within one
+            with multiprocessing.get_context('spawn').Pool(1) as pool:
+                runs.append(pool.apply(run_scenario, (SCENARIOS[name], seed, repeats)))
+        results[name] = best_of(runs)
+        results[name]['parameters'] = SCENARIOS[name]
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Metrics that got worse than the baseline by more than the tolerance, as (scenario, metric, old, new)."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            old, new = baseline[name].get(metric), result.get(metric)
+            if old is None or new is None or (old == 0 and metric not in NOISE):
+                continue
+            worse = old - new if higher_is_better else new - old
+            if worse > NOISE.get(metric, 0.0) and (old == 0 or worse / abs(old) > tolerance):
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark the festival simulation on standard scenarios.")
+    parser.add_argument('scenarios', nargs='*', help=f"scenarios to run (default: all of {', '.join(SCENARIOS)})")
+    parser.add_argument('--output', default=None, help="json file for the results")
+    parser.add_argument('--baseline', default=None, help="json file of earlier results to compare with")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help=f"relative change counted as a regression (default {TOLERANCE})")
+    parser.add_argument('--repeats', type=int, default=REPEATS, help=f"least number of runs per timing in a process, the fastest counts (default {REPEATS})")
+    parser.add_argument('--processes', type=int, default=PROCESSES, help=f"processes per scenario, the best of each metric counts (default {PROCESSES})")
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario '{name}', choose from {', '.join(SCENARIOS)}")
+
+    results = run_benchmarks(args.scenarios, repeats=args.repeats, processes=args.processes)
+    print(f"{'scenario':<26}{'events/s':>12}{'rss MB':>10}{'db flush s':>12}{'contended':>12}{'lock wait s':>13}")
+    for name, result in results.items():
+        print(f"{name:<26}{result['events_per_second']:>12}{result['peak_rss_mb']:>10}{result['db_flush_seconds']:>12}"
+              f"{result['contended_fraction']:>12}{result['lock_wait_seconds']:>13}")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for name, metric, old, new in regressions:
+            print(f"REGRESSION {name} {metric}: {old} -> {new}")
+        if regressions:
+            sys.exit(1)
+        print("no regressions against the baseline")
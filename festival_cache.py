@@ -0,0 +1,120 @@
+import os
+import json
+import pickle
+import hashlib
+import tempfile
+
+# On-disk cache of simulation results. Only seeded runs of the discrete-event and vectorized engines
+# are reproducible, so only those are cached: the same configuration, lineup and seed always give
+# the same attendees, orders and summary, and a repeated scenario is read back instead of rerun.
+
+CACHE_VERSION = 5 # bump when a change to the model changes the results of a seed
+
+
+def cache_key(engine, parameters, seed, artists_info, options=None):
+    """Content address of a run: sha256 of everything that determines its results."""
+    description = {'version': CACHE_VERSION, 'engine': engine, 'seed': seed, 'parameters': parameters,
+                   'artists_info': artists_info, 'options': options or {}}
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class CachedRun:
+    """What a run leaves behind: the summary, the station metrics and, for the discrete-event engine,
+    the attendee and order objects that FestivalStorage writes to the tables and the FestivalAnalytics."""
+    def __init__(self, summary, station_metrics=None, attendees=None, orders=None, analytics=None):
+        self.summary = summary
+        self.station_metrics = station_metrics
+        self.attendees = attendees
+        self.orders = orders
+        self.analytics = analytics
+
+
+class ResultCache:
+    def __init__(self, directory='festival_cache', max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes # least recently used entries are evicted above this size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, f'{key}.pickle')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as file:
+                run = pickle.load(file)
+            os.utime(path) # the modification time is the last use, for the LRU eviction
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return run
+
+    def put(self, key, run):
+        # written to a temporary file and renamed, so concurrent sweep workers never read half an entry
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as file:
+            pickle.dump(run, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, self.path(key))
+        self.evict()
+
+    def entries(self):
+        """(last use, size, path) of every entry, least recently used first."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.pickle'):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue # evicted by another process
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def run_cached(cache, engine, parameters, seed, artists_info, **options):
+    """Run a seeded simulation, or read it back from the cache. Returns a CachedRun. The options
+    (e.g. start for the discrete-event engine) are passed on to the engine and are part of the key."""
+    key = cache_key(engine, parameters, seed, artists_info, options) if cache is not None else None
+    run = cache.get(key) if cache is not None else None
+    if run is not None:
+        return run
+    if engine == 'des':
+        from festival_des import DiscreteEventFestival as Festival
+    elif engine == 'vectorized':
+        from festival_vectorized import VectorizedFestival as Festival
+    else:
+        raise ValueError(f"Only the seeded engines can be cached, not '{engine}'")
+    festival = Festival(artists_info=artists_info, seed=seed, **parameters, **options)
+    summary = festival.start()
+    if engine == 'des':
+        run = CachedRun(summary, festival.station_metrics(), festival.attendees, festival.all_orders, festival.analytics)
+    else:
+        run = CachedRun(summary)
+    if cache is not None:
+        cache.put(key, run)
+    return run
@@ -0,0 +1,149 @@
+import argparse
+import os
+import pickle
+import struct
+import tempfile
+import zlib
+
+from festival_cache import cache_key
+
+# Checkpoints of long discrete-event runs. A checkpoint directory holds
+#
+#   state.ckpt    the festival without its completed orders: event queue, station queues, attendees
+#                 (counters, inside or not, random streams), stage position; a zlib-compressed pickle
+#   orders.log    the completed orders, one compressed chunk appended per checkpoint
+#
+# so every checkpoint only writes the orders completed since the previous one, and a run interrupted
+# at any point resumes from its last checkpoint. The threaded FestivalSimulation cannot be checkpointed
+# (its state is spread over the stacks of hundreds of threads); its deterministic mode runs on this engine
+# and takes a checkpoint_directory.
+#
+#   python festival_checkpoint.py DIRECTORY            resume the run checkpointed in DIRECTORY
+
+CHECKPOINT_VERSION = 2 # bump when DiscreteEventFestival changes in a way old checkpoints cannot follow
+MAGIC = b'FESTIVAL-CHECKPOINT'
+CHUNK = struct.Struct('<I') # length of the compressed order chunk that follows
+
+
+class Checkpointer:
+    def __init__(self, directory, key=None, compression=6):
+        self.directory = directory
+        self.key = key # cache_key of the run, checked on load so a directory is not resumed with other parameters
+        self.compression = compression
+        self.state_path = os.path.join(directory, 'state.ckpt')
+        self.orders_path = os.path.join(directory, 'orders.log')
+        self.orders_saved = 0 # completed orders already in the log
+        self.orders_offset = 0 # end of the last chunk a checkpoint refers to
+        self.saves = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def exists(self):
+        return os.path.exists(self.state_path)
+
+    def save(self, festival):
+        # the new orders first; anything after the last checkpoint's offset is from an interrupted save
+        new_orders = festival.all_orders[self.orders_saved:]
+        with open(self.orders_path, 'r+b' if os.path.exists(self.orders_path) else 'wb') as file:
+            file.seek(self.orders_offset)
+            file.truncate()
+            if new_orders:
+                data = zlib.compress(pickle.dumps(new_orders, protocol=pickle.HIGHEST_PROTOCOL), self.compression)
+                file.write(CHUNK.pack(len(data)) + data)
+            file.flush()
+            os.fsync(file.fileno())
+            orders_offset = file.tell()
+
+        orders, festival.all_orders = festival.all_orders, [] # already in the log
+        try:
+            state = pickle.dumps({'key': self.key, 'orders_offset': orders_offset, 'orders_count': len(orders), 'festival': festival},
+                                 protocol=pickle.HIGHEST_PROTOCOL)
+        finally:
+            festival.all_orders = orders
+        # written to a temporary file and renamed, an interruption leaves the previous checkpoint intact
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as file:
+            file.write(MAGIC + bytes([CHECKPOINT_VERSION]) + zlib.compress(state, self.compression))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self.state_path)
+        self.orders_saved = len(orders)
+        self.orders_offset = orders_offset
+        self.saves += 1
+
+    def load(self):
+        """The checkpointed festival, a new copy on every call."""
+        with open(self.state_path, 'rb') as file:
+            data = file.read()
+        if not data.startswith(MAGIC):
+            raise ValueError(f"{self.state_path} is not a festival checkpoint")
+        version = data[len(MAGIC)]
+        if version != CHECKPOINT_VERSION:
+            raise ValueError(f"{self.state_path} is a version {version} checkpoint, this is version {CHECKPOINT_VERSION}")
+        state = pickle.loads(zlib.decompress(data[len(MAGIC) + 1:]))
+        if self.key is not None and state['key'] != self.key:
+            raise ValueError(f"{self.directory} holds a checkpoint of another configuration")
+        self.key = state['key']
+
+        orders = []
+        with open(self.orders_path, 'rb') as file:
+            while file.tell() < state['orders_offset']:
+                length, = CHUNK.unpack(file.read(CHUNK.size))
+                orders.extend(pickle.loads(zlib.decompress(file.read(length))))
+        festival = state['festival']
+        festival.all_orders = orders
+        self.orders_saved = state['orders_count']
+        self.orders_offset = state['orders_offset']
+        return festival
+
+
+def run_with_checkpoints(festival, checkpointer, interval=60.0):
+    """Play a DiscreteEventFestival to the end, checkpointing every interval simulated seconds. Returns the summary."""
+    if not festival.begun:
+        festival.begin()
+        checkpointer.save(festival)
+    while not festival.run(until=festival.events.now + interval):
+        checkpointer.save(festival)
+    checkpointer.save(festival) # the finished run, resuming it just gives the results back
+    return festival.summary()
+
+
+def run_checkpointed(directory, parameters, seed, artists_info, interval=60.0, **options):
+    """The festival of these parameters, run to the end from its last checkpoint in directory if there is
+    one, from the start otherwise."""
+    from festival_des import DiscreteEventFestival
+    checkpointer = Checkpointer(directory, key=cache_key('des', parameters, seed, artists_info, options))
+    if checkpointer.exists():
+        festival = checkpointer.load()
+    else:
+        festival = DiscreteEventFestival(artists_info=artists_info, seed=seed, **parameters, **options)
+    run_with_checkpoints(festival, checkpointer, interval)
+    return festival
+
+
+def resume(directory, interval=60.0):
+    """Run the festival checkpointed in directory to the end. Returns the festival."""
+    checkpointer = Checkpointer(directory)
+    festival = checkpointer.load()
+    run_with_checkpoints(festival, checkpointer, interval)
+    return festival
+
+
+def fork(festival, seed=None, **staffing):
+    """Independent copy of a running festival for a what-if branch, e.g. fork(warm, seed=3, num_baristas=12):
+    new random streams from seed (None plays out the same future) and new staffing (see restaff)."""
+    branch = pickle.loads(pickle.dumps(festival, protocol=pickle.HIGHEST_PROTOCOL))
+    if seed is not None:
+        branch.reseed(seed)
+    branch.restaff(**staffing)
+    return branch
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Resume a checkpointed discrete-event festival run.")
+    parser.add_argument('directory', help="checkpoint directory of the run")
+    parser.add_argument('--interval', type=float, default=60.0, help="simulated seconds between checkpoints (default 60)")
+    args = parser.parse_args()
+    festival = resume(args.directory, args.interval)
+    for key, value in festival.summary().items():
+        print(f"{key}: {value}")
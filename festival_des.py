@@ -0,0 +1,526 @@
+import heapq
+import time
+import datetime
+import json
+from collections import deque
+
+from punta_cana_festival import (Order, Menu_Bar, Menu_FoodTruck, DEFAULT_ARTISTS_INFO, StationMetrics, Histogram,
+                                 RandomStreams, Lineup, StationRouter, FestivalAnalytics, ArrivalCurve, VIP_TICKETS,
+                                 lane_layout, lane_names, create_attendees, Case, case_severity, TRIAGE_CLASSES)
+
+# Discrete-event version of the festival: same model as FestivalSimulation, but every
+# time.sleep becomes an event on a priority queue, so the run goes as fast as the CPU allows.
+# The whole state (event queue, stations, attendees, random streams) pickles, see festival_checkpoint.py.
+
+# Virtual clock and event queue:
+
+class EventQueue:
+    def __init__(self, start=None):
+        self.now = 0.0 # simulated seconds since the gates opened
+        self.start = start or datetime.datetime.now()
+        self.events = []
+        self.sequence = 0 # tie breaker, keeps events at the same time in FIFO order
+        self.events_processed = 0
+
+    def schedule(self, delay, action, *args):
+        self.sequence += 1
+        heapq.heappush(self.events, (self.now + delay, self.sequence, action, args))
+
+    def clock(self):
+        return self.now
+
+    def run(self, until=None):
+        while self.events:
+            if until is not None and self.events[0][0] > until:
+                self.now = until
+                break
+            event_time, _, action, args = heapq.heappop(self.events)
+            self.now = event_time
+            action(*args)
+            self.events_processed += 1
+
+    def time_of_day(self, seconds=None):
+        """Festival wall-clock time for a simulated timestamp, as stored in the sql tables."""
+        if seconds is None:
+            seconds = self.now
+        return (self.start + datetime.timedelta(seconds=seconds)).time()
+
+
+# Service stations (bars, food trucks, bathroom, emergency truck, entrance):
+
+# module level functions and small classes instead of lambdas, so that a festival can be pickled
+
+def estimated_time(order):
+    return order.estimated_time
+
+
+def discharge(person):
+    pass # bathroom users and patients go back to their activity loop on their own
+
+
+class UniformTime:
+    """Service time function of a station: U(low, high) drawn from the station's own stream."""
+    def __init__(self, rng, low, high):
+        self.rng = rng
+        self.low = low
+        self.high = high
+
+    def __call__(self, item):
+        return self.rng.uniform(self.low, self.high)
+
+
+class TriageTime:
+    """Service time function of an emergency truck with triage: the treatment time of the patient's class."""
+    def __init__(self, rng, triage):
+        self.rng = rng
+        self.triage = triage
+
+    def __call__(self, case):
+        return self.triage.treatment_time(case, self.rng)
+
+
+class ServiceStation:
+    def __init__(self, events, name, servers, service_time, on_complete, work=None, batching=None, deadline=None, category=None):
+        self.events = events
+        self.name = name
+        # optional (item, queued_at) -> deadline: the queue is then a heap of (deadline, sequence, item, queued_at),
+        # served earliest deadline first like a DeadlineQueue of the threaded model
+        self.deadline = deadline
+        self.queue = [] if deadline else deque()
+        self.sequence = 0
+        self.servers = servers
+        self.idle_servers = servers
+        self.service_time = service_time # function item -> simulated seconds
+        self.on_complete = on_complete
+        self.open = True
+        self.metrics = StationMetrics(name, servers, clock=events.clock)
+        self.work = work # optional item -> expected seconds, summed in self.backlog for the routing
+        self.backlog = 0.0
+        self.peers = [] # stations whose queued items idle servers of this one may take (work stealing)
+        self.batching = batching # BatchPolicy for stations that serve orders, None for one item at a time
+        self.category = category # optional item -> class name, the waits are also recorded per class
+
+    def submit(self, item):
+        if self.open and self.idle_servers > 0:
+            self.idle_servers -= 1
+            self.begin(item, self.events.now)
+            return
+        idle = next((peer for peer in self.peers if peer.open and peer.idle_servers > 0), None) if self.open else None
+        if idle:
+            idle.idle_servers -= 1 # an idle server of another station takes it right away
+            idle.begin(item, self.events.now)
+        else:
+            if self.deadline:
+                self.sequence += 1
+                heapq.heappush(self.queue, (self.deadline(item, self.events.now), self.sequence, item, self.events.now))
+            else:
+                self.queue.append((item, self.events.now))
+            if self.work:
+                self.backlog += self.work(item)
+            self.metrics.record_depth(len(self.queue))
+
+    def take(self):
+        if self.deadline:
+            _, _, item, queued_at = heapq.heappop(self.queue)
+        else:
+            item, queued_at = self.queue.popleft()
+        if self.work:
+            self.backlog = max(self.backlog - self.work(item), 0.0)
+        self.metrics.record_depth(len(self.queue))
+        return item, queued_at
+
+    def begin(self, item, queued_at):
+        self.metrics.record_wait(self.events.now - queued_at, self.category(item) if self.category else None)
+        batch = [item]
+        if self.batching:
+            batch += self.take_matching(item, self.batching.limit(item.menu_item) - 1)
+            service_time = self.batching.prep_time(item.menu_item, len(batch))
+        else:
+            service_time = self.service_time(item)
+        self.metrics.record_service(self.name, service_time) # servers are anonymous, busy time is per station
+        self.events.schedule(service_time, self.finish, batch)
+
+    def take_matching(self, order, limit):
+        """Queued orders for the same menu item as order, oldest (or earliest deadline) first, prepared in the same batch."""
+        taken, kept = [], [] if self.deadline else deque()
+        for entry in sorted(self.queue) if self.deadline else self.queue: # a sorted list is still a heap
+            item, queued_at = entry[-2:]
+            if len(taken) < limit and item.menu_item.name == order.menu_item.name:
+                self.metrics.record_wait(self.events.now - queued_at)
+                if self.work:
+                    self.backlog = max(self.backlog - self.work(item), 0.0)
+                taken.append(item)
+            else:
+                kept.append(entry)
+        if taken:
+            self.queue = kept
+            self.metrics.record_depth(len(self.queue))
+        return taken
+
+    def finish(self, batch):
+        for item in batch:
+            self.on_complete(item)
+        if self.idle_servers < 0:
+            self.idle_servers += 1 # staff() took this server away, it leaves after its current item
+            return
+        busiest = max(self.peers, key=lambda peer: len(peer.queue), default=None) if self.open else None
+        if self.open and self.queue:
+            self.begin(*self.take()) # same server picks up the next one
+        elif busiest and busiest.open and busiest.queue:
+            self.begin(*busiest.take())
+        else:
+            self.idle_servers += 1
+
+    def queue_length(self):
+        return len(self.queue)
+
+    def expected_wait(self):
+        return self.backlog / max(self.servers, 1)
+
+    def staff(self, servers):
+        """Change the number of servers mid-run: new ones start on the queue at once, removed ones
+        finish what they are serving first."""
+        self.idle_servers += servers - self.servers
+        self.servers = servers
+        self.metrics.workers = servers
+        while self.open and self.idle_servers > 0 and self.queue:
+            self.idle_servers -= 1
+            self.begin(*self.take())
+
+    def close(self):
+        # like festival_running = False: work in progress finishes, queued work is dropped
+        self.open = False
+        self.metrics.stop()
+
+
+def peak_rate(times, window=60.0):
+    """Most events in any window of that many seconds (times in completion order, so already sorted)."""
+    peak = 0
+    first = 0
+    for last, at in enumerate(times):
+        while at - times[first] >= window:
+            first += 1
+        peak = max(peak, last - first + 1)
+    return peak
+
+
+def mean_wait(stations):
+    served = sum(station.metrics.wait.count for station in stations)
+    return sum(station.metrics.wait.total for station in stations) / served if served else 0.0
+
+
+class DesBar:
+    def __init__(self, events, name, barista_count, on_complete, menu=None, batching=None):
+        self.menu = menu or Menu_Bar()
+        self.station = ServiceStation(events, name, barista_count, estimated_time, on_complete,
+                                      work=estimated_time, batching=batching)
+
+    def add_order(self, order):
+        self.station.submit(order)
+
+    def queue_length(self):
+        return self.station.queue_length()
+
+    def expected_wait(self):
+        return self.station.expected_wait()
+
+
+class DesFoodTruck(DesBar):
+    def __init__(self, events, name, cook_count, on_complete, batching=None):
+        super().__init__(events, name, cook_count, on_complete, menu=Menu_FoodTruck(), batching=batching)
+
+
+# Main simulation class:
+
+class DiscreteEventFestival:
+    def __init__(self, num_attendees, num_baristas, num_cooks, num_stalls, num_security, num_doctors, num_stages, artists_info, num_bars, num_food_trucks, seed=None, start=None,
+                 routing='static', work_stealing=False, batching=None, entrance_lanes=1, vip_lanes=0, arrivals=None, triage=None):
+        # every attendee and station draws from its own stream, so a seed gives the same run whatever
+        # the parameters of the other actors are (e.g. one more bar does not reshuffle the crowd)
+        self.streams = RandomStreams(seed)
+        self.rng = self.streams.stream('festival') # bar and food truck assignment
+        self.events = EventQueue(start)
+        self.attendees = create_attendees(num_attendees, self.streams)
+
+        self.bars = [DesBar(self.events, f'Bar {i+1}', num_baristas, self.complete_order, batching=batching) for i in range(num_bars)]
+        self.food_trucks = [DesFoodTruck(self.events, f'Food Truck {i+1}', num_cooks, self.complete_order, batching) for i in range(num_food_trucks)]
+        # same routing options as FestivalSimulation
+        self.bar_router = StationRouter(self.bars, routing, self.rng, 'Bars') if routing != 'static' else None
+        self.truck_router = StationRouter(self.food_trucks, routing, self.rng, 'Food Trucks') if routing != 'static' else None
+        if work_stealing:
+            for group in (self.bars, self.food_trucks):
+                for station in group:
+                    station.station.peers = [other.station for other in group if other is not station]
+        self.bathroom = {gender: ServiceStation(self.events, f'{gender} Bathroom', num_stalls,
+                                                self.uniform(f'{gender} Bathroom', 2, 5), discharge)
+                         for gender in ['Male', 'Female']}
+        self.triage = triage # Triage of the patients, None for FIFO and the same treatment time for everyone
+        if triage:
+            self.emergency_truck = ServiceStation(self.events, 'Emergency Truck', num_doctors,
+                                                  TriageTime(self.station_stream('Emergency Truck'), triage), discharge,
+                                                  deadline=triage.deadline if triage.priority else None, category=case_severity)
+        else:
+            self.emergency_truck = ServiceStation(self.events, 'Emergency Truck', num_doctors, self.uniform('Emergency Truck', 0.5, 1.5), discharge)
+        # entrance lanes like the threaded Entrance: guards spread over the lanes, idle ones help the other lanes
+        lanes, vip_lanes = lane_layout(num_security, entrance_lanes, vip_lanes)
+        self.entrance = [ServiceStation(self.events, name, sum(1 for guard in range(num_security) if guard % lanes == lane),
+                                        self.uniform(name, 0.2, 1), self.check_ticket)
+                         for lane, name in enumerate(lane_names(lanes, vip_lanes))]
+        for lane in self.entrance:
+            lane.peers = [other for other in self.entrance if other is not lane]
+        self.vip_lanes = self.entrance[:vip_lanes]
+        self.regular_lanes = self.entrance[vip_lanes:]
+        self.arrivals = arrivals or ArrivalCurve()
+        self.assignments = {} # attendee id -> (bar, food truck)
+        self.entrance_closed_at = None
+
+        self.lineup = Lineup(artists_info, num_stages) # same timetable as the threaded Stage
+        self.show_started_at = None
+        self.show_length = self.lineup.length
+
+        self.festival_running = True
+        self.checked = 0
+        self.inside = 0
+        self.show_over = False
+        self.all_orders = []
+        self.analytics = FestivalAnalytics() # the summary totals, kept up to date instead of summed at the end
+        self.wall_time = 0.0
+
+    def station_stream(self, name):
+        return self.streams.stream(name)
+
+    def uniform(self, name, low, high):
+        """Service time function of a station, drawn from the station's own stream."""
+        return UniformTime(self.station_stream(name), low, high)
+
+    def reseed(self, seed):
+        """Fresh random streams for everything that happens from now on, e.g. for what-if branches forked
+        from one mid-festival checkpoint that should not all play out the same afternoon."""
+        self.streams = RandomStreams(seed)
+        self.rng = self.streams.stream('festival')
+        for router in (self.bar_router, self.truck_router):
+            if router:
+                router.rng = self.rng
+        for attendee in self.attendees:
+            attendee.rng = self.streams.stream(attendee.id, compact=True)
+        for station in self.entrance + self.stations():
+            if isinstance(station.service_time, (UniformTime, TriageTime)):
+                station.service_time.rng = self.streams.stream(station.name)
+
+    def restaff(self, num_baristas=None, num_cooks=None, num_stalls=None, num_doctors=None):
+        """New staffing for the stations from now on, None keeps the current one."""
+        changes = [(num_baristas, [bar.station for bar in self.bars]), (num_cooks, [truck.station for truck in self.food_trucks]),
+                   (num_stalls, list(self.bathroom.values())), (num_doctors, [self.emergency_truck])]
+        for servers, stations in changes:
+            if servers is not None:
+                for station in stations:
+                    station.staff(servers)
+
+    # orders:
+
+    def complete_order(self, order):
+        order.status = 'completed'
+        order.completed_at = self.events.now
+        order.attendee = None # nobody to notify here, and the tables only need attendee_id
+        self.all_orders.append(order)
+        self.analytics.add_order(order)
+
+    # entrance:
+
+    def arrive(self, attendee):
+        lanes = self.vip_lanes if self.vip_lanes and attendee.ticket.type in VIP_TICKETS else self.regular_lanes
+        min(lanes, key=lambda lane: (len(lane.queue), -lane.idle_servers)).submit(attendee)
+
+    def check_ticket(self, attendee):
+        if attendee.ticket.type != "No ticket":
+            attendee.is_inside = True
+            attendee.entered_at = self.events.now
+            attendee.display_entered_at = self.events.time_of_day()
+            self.inside += 1
+            self.events.schedule(0, self.next_activity, attendee, *self.assignments[attendee.id]) # streams straight into the festival
+        else:
+            attendee.display_entered_at = None # never entered
+            self.analytics.add_attendee(attendee)
+        self.checked += 1
+        if self.checked == len(self.attendees):
+            self.entrance_closed_at = self.events.now
+            for lane in self.entrance:
+                lane.metrics.stop()
+            self.check_festival_over()
+
+    def open_festival(self):
+        # services and stage open with the gates, attendees join as security lets them in
+        self.show_started_at = self.events.now
+        for station in self.stations():
+            station.metrics.start() # utilization counts from when the services open
+        self.events.schedule(self.show_length, self.end_show)
+        for attendee in self.attendees:
+            bar = self.bar_router or self.rng.choice(self.bars)
+            food_truck = self.truck_router or self.rng.choice(self.food_trucks)
+            self.assignments[attendee.id] = (bar, food_truck)
+
+    # stage:
+
+    def get_current_performer(self, stage_index):
+        if self.show_started_at is None:
+            return None
+        act = self.lineup.performer(stage_index, self.events.now - self.show_started_at)
+        return act.name if act else None
+
+    def end_show(self):
+        self.show_over = True
+        self.check_festival_over()
+
+    # attendee activity loop, one event per time.sleep of Attendee.do_activities:
+
+    def next_activity(self, attendee, bar, food_truck):
+        time_spent = self.events.now - attendee.entered_at
+        if attendee.rng.random() < attendee.leave_probability(time_spent):
+            attendee.is_inside = False
+            attendee.display_exited_at = self.events.time_of_day()
+            self.inside -= 1
+            self.analytics.add_attendee(attendee, time_spent)
+            self.check_festival_over()
+            return
+        activity = attendee.rng.choice(attendee.activities)
+        self.events.schedule(attendee.rng.uniform(0.5, 1.5), self.do_activity, attendee, activity, bar, food_truck)
+
+    def do_activity(self, attendee, activity, bar, food_truck):
+        if activity == 'drinks':
+            drink_item = attendee.rng.choice(bar.menu.items)
+            bar.add_order(Order(attendee, drink_item, attendee.has_free_ticket))
+            attendee.total_drinks += 1
+
+        elif activity == 'food':
+            food_item = attendee.rng.choice(food_truck.menu.items)
+            food_truck.add_order(Order(attendee, food_item, attendee.has_free_ticket))
+            attendee.total_foods += 1
+
+        elif activity == 'music':
+            self.watch_stage(attendee, attendee.rng.randint(0, self.lineup.num_stages - 1), bar, food_truck)
+            return
+
+        elif activity == 'bathroom':
+            if attendee.rng.random() < attendee.bathroom_probability():
+                self.bathroom[attendee.gender].submit(attendee)
+                attendee.total_bathroom_visits += 1
+
+        elif activity == 'emergency':
+            if attendee.rng.random() < attendee.emergency_probability():
+                self.emergency_truck.submit(Case(attendee, self.triage.severity(attendee)) if self.triage else attendee)
+                attendee.total_treatments += 1
+
+        self.rest(attendee, bar, food_truck)
+
+    def watch_stage(self, attendee, stage_index, bar, food_truck):
+        if self.get_current_performer(stage_index):
+            attendee.total_stage_visits += 1
+        self.events.schedule(attendee.rng.uniform(5.0, 10.0), self.rest, attendee, bar, food_truck)
+
+    def rest(self, attendee, bar, food_truck):
+        self.events.schedule(attendee.rng.uniform(2, 5), self.next_activity, attendee, bar, food_truck)
+
+    def check_festival_over(self):
+        if self.festival_running and self.show_over and self.inside == 0 and self.checked == len(self.attendees):
+            self.festival_running = False
+            for station in self.stations():
+                station.close()
+
+    def stations(self):
+        return ([bar.station for bar in self.bars] + [truck.station for truck in self.food_trucks] +
+                list(self.bathroom.values()) + [self.emergency_truck])
+
+    def begin(self):
+        """Open the gates and schedule every arrival, run() then plays the events."""
+        self.open_festival()
+        for attendee, arrival_time in zip(self.attendees, self.arrivals.times(len(self.attendees), self.rng)):
+            self.events.schedule(arrival_time, self.arrive, attendee)
+
+    @property
+    def begun(self):
+        return self.show_started_at is not None
+
+    @property
+    def over(self):
+        return self.begun and not self.events.events
+
+    def run(self, until=None):
+        """Play the events up to until simulated seconds, all of them by default. True once the festival is over."""
+        started = time.perf_counter()
+        self.events.run(until)
+        self.wall_time += time.perf_counter() - started
+        return self.over
+
+    def start(self):
+        started = time.perf_counter()
+        self.begin()
+        self.wall_time += time.perf_counter() - started
+        self.run()
+        return self.summary()
+
+    def summary(self):
+        analytics = self.analytics
+        festival_minutes = max(self.events.now - (self.show_started_at or 0), 1e-9) / 60
+        return {
+            'attendees': len(self.attendees),
+            'admitted': analytics.admitted,
+            'completed_orders': analytics.orders,
+            'drinks': analytics.activities['total_drinks'],
+            'foods': analytics.activities['total_foods'],
+            'revenue': round(analytics.revenue, 2),
+            'treatments': analytics.activities['total_treatments'],
+            'bathroom_visits': analytics.activities['total_bathroom_visits'],
+            'stage_visits': analytics.activities['total_stage_visits'],
+            'orders_per_minute': round(len(self.all_orders) / festival_minutes, 2),
+            'peak_orders_per_minute': peak_rate([order.completed_at for order in self.all_orders]),
+            'bar_wait': round(mean_wait([bar.station for bar in self.bars]), 3),
+            'bar_max_wait': round(max(bar.station.metrics.wait.max for bar in self.bars), 3),
+            'food_wait': round(mean_wait([truck.station for truck in self.food_trucks]), 3),
+            'food_max_wait': round(max(truck.station.metrics.wait.max for truck in self.food_trucks), 3),
+            'bathroom_wait': round(mean_wait(list(self.bathroom.values())), 3),
+            'emergency_wait': round(mean_wait([self.emergency_truck]), 3),
+            **self.triage_summary(),
+            'entrance_wait': round(mean_wait(self.entrance), 3),
+            'entrance_max_wait': round(max(lane.metrics.wait.max for lane in self.entrance), 3),
+            'vip_entrance_wait': round(mean_wait(self.vip_lanes), 3),
+            'checks_per_minute': round(self.checked / max((self.entrance_closed_at or self.events.now) / 60, 1e-9), 2),
+            'simulated_seconds': round(self.events.now, 2),
+            'events': self.events.events_processed,
+            'wall_seconds': round(self.wall_time, 3),
+        }
+
+    def triage_summary(self):
+        """Patients and time to treatment per severity class, for sizing the doctors on the tail; empty without triage."""
+        if not self.triage:
+            return {}
+        summary = {}
+        for severity in TRIAGE_CLASSES:
+            wait = self.emergency_truck.metrics.category_wait.get(severity, Histogram())
+            summary[f'{severity}_patients'] = wait.count
+            summary[f'{severity}_wait'] = round(wait.total / wait.count, 3) if wait.count else 0.0
+            summary[f'{severity}_p95_wait'] = round(wait.percentile(95), 3)
+            summary[f'{severity}_max_wait'] = round(wait.max, 3)
+        return summary
+
+    def station_metrics(self):
+        return {station.name: station.metrics.summary() for station in self.entrance + self.stations()}
+
+    def export_metrics(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.station_metrics(), file, indent=2)
+
+    def store(self, festival_db):
+        """Write the results with the same FestivalDatabase used by the threaded simulation."""
+        festival_db.create_attendees_table()
+        festival_db.create_orders_table()
+        festival_db.insert_attendees(self.attendees)
+        festival_db.clear_orders_table()
+        festival_db.insert_orders(self.all_orders)
+
+
+if __name__ == '__main__':
+
+    festival = DiscreteEventFestival(num_attendees=500, num_baristas=8, num_cooks=8, num_stalls=10, num_security=20, num_doctors=5, num_stages=3,
+                                     artists_info=DEFAULT_ARTISTS_INFO, num_bars=3, num_food_trucks=3, seed=0)
+    for key, value in festival.start().items():
+        print(f"{key}: {value}")
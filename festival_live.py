@@ -0,0 +1,134 @@
+import json
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from punta_cana_festival import festival_clock
+
+# Live metrics of a running threaded FestivalSimulation over local HTTP. Nothing is computed on the hot
+# paths: the attendee and staff threads only bump counters, and every request reads those
+# counters and the queue lengths, so a scrape costs the same whatever the size of the crowd.
+#
+#   FestivalSimulation(..., live_port=8000).start()
+#   curl localhost:8000/metrics            Prometheus text format
+#   curl localhost:8000/metrics.json       the same snapshot as json
+
+
+def queue_depths(festival):
+    """Orders, attendees or patients waiting at every station, by station name."""
+    depths = {metrics.name: len(lane) for metrics, lane in zip(festival.entrance.metrics, festival.entrance.lanes)}
+    for station in festival.bars + festival.food_trucks:
+        depths[station.name] = len(station.orders)
+    for gender, persons in festival.bathroom.persons.items():
+        depths[f'{gender} Bathroom'] = len(persons)
+    depths['Emergency Truck'] = len(festival.emergency_truck.patients)
+    return depths
+
+
+class LiveMetrics:
+    """Snapshots of a FestivalSimulation. The order rate is measured over the last window festival seconds,
+    or since the previous snapshot when the snapshots are further apart than that."""
+    def __init__(self, festival, window=10.0):
+        self.festival = festival
+        self.window = window
+        self.samples = deque() # (festival time, completed orders) of the recent snapshots
+        self.lock = threading.Lock()
+
+    def orders_per_second(self, now, completed):
+        with self.lock:
+            self.samples.append((now, completed))
+            while len(self.samples) > 2 and now - self.samples[1][0] >= self.window:
+                self.samples.popleft()
+            then, before = self.samples[0]
+        return (completed - before) / (now - then) if now > then else 0.0
+
+    def snapshot(self):
+        festival = self.festival
+        now = festival_clock.time()
+        admitted, left = festival.admitted.value, festival.left.value
+        completed = festival.completed_orders.value
+        stage = festival.stage
+        return {
+            'festival_seconds': round(now - stage.started_at, 3) if stage.started_at is not None else 0.0,
+            'running': festival.festival_running,
+            'attendees': len(festival.attendees),
+            'admitted': admitted,
+            'inside': admitted - left,
+            'left': left,
+            'completed_orders': completed,
+            'orders_per_second': round(self.orders_per_second(now, completed), 3),
+            'queue_depths': queue_depths(festival),
+            'performers': {f'{genre} Stage' if genre else f'Stage {stage_index+1}': act.name if act else None
+                           for stage_index, genre, act in stage.current_performers()},
+        }
+
+
+def label_value(text):
+    """A label value escaped for the text format: backslash, double quote and newline."""
+    return str(text).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(snapshot):
+    """A snapshot in the Prometheus text exposition format."""
+    lines = []
+
+    def metric(name, kind, help, samples):
+        lines.append(f'# HELP festival_{name} {help}')
+        lines.append(f'# TYPE festival_{name} {kind}')
+        for labels, value in samples:
+            label_text = ','.join(f'{key}="{label_value(text)}"' for key, text in labels.items())
+            lines.append(f'festival_{name}{{{label_text}}} {value}' if label_text else f'festival_{name} {value}')
+
+    metric('seconds', 'gauge', 'Festival seconds since the show started.', [({}, snapshot['festival_seconds'])])
+    metric('running', 'gauge', '1 while the festival is running.', [({}, int(snapshot['running']))])
+    metric('attendees_inside', 'gauge', 'Attendees inside the festival.', [({}, snapshot['inside'])])
+    metric('attendees_admitted_total', 'counter', 'Attendees let in by security.', [({}, snapshot['admitted'])])
+    metric('attendees_left_total', 'counter', 'Attendees who left the festival.', [({}, snapshot['left'])])
+    metric('orders_completed_total', 'counter', 'Drink and food orders served.', [({}, snapshot['completed_orders'])])
+    metric('orders_per_second', 'gauge', 'Orders served per festival second, recent window.', [({}, snapshot['orders_per_second'])])
+    metric('queue_depth', 'gauge', 'Waiting at the station.', [({'station': name}, depth) for name, depth in snapshot['queue_depths'].items()])
+    metric('performing', 'gauge', '1 for the artist on each stage.',
+           [({'stage': stage, 'artist': artist}, 1) for stage, artist in snapshot['performers'].items() if artist])
+    return '\n'.join(lines) + '\n'
+
+
+class LiveMetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/metrics':
+            body, content_type = prometheus_text(self.server.live.snapshot()), 'text/plain; version=0.0.4'
+        elif path in ('/', '/metrics.json'):
+            body, content_type = json.dumps(self.server.live.snapshot(), indent=2), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        data = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass # no request lines in the festival output
+
+
+class LiveMetricsServer:
+    """Serves LiveMetrics of a festival from a daemon thread; port=0 picks a free port, see url."""
+    def __init__(self, festival, host='127.0.0.1', port=8000, window=10.0):
+        self.server = ThreadingHTTPServer((host, port), LiveMetricsHandler)
+        self.server.daemon_threads = True
+        self.server.live = LiveMetrics(festival, window)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='Live metrics', daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/metrics'
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,186 @@
+import sys
+import json
+import time
+import struct
+import threading
+from collections import deque, namedtuple
+
+# Structured event log for the simulations. Actors call event_log.emit(...) instead of print: the
+# call only appends to a buffer, and a background thread hands the events to the sinks in batches,
+# so hundreds of threads no longer fight over the stdout lock.
+
+# verbosity levels
+DEBUG = 10 # notifications and staff chatter
+INFO = 20 # what the attendees do
+MILESTONE = 30 # festival opening, sets starting and ending
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: 'debug', INFO: 'info', MILESTONE: 'milestone', ERROR: 'error'}
+
+Event = namedtuple('Event', ['time', 'level', 'type', 'actor', 'station', 'message'])
+
+
+# Sinks:
+
+class Sink:
+    def __init__(self, level=DEBUG):
+        self.level = level # events below this level are not written to this sink
+
+    def write(self, events):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class ConsoleSink(Sink):
+    """The old print output, one line per event, written in one go per batch."""
+    def __init__(self, level=INFO, stream=None):
+        super().__init__(level)
+        self.stream = stream or sys.stdout
+
+    def write(self, events):
+        self.stream.write(''.join(f"{event.message}\n" for event in events))
+
+    def flush(self):
+        self.stream.flush()
+
+
+class JSONLSink(Sink):
+    def __init__(self, path, level=DEBUG):
+        super().__init__(level)
+        self.file = open(path, 'w', buffering=1 << 20)
+
+    def write(self, events):
+        self.file.write(''.join(json.dumps({'time': round(event.time, 4), 'level': LEVEL_NAMES.get(event.level, event.level),
+                                            'type': event.type, 'actor': event.actor, 'station': event.station,
+                                            'message': event.message}) + '\n' for event in events))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class BinarySink(Sink):
+    """Compact records: time (double), level (byte), then type, actor, station and message as
+    length-prefixed utf-8 strings, cut to 64 kB on a character boundary. Read them back with read_binary_log."""
+    HEADER = struct.Struct('<dB')
+    LENGTH = struct.Struct('<H')
+
+    def __init__(self, path, level=DEBUG):
+        super().__init__(level)
+        self.file = open(path, 'wb', buffering=1 << 20)
+
+    def write(self, events):
+        chunks = []
+        for event in events:
+            chunks.append(self.HEADER.pack(event.time, event.level))
+            for text in (event.type, event.actor, event.station, event.message):
+                data = (text or '').encode('utf-8')
+                if len(data) > 0xFFFF:
+                    data = data[:0xFFFF].decode('utf-8', 'ignore').encode('utf-8') # drops a character cut in half
+                chunks.append(self.LENGTH.pack(len(data)))
+                chunks.append(data)
+        self.file.write(b''.join(chunks))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_binary_log(path):
+    """Yield the Events written by a BinarySink."""
+    with open(path, 'rb') as file:
+        data = file.read()
+    offset = 0
+    while offset < len(data):
+        event_time, level = BinarySink.HEADER.unpack_from(data, offset)
+        offset += BinarySink.HEADER.size
+        fields = []
+        for _ in range(4):
+            (length,) = BinarySink.LENGTH.unpack_from(data, offset)
+            offset += BinarySink.LENGTH.size
+            fields.append(data[offset:offset + length].decode('utf-8'))
+            offset += length
+        yield Event(event_time, level, *fields)
+
+
+# Event log:
+
+class EventLog:
+    def __init__(self, clock=time.time, flush_interval=0.2):
+        self.sinks = []
+        self.level = ERROR # until a sink is added only errors are kept, written straight to stderr
+        self.clock = clock
+        self.started_at = clock()
+        self.flush_interval = flush_interval # seconds between two background writes
+        self.buffer = deque() # append and popleft are thread safe, no lock on the hot path
+        self.write_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.writer = None
+
+    def emit(self, event_type, actor, station=None, message='', level=INFO):
+        """message can be a function returning the text, so a hot path only formats it if the event is kept."""
+        if level < self.level:
+            return # cheap when the verbosity filters the event out
+        if callable(message):
+            message = message()
+        if not self.sinks:
+            sys.stderr.write(f"{message}\n") # no sink yet (e.g. a library caller), errors must not vanish
+            return
+        self.buffer.append(Event(self.clock() - self.started_at, level, event_type, actor, station, message))
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        self.level = min(s.level for s in self.sinks)
+        if self.writer is None:
+            self.writer = threading.Thread(target=self.run, name='Event Log Writer', daemon=True)
+            self.writer.start()
+
+    def set_clock(self, clock):
+        """Timestamps become clock() - clock() at this call, e.g. seconds since the festival opened."""
+        self.clock = clock
+        self.started_at = clock()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.write_pending()
+
+    def write_pending(self):
+        with self.write_lock:
+            events = []
+            while self.buffer:
+                events.append(self.buffer.popleft())
+            if not events:
+                return
+            for sink in self.sinks:
+                selected = [event for event in events if event.level >= sink.level]
+                if selected:
+                    sink.write(selected)
+
+    def flush(self):
+        """Write everything emitted so far, from the calling thread."""
+        self.write_pending()
+        with self.write_lock:
+            for sink in self.sinks:
+                sink.flush()
+
+    def close(self):
+        self.flush()
+        with self.write_lock:
+            for sink in self.sinks:
+                sink.close()
+            self.sinks = []
+            self.level = ERROR
+
+
+event_log = EventLog() # shared by every actor of the simulation
@@ -0,0 +1,310 @@
+import argparse
+import bisect
+import csv
+import datetime
+import sys
+import time
+from collections import deque, namedtuple
+
+from punta_cana_festival import RandomStreams, StationRouter, Menu_Bar, Menu_FoodTruck, Order, FestivalAnalytics
+from festival_des import EventQueue, ServiceStation, DesBar, DesFoodTruck, UniformTime, discharge, mean_wait
+from festival_sweep import BASE_PARAMETERS, parameter_grid, parse_values, write_table
+
+# Trace replay: a recorded festival (the attendees and orders tables, as CSV files or in a database)
+# played through the discrete-event bars, food trucks, bathrooms and emergency truck with other
+# staffing, e.g. "last year's crowd with 4 more baristas". The tables keep no order times, so every
+# attendee's orders, bathroom visits and treatments are spread evenly over their stay.
+#
+# The orders table, the bulk of a trace, is read in chunks and only as far ahead as the simulation
+# needs (horizon simulated seconds); the attendees table is read once, in chunks, into one small
+# record per attendee.
+#
+#   python festival_replay.py attendees_seed_0.csv orders_seed_0.csv --set num_baristas=2,4,8
+#   python festival_replay.py --database festival.db --set num_cooks=2,4
+
+STAFFING = ['num_baristas', 'num_cooks', 'num_stalls', 'num_doctors', 'num_bars', 'num_food_trucks']
+
+Stay = namedtuple('Stay', ['entered', 'exited', 'orders', 'bathroom_visits', 'treatments', 'gender'])
+Visitor = namedtuple('Visitor', ['id', 'gender']) # what the stations and the orders need of an attendee
+
+
+# Trace sources, each a generator of row chunks (lists of {column: value}):
+
+def csv_chunks(path, chunk_size=10000):
+    with open(path, newline='') as file:
+        chunk = []
+        for row in csv.DictReader(file):
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def table_chunks(connection, table, order_by, chunk_size=10000):
+    """Rows of a table of any DB-API connection (sqlite3, mysql.connector...), fetched chunk by chunk."""
+    cursor = connection.cursor()
+    cursor.execute(f"SELECT * FROM {table} ORDER BY {order_by}")
+    columns = [column[0] for column in cursor.description]
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield [dict(zip(columns, row)) for row in rows]
+    cursor.close()
+
+
+class Trace:
+    """A recorded festival: attendee rows and order rows (in order_id order), both as chunk generators.
+    Factories rather than generators, so that the same trace can be replayed more than once."""
+    def __init__(self, attendees, orders):
+        self.attendees = attendees # () -> chunks of attendee rows
+        self.orders = orders # () -> chunks of order rows
+
+    @classmethod
+    def from_csv(cls, attendees_path, orders_path, chunk_size=10000):
+        return cls(lambda: csv_chunks(attendees_path, chunk_size), lambda: csv_chunks(orders_path, chunk_size))
+
+    @classmethod
+    def from_database(cls, connection, chunk_size=10000):
+        return cls(lambda: table_chunks(connection, 'attendees', 'id', chunk_size),
+                   lambda: table_chunks(connection, 'orders', 'order_id', chunk_size))
+
+
+def seconds_of_day(value):
+    """'15:03:23', a datetime.time or a timedelta (MySQL TIME) -> seconds since midnight, None for NULL."""
+    if value is None or value == 'NULL' or value == '':
+        return None
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    if isinstance(value, datetime.time):
+        return value.hour * 3600 + value.minute * 60 + value.second
+    hours, minutes, seconds = value.split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def spread(stay, k, count, trace_end):
+    """Time of the k-th of count events of an attendee, evenly over their stay."""
+    exited = stay.exited if stay.exited is not None else trace_end
+    return stay.entered + (k + 0.5) / max(count, k + 1) * (exited - stay.entered)
+
+
+class ReplayFestival:
+    def __init__(self, trace, num_baristas, num_cooks, num_stalls, num_doctors, num_bars, num_food_trucks, seed=None,
+                 routing='static', work_stealing=False, batching=None, horizon=60.0):
+        self.trace = trace
+        self.horizon = horizon # simulated seconds of orders read ahead of the clock
+        self.streams = RandomStreams(seed)
+        self.rng = self.streams.stream('festival') # bar and food truck assignment
+        self.events = EventQueue()
+
+        self.bars = [DesBar(self.events, f'Bar {i+1}', num_baristas, self.complete_order, batching=batching) for i in range(num_bars)]
+        self.food_trucks = [DesFoodTruck(self.events, f'Food Truck {i+1}', num_cooks, self.complete_order, batching) for i in range(num_food_trucks)]
+        self.bar_router = StationRouter(self.bars, routing, self.rng, 'Bars') if routing != 'static' else None
+        self.truck_router = StationRouter(self.food_trucks, routing, self.rng, 'Food Trucks') if routing != 'static' else None
+        if work_stealing:
+            for group in (self.bars, self.food_trucks):
+                for station in group:
+                    station.station.peers = [other.station for other in group if other is not station]
+        self.bathroom = {gender: ServiceStation(self.events, f'{gender} Bathroom', num_stalls,
+                                                UniformTime(self.streams.stream(f'{gender} Bathroom'), 2, 5), discharge)
+                         for gender in ['Male', 'Female']}
+        self.emergency_truck = ServiceStation(self.events, 'Emergency Truck', num_doctors,
+                                              UniformTime(self.streams.stream('Emergency Truck'), 0.5, 1.5), discharge)
+        self.bar_menu = Menu_Bar()
+        self.food_menu = Menu_FoodTruck()
+
+        self.stays = {} # attendee id -> Stay, times in seconds since the first admission
+        self.entries = [] # (entered, attendee id), for the visits of the attendees coming in next
+        self.placed = {} # attendee id -> orders replayed so far
+        self.assignments = {} # attendee id -> (bar, food truck) with the static routing
+        self.trace_end = 0.0
+        self.next_entry = 0
+        self.order_chunks = None
+        self.read_until = 0.0 # where the trace has been read up to: the typical order time of the last chunk
+
+        self.orders_replayed = 0
+        self.late_orders = 0 # read after their time had passed, replayed right away
+        self.unknown_orders = 0 # attendee not in the attendees table, skipped
+        self.completed_orders = 0
+        self.analytics = FestivalAnalytics() # revenue per menu item, alcohol share... of the replayed orders
+        self.last_minute = deque() # completion times of the last 60 seconds, for the peak rate
+        self.peak_orders_per_minute = 0
+        self.wall_time = 0.0
+
+    # trace:
+
+    def load_attendees(self):
+        rows = []
+        for chunk in self.trace.attendees():
+            for row in chunk:
+                entered = seconds_of_day(row['entered_at'])
+                if entered is None:
+                    continue # never got in
+                rows.append((row['id'], entered, seconds_of_day(row['exited_at']), int(row['total_drinks']) + int(row['total_foods']),
+                             int(row['total_bathroom_visits']), int(row['total_treatments']), row['gender']))
+        opened = min((entered for _, entered, *_ in rows), default=0.0)
+        for attendee_id, entered, exited, orders, bathroom_visits, treatments, gender in rows:
+            entered -= opened
+            if exited is not None:
+                exited -= opened
+                if exited < entered:
+                    exited += 24 * 3600 # left after midnight
+                self.trace_end = max(self.trace_end, exited)
+            self.stays[attendee_id] = Stay(entered, exited, orders, bathroom_visits, treatments, gender)
+            self.entries.append((entered, attendee_id))
+            self.trace_end = max(self.trace_end, entered)
+        self.entries.sort()
+
+    def refill(self):
+        """Schedule what happens within the horizon: the visits of the attendees coming in, the next order chunks."""
+        until = self.events.now + self.horizon
+        stop = bisect.bisect_right(self.entries, until, key=lambda entry: entry[0])
+        for _, attendee_id in self.entries[self.next_entry:stop]:
+            self.schedule_visits(attendee_id)
+        self.next_entry = max(self.next_entry, stop)
+        while self.order_chunks is not None and self.read_until <= until:
+            chunk = next(self.order_chunks, None)
+            if chunk is None:
+                self.order_chunks = None
+                break
+            times = sorted(at for at in map(self.schedule_order, chunk) if at is not None)
+            if times:
+                # the table is in completion order, but the evenly spread times are not, so the median
+                # rather than the latest order time tells how far the trace has been read
+                self.read_until = times[len(times) // 2]
+        if self.order_chunks is not None or self.next_entry < len(self.entries):
+            self.events.schedule(self.horizon / 2, self.refill)
+
+    def schedule_visits(self, attendee_id):
+        stay = self.stays[attendee_id]
+        visitor = Visitor(attendee_id, stay.gender)
+        self.visit(self.bathroom[stay.gender], visitor, -1, stay.bathroom_visits)
+        self.visit(self.emergency_truck, visitor, -1, stay.treatments)
+
+    def visit(self, station, visitor, k, count):
+        """The k-th of count visits of an attendee to the station; only the next one is scheduled, not the whole stay."""
+        if k >= 0:
+            station.submit(visitor)
+        if k + 1 < count:
+            at = spread(self.stays[visitor.id], k + 1, count, self.trace_end)
+            self.events.schedule(max(at - self.events.now, 0.0), self.visit, station, visitor, k + 1, count)
+
+    def schedule_order(self, row):
+        attendee_id = row['attendee_id']
+        stay = self.stays.get(attendee_id)
+        if stay is None:
+            self.unknown_orders += 1
+            return None
+        k = self.placed.get(attendee_id, 0)
+        self.placed[attendee_id] = k + 1
+        at = spread(stay, k, stay.orders, self.trace_end)
+        if at < self.events.now:
+            self.late_orders += 1
+        self.events.schedule(max(at - self.events.now, 0.0), self.place_order, attendee_id, stay.gender, row['menu_item_name'])
+        return at
+
+    def place_order(self, attendee_id, gender, item_name):
+        if attendee_id not in self.assignments:
+            self.assignments[attendee_id] = (self.bar_router or self.rng.choice(self.bars),
+                                             self.truck_router or self.rng.choice(self.food_trucks))
+        bar, food_truck = self.assignments[attendee_id]
+        menu_item = self.bar_menu.get_item_by_name(item_name)
+        station = bar
+        if menu_item is None:
+            menu_item = self.food_menu.get_item_by_name(item_name)
+            station = food_truck
+        if menu_item is None:
+            self.unknown_orders += 1 # not on today's menus
+            return
+        self.orders_replayed += 1
+        station.add_order(Order(Visitor(attendee_id, gender), menu_item, False)) # the tables do not keep free tickets
+
+    def complete_order(self, order):
+        # counted, not kept: a replay holds no more orders than are waiting at the stations
+        now = self.events.now
+        self.completed_orders += 1
+        self.analytics.add_order(order)
+        self.last_minute.append(now)
+        while now - self.last_minute[0] >= 60:
+            self.last_minute.popleft()
+        self.peak_orders_per_minute = max(self.peak_orders_per_minute, len(self.last_minute))
+
+    def stations(self):
+        return ([bar.station for bar in self.bars] + [truck.station for truck in self.food_trucks] +
+                list(self.bathroom.values()) + [self.emergency_truck])
+
+    def start(self):
+        started = time.perf_counter()
+        self.load_attendees()
+        self.order_chunks = iter(self.trace.orders())
+        self.refill()
+        self.events.run() # every recorded order is served, the stations close once they are empty
+        for station in self.stations():
+            station.close()
+        self.wall_time = time.perf_counter() - started
+        return self.summary()
+
+    def summary(self):
+        minutes = max(self.events.now, 1e-9) / 60
+        return {
+            'attendees': len(self.stays),
+            'orders': self.orders_replayed,
+            'late_orders': self.late_orders,
+            'unknown_orders': self.unknown_orders,
+            'completed_orders': self.completed_orders,
+            'revenue': round(self.analytics.revenue, 2),
+            'orders_per_minute': round(self.completed_orders / minutes, 2),
+            'peak_orders_per_minute': self.peak_orders_per_minute,
+            'bar_wait': round(mean_wait([bar.station for bar in self.bars]), 3),
+            'bar_max_wait': round(max(bar.station.metrics.wait.max for bar in self.bars), 3),
+            'food_wait': round(mean_wait([truck.station for truck in self.food_trucks]), 3),
+            'food_max_wait': round(max(truck.station.metrics.wait.max for truck in self.food_trucks), 3),
+            'bathroom_wait': round(mean_wait(list(self.bathroom.values())), 3),
+            'emergency_wait': round(mean_wait([self.emergency_truck]), 3),
+            'simulated_seconds': round(self.events.now, 2),
+            'events': self.events.events_processed,
+            'wall_seconds': round(self.wall_time, 3),
+        }
+
+    def station_metrics(self):
+        return {station.name: station.metrics.summary() for station in self.stations()}
+
+
+def replay_staffing(trace, grid, base=None, seed=0, **options):
+    """Replay the trace with every staffing of the grid, e.g. {'num_baristas': [4, 8]}; one summary row per staffing."""
+    base = {name: value for name, value in (base or BASE_PARAMETERS).items() if name in STAFFING}
+    rows = []
+    for parameters in parameter_grid(grid, base):
+        row = dict(parameters)
+        row.update(ReplayFestival(trace, seed=seed, **parameters, **options).start())
+        rows.append(row)
+    return rows
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Replay a recorded festival with other staffing.")
+    parser.add_argument('tables', nargs='*', metavar='CSV', help="attendees and orders csv files")
+    parser.add_argument('--database', default=None, help="SQLite file with the attendees and orders tables, instead of csv files")
+    parser.add_argument('--set', action='append', default=[], metavar='PARAMETER=VALUES',
+                        help=f"staffing to compare, e.g. --set num_baristas=4,8 (one of {', '.join(STAFFING)}, repeatable)")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the service times and the bar and food truck assignment")
+    parser.add_argument('--chunk-size', type=int, default=10000, help="rows read at a time")
+    args = parser.parse_args()
+
+    if args.database:
+        import sqlite3
+        trace = Trace.from_database(sqlite3.connect(args.database), args.chunk_size)
+    elif len(args.tables) == 2:
+        trace = Trace.from_csv(*args.tables, args.chunk_size)
+    else:
+        parser.error("give the attendees and orders csv files, or --database")
+    grid = {}
+    for assignment in args.set:
+        name, values = assignment.split('=', 1)
+        if name not in STAFFING:
+            parser.error(f"unknown parameter '{name}', choose one of {', '.join(STAFFING)}")
+        grid[name] = parse_values(values)
+    write_table(replay_staffing(trace, grid, seed=args.seed), sys.stdout)
@@ -0,0 +1,69 @@
+import os
+import sys
+import tempfile
+
+from punta_cana_festival import ROUTING_POLICIES, DEFAULT_ARTISTS_INFO, FestivalSimulation
+from festival_des import DiscreteEventFestival
+from festival_storage import SQLiteStorage
+
+# Routing report: the same festivals (same seeds) on the discrete-event engine with every routing
+# policy, with and without work stealing, against the static one-bar-per-attendee assignment.
+# Every order placed is eventually served whatever the routing, so the throughput reported is the
+# busiest minute, which rises when the stations share the load, not the total or mean rate.
+
+METRICS = ['peak_orders_per_minute', 'bar_wait', 'bar_max_wait', 'food_wait', 'food_max_wait']
+
+
+def compare_routing(seeds=range(5), policies=ROUTING_POLICIES, **parameters):
+    """Mean of the order metrics per (policy, work stealing) over the seeds, as {name: {metric: value}}."""
+    results = {}
+    for policy in policies:
+        for work_stealing in (False, True):
+            runs = [DiscreteEventFestival(seed=seed, routing=policy, work_stealing=work_stealing, **parameters).start() for seed in seeds]
+            name = policy + (' + stealing' if work_stealing else '')
+            results[name] = {metric: round(sum(run[metric] for run in runs) / len(runs), 3) for metric in METRICS}
+    return results
+
+
+def gains(results, baseline='static'):
+    """Relative change of every metric against the baseline, e.g. -0.4 for a 40% shorter wait."""
+    reference = results[baseline]
+    return {name: {metric: round(values[metric] / reference[metric] - 1, 3) if reference[metric] else 0.0 for metric in METRICS}
+            for name, values in results.items()}
+
+
+def check_threaded(policies=ROUTING_POLICIES, time_scale=50, seed=0):
+    """Run a short threaded FestivalSimulation per policy, with work stealing, and fail unless orders get served:
+    the routers also stand in for a bar or food truck in the attendee threads, not only on the discrete-event engine."""
+    completed = {}
+    for policy in policies:
+        with tempfile.TemporaryDirectory() as directory:
+            festival = FestivalSimulation(num_attendees=50, num_baristas=2, num_cooks=2, num_stalls=2, num_security=4, num_doctors=1,
+                                          num_stages=3, artists_info=[{'name': 'Opening act', 'genre': 'Pop', 'set_duration': 20}],
+                                          num_bars=2, num_food_trucks=2, storage=SQLiteStorage(os.path.join(directory, 'festival.db')),
+                                          routing=policy, work_stealing=True, time_scale=time_scale, seed=seed)
+            festival.start()
+        completed[policy] = festival.completed_orders.value
+        if not completed[policy]:
+            raise AssertionError(f"no order was served on the threaded engine with routing='{policy}'")
+    return completed
+
+
+if __name__ == '__main__':
+
+    if '--threaded' in sys.argv:
+        # python festival_routing.py --threaded: the threaded engine with every routing policy
+        for policy, orders in check_threaded().items():
+            print(f"{policy:<16}{orders:>6} orders served")
+        sys.exit()
+
+    # a busy festival, four baristas and four cooks per station, so that queues build up
+    parameters = dict(num_attendees=1000, num_baristas=4, num_cooks=4, num_stalls=10, num_security=20, num_doctors=5, num_stages=3,
+                      artists_info=DEFAULT_ARTISTS_INFO, num_bars=4, num_food_trucks=4)
+    if len(sys.argv) > 1:
+        parameters['num_attendees'] = int(sys.argv[1])
+    results = compare_routing(**parameters)
+    changes = gains(results)
+    print(f"{'routing':<28}" + ''.join(f"{metric:>24}" for metric in METRICS))
+    for name, values in results.items():
+        print(f"{name:<28}" + ''.join(f"{values[metric]:>16} ({changes[name][metric]:+.0%})" for metric in METRICS))
@@ -0,0 +1,230 @@
+import os
+import csv
+import sqlite3
+import threading
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None # only needed by ParquetStorage
+
+from punta_cana_festival import FestivalStorage, FestivalDatabase, attendee_row, order_row
+
+# Storage backends for FestivalSimulation(storage=...). All of them write the same attendees and
+# orders tables as FestivalDatabase (MySQL), so the analysis notebook works on any of them.
+
+ATTENDEE_COLUMNS = ['id', 'age', 'ticket_type', 'total_drinks', 'total_foods', 'total_treatments',
+                    'total_bathroom_visits', 'total_stage_visits', 'gender', 'entered_at', 'exited_at']
+ORDER_COLUMNS = ['order_id', 'attendee_id', 'menu_item_name', 'price', 'contains_alcohol', 'status']
+
+MySQLStorage = FestivalDatabase
+
+
+# SQLite: one file per simulation, no server needed
+
+class SQLiteStorage(FestivalStorage):
+    def __init__(self, path='festival.db', chunk_size=1000):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.conn = sqlite3.connect(path, check_same_thread=False) # also used by the OrderWriter thread
+        self.lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL;") # readers do not block the writer
+        self.conn.execute("PRAGMA synchronous=NORMAL;") # fsync at checkpoints instead of every commit
+
+    def create_attendees_table(self):
+        with self.lock:
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS attendees (
+                id VARCHAR(10) PRIMARY KEY,
+                age INT,
+                ticket_type VARCHAR(50),
+                total_drinks INT,
+                total_foods INT,
+                total_treatments INT,
+                total_bathroom_visits INT,
+                total_stage_visits INT,
+                gender VARCHAR(10),
+                entered_at TIME,
+                exited_at TIME
+            );
+            """)
+            self.conn.commit()
+
+    def create_orders_table(self):
+        with self.lock:
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS orders (
+                order_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                attendee_id VARCHAR(10),
+                menu_item_name VARCHAR(50),
+                price DECIMAL(5,2),
+                contains_alcohol BOOLEAN,
+                status VARCHAR(20),
+                FOREIGN KEY (attendee_id) REFERENCES attendees(id)
+            );
+            """)
+            self.conn.commit()
+
+    def clear_orders_table(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM orders;")
+            self.conn.execute("DELETE FROM sqlite_sequence WHERE name = 'orders';") # start from 1 again
+            self.conn.commit()
+
+    def insert_attendees(self, attendees, chunk_size=None):
+        query = f"""
+        INSERT INTO attendees ({', '.join(ATTENDEE_COLUMNS)})
+        VALUES ({', '.join(['?'] * len(ATTENDEE_COLUMNS))})
+        ON CONFLICT(id) DO UPDATE SET {', '.join(f'{column} = excluded.{column}' for column in ATTENDEE_COLUMNS[1:])};
+        """
+        self.write_chunks(query, [attendee_row(attendee) for attendee in attendees], chunk_size)
+
+    def insert_orders(self, orders, chunk_size=None):
+        query = f"""
+        INSERT INTO orders ({', '.join(ORDER_COLUMNS[1:])})
+        VALUES ({', '.join(['?'] * (len(ORDER_COLUMNS) - 1))});
+        """
+        self.write_chunks(query, [order_row(order) for order in orders], chunk_size)
+
+    def write_chunks(self, query, rows, chunk_size=None):
+        chunk_size = chunk_size or self.chunk_size
+        for i in range(0, len(rows), chunk_size):
+            with self.lock:
+                with self.conn: # one transaction per chunk
+                    self.conn.executemany(query, rows[i:i + chunk_size])
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+# Columnar files: append-only, one file per table
+
+class ColumnarFileStorage(FestivalStorage):
+    """Orders are appended as they arrive. Attendees are upserted many times during a run, so only
+    their latest values are kept and the attendees file is written once, on close."""
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.attendees = {}
+        self.next_order_id = 1
+
+    def create_attendees_table(self):
+        pass # the file is created on close
+
+    def create_orders_table(self):
+        pass # the file is created by clear_orders_table or the first append
+
+    def clear_orders_table(self):
+        with self.lock:
+            self.next_order_id = 1
+            self.truncate_orders()
+
+    def insert_attendees(self, attendees, chunk_size=None):
+        with self.lock:
+            for attendee in attendees:
+                self.attendees[attendee.id] = attendee_row(attendee)
+
+    def insert_orders(self, orders, chunk_size=None):
+        with self.lock:
+            rows = []
+            for order in orders:
+                rows.append((self.next_order_id,) + order_row(order))
+                self.next_order_id += 1
+            self.append_orders(rows)
+
+    def close(self):
+        with self.lock:
+            self.write_attendees(list(self.attendees.values()))
+            self.close_files()
+
+    # file format specific:
+
+    def truncate_orders(self):
+        raise NotImplementedError
+
+    def append_orders(self, rows):
+        raise NotImplementedError
+
+    def write_attendees(self, rows):
+        raise NotImplementedError
+
+    def close_files(self):
+        pass
+
+
+class CSVStorage(ColumnarFileStorage):
+    """attendees.csv and orders.csv in the same layout as attendees_seed_0.csv and orders_seed_0.csv."""
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.orders_path = os.path.join(directory, 'orders.csv')
+        self.attendees_path = os.path.join(directory, 'attendees.csv')
+
+    def truncate_orders(self):
+        with open(self.orders_path, 'w', newline='') as file:
+            csv.writer(file).writerow(ORDER_COLUMNS)
+
+    def append_orders(self, rows):
+        if not os.path.exists(self.orders_path):
+            self.truncate_orders()
+        with open(self.orders_path, 'a', newline='') as file:
+            writer = csv.writer(file)
+            for order_id, attendee_id, name, price, contains_alcohol, status in rows:
+                writer.writerow([order_id, attendee_id, name, f'{price:.2f}', int(contains_alcohol), status])
+
+    def write_attendees(self, rows):
+        with open(self.attendees_path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(ATTENDEE_COLUMNS)
+            for row in rows:
+                writer.writerow(['NULL' if value is None else value for value in row])
+
+
+class ParquetStorage(ColumnarFileStorage):
+    """attendees.parquet and orders.parquet, every batch of orders is one row group (needs pyarrow)."""
+    ATTENDEE_SCHEMA = [('id', 'string'), ('age', 'int32'), ('ticket_type', 'string'), ('total_drinks', 'int32'),
+                       ('total_foods', 'int32'), ('total_treatments', 'int32'), ('total_bathroom_visits', 'int32'),
+                       ('total_stage_visits', 'int32'), ('gender', 'string'), ('entered_at', 'string'), ('exited_at', 'string')]
+    ORDER_SCHEMA = [('order_id', 'int64'), ('attendee_id', 'string'), ('menu_item_name', 'string'), ('price', 'float64'),
+                    ('contains_alcohol', 'bool_'), ('status', 'string')]
+
+    def __init__(self, directory):
+        if pyarrow is None:
+            raise ImportError("ParquetStorage needs pyarrow, install it or use CSVStorage")
+        super().__init__(directory)
+        self.orders_path = os.path.join(directory, 'orders.parquet')
+        self.attendees_path = os.path.join(directory, 'attendees.parquet')
+        self.orders_writer = None
+
+    @staticmethod
+    def schema(columns):
+        return pyarrow.schema([(name, getattr(pyarrow, kind)()) for name, kind in columns])
+
+    @staticmethod
+    def table(rows, schema):
+        columns = list(zip(*rows)) if rows else [[] for _ in schema.names]
+        return pyarrow.Table.from_arrays([pyarrow.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema)
+
+    def truncate_orders(self):
+        if self.orders_writer:
+            self.orders_writer.close()
+        self.orders_writer = pyarrow.parquet.ParquetWriter(self.orders_path, self.schema(self.ORDER_SCHEMA))
+
+    def append_orders(self, rows):
+        if self.orders_writer is None:
+            self.truncate_orders()
+        if rows:
+            schema = self.schema(self.ORDER_SCHEMA)
+            self.orders_writer.write_table(self.table(rows, schema))
+
+    def write_attendees(self, rows):
+        schema = self.schema(self.ATTENDEE_SCHEMA)
+        pyarrow.parquet.write_table(self.table(rows, schema), self.attendees_path)
+
+    def close_files(self):
+        if self.orders_writer is None:
+            self.truncate_orders() # an empty orders file still has the schema
+        self.orders_writer.close()
+        self.orders_writer = None
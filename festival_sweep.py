@@ -0,0 +1,96 @@
+import argparse
+import concurrent.futures
+import csv
+import itertools
+import os
+import sys
+
+from punta_cana_festival import DEFAULT_ARTISTS_INFO
+from festival_cache import ResultCache, run_cached
+
+# Parameter sweeps: every (configuration, seed) pair of a grid runs in its own process and the
+# summaries come back as one table, so capacity planning uses all the cores of the machine.
+
+BASE_PARAMETERS = dict(num_attendees=500, num_baristas=8, num_cooks=8, num_stalls=10, num_security=20, num_doctors=5, num_stages=3,
+                       num_bars=3, num_food_trucks=3) # same festival as the __main__ block of punta_cana_festival.py
+
+ENGINES = ['des', 'vectorized'] # the threaded simulation runs in real time, far too slow for sweeps
+
+
+def parameter_grid(grid, base=None):
+    """All combinations of a {parameter: [values]} grid, on top of the base parameters."""
+    names = list(grid)
+    configurations = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        parameters = dict(base or BASE_PARAMETERS)
+        parameters.update(zip(names, values))
+        configurations.append(parameters)
+    return configurations
+
+
+def run_configuration(engine, parameters, seed, artists_info=None, cache_directory=None):
+    """Run one simulation, top level so it can be sent to a worker process. With a cache directory,
+    configurations that already ran with the same seed are read back instead of simulated."""
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine '{engine}', choose one of {ENGINES}")
+    cache = ResultCache(cache_directory) if cache_directory else None
+    run = run_cached(cache, engine, parameters, seed, artists_info or DEFAULT_ARTISTS_INFO)
+    row = dict(parameters)
+    row['seed'] = seed
+    row.update(run.summary)
+    return row
+
+
+def run_sweep(grid, seeds=(0,), engine='des', workers=None, artists_info=None, base=None, cache_directory=None):
+    """Run every configuration of the grid with every seed on a process pool, one summary row per run."""
+    jobs = [(engine, parameters, seed, artists_info, cache_directory) for parameters in parameter_grid(grid, base) for seed in seeds]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = [executor.submit(run_configuration, *job) for job in jobs]
+        return [future.result() for future in futures] # same order as the grid
+
+
+def write_table(rows, file):
+    columns = list(rows[0]) if rows else []
+    writer = csv.DictWriter(file, fieldnames=columns, extrasaction='ignore')
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def parse_values(text):
+    """'4,8,12' -> [4, 8, 12] and '0-9' -> [0, 1, ..., 9]."""
+    values = []
+    for part in text.split(','):
+        if '-' in part.strip()[1:]:
+            low, high = part.split('-', 1)
+            values += list(range(int(low), int(high) + 1))
+        else:
+            values.append(int(part))
+    return values
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Run a grid of festival configurations on all cores.")
+    parser.add_argument('--set', action='append', default=[], metavar='PARAMETER=VALUES',
+                        help="sweep a FestivalSimulation parameter, e.g. --set num_baristas=4,8,12 (repeatable)")
+    parser.add_argument('--seeds', default='0', help="seeds for every configuration, e.g. 0-9 or 1,2,3")
+    parser.add_argument('--engine', default='des', choices=ENGINES)
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument('--output', default=None, help="csv file for the results table (default: stdout)")
+    parser.add_argument('--cache', default=None, metavar='DIRECTORY', help="reuse the results of runs already in this cache directory")
+    args = parser.parse_args()
+
+    grid = {}
+    for assignment in args.set:
+        name, values = assignment.split('=', 1)
+        if name not in BASE_PARAMETERS:
+            parser.error(f"unknown parameter '{name}', choose one of {', '.join(BASE_PARAMETERS)}")
+        grid[name] = parse_values(values)
+
+    rows = run_sweep(grid, seeds=parse_values(args.seeds), engine=args.engine, workers=args.workers, cache_directory=args.cache)
+    if args.output:
+        with open(args.output, 'w', newline='') as file:
+            write_table(rows, file)
+        print(f"{len(rows)} runs written to {args.output}")
+    else:
+        write_table(rows, sys.stdout)
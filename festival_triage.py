@@ -0,0 +1,41 @@
+import sys
+
+from punta_cana_festival import Triage, TRIAGE_CLASSES, DEFAULT_ARTISTS_INFO
+from festival_des import DiscreteEventFestival
+
+# Triage report: the same festivals (same seeds) on the discrete-event engine with a FIFO emergency truck
+# and with triage, for a few numbers of doctors. Both classify the patients and give the same treatment
+# times, so the difference is only the order in which the doctors take them. The tail (p95, max) of the
+# time to treatment of the critical patients is what the doctors should be sized for.
+
+METRICS = [f'{severity}_{metric}' for severity in TRIAGE_CLASSES for metric in ['wait', 'p95_wait', 'max_wait']]
+
+POLICIES = {
+    'fifo': Triage(priority=False),
+    'triage': Triage(),
+}
+
+
+def compare_triage(seeds=range(5), policies=POLICIES, doctors=(1, 2, 3), **parameters):
+    """Mean of the per-class times to treatment per policy and number of doctors over the seeds,
+    as {(name, doctors): {metric: value}}."""
+    results = {}
+    for num_doctors in doctors:
+        for name, triage in policies.items():
+            runs = [DiscreteEventFestival(seed=seed, triage=triage, num_doctors=num_doctors, **parameters).start() for seed in seeds]
+            results[name, num_doctors] = {metric: round(sum(run[metric] for run in runs) / len(runs), 3)
+                                          for metric in ['emergency_wait'] + METRICS}
+    return results
+
+
+if __name__ == '__main__':
+
+    # a crowd that drinks through the afternoon, so the emergency truck gets busy
+    parameters = dict(num_attendees=1000, num_baristas=2, num_cooks=2, num_stalls=10, num_security=20, num_stages=3,
+                      artists_info=DEFAULT_ARTISTS_INFO, num_bars=4, num_food_trucks=4)
+    if len(sys.argv) > 1:
+        parameters['num_attendees'] = int(sys.argv[1])
+    results = compare_triage(**parameters)
+    print(f"{'policy':<10}{'doctors':>8}{'all':>10}" + ''.join(f"{metric:>20}" for metric in METRICS))
+    for (name, num_doctors), values in results.items():
+        print(f"{name:<10}{num_doctors:>8}{values['emergency_wait']:>10}" + ''.join(f"{values[metric]:>20}" for metric in METRICS))
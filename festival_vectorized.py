@@ -0,0 +1,288 @@
+import sys
+import time
+
+import numpy as np
+
+from punta_cana_festival import Menu_Bar, Menu_FoodTruck, Lineup, ACTIVITIES, TICKET_TYPES, DEFAULT_ARTISTS_INFO
+
+# Vectorized Monte Carlo version of the festival: the crowd lives in NumPy arrays (one entry per
+# attendee) and every decision of Attendee.activity_loop is drawn for all the attendees that are
+# due at once. Meant for million-attendee what-if runs; per-order details are not kept, the bars
+# and food trucks are modelled as fluid queues that drain servers * dt seconds of work per tick.
+#
+# What an attendee does never depends on the queues, so the attendees are stepped a window of
+# WINDOW ticks at a time: everyone inside takes all their steps due before the window ends, the
+# orders go to the tick they were placed in, and only the fluid stations go tick by tick.
+
+WINDOW = 64 # ticks
+
+TICKETS = [ticket.type for ticket in TICKET_TYPES]
+
+# phases of the activity loop
+DECIDE = 0 # leave check and activity choice, then the 0.5-1.5s pause
+ACT = 1 # the activity itself, then the 2-5s pause
+
+
+# Probability models, vectorized copies of Attendee.leave_probability/bathroom_probability/emergency_probability:
+
+def leave_probability(total_treatments, total_drinks, time_spent):
+    return 0.0001 + 0.005 * total_treatments + 0.002 * total_drinks + 0.001 * time_spent
+
+def bathroom_probability(total_drinks, total_bathroom_visits):
+    return np.minimum(0.1 + 0.1 * total_drinks - 0.05 * total_bathroom_visits, 1.0)
+
+def emergency_probability(total_drinks, total_treatments):
+    return np.minimum(0.001 + 0.05 * total_drinks - 0.05 * total_treatments, 1.0)
+
+
+class FluidStations:
+    """A group of identical stations (all the bars, or all the food trucks) with per-item backlogs."""
+    def __init__(self, count, servers, menu):
+        self.prices = np.array([item.price for item in menu.items])
+        self.prep_times = np.array([item.prep_time for item in menu.items])
+        self.servers = servers
+        self.pending = np.zeros((2, count, len(menu.items))) # [paid/free, station, item]
+        self.completed = np.zeros((2, len(menu.items)))
+        self.incoming = np.zeros((0,) + self.pending.shape) # orders of the current window, per tick
+
+    def open_window(self, ticks):
+        self.incoming = np.zeros((ticks,) + self.pending.shape)
+
+    def add(self, tick, station, item, free):
+        """Orders placed in a tick of the window, they join the queues when serve_window gets there."""
+        np.add.at(self.incoming, (tick, free.astype(np.intp), station, item), 1)
+
+    def serve(self, dt):
+        work = self.pending.sum(axis=0) @ self.prep_times # seconds of work waiting per station
+        capacity = self.servers * dt
+        fraction = capacity / np.maximum(work, capacity) # 1 where everything can be served
+        served = self.pending * fraction[None, :, None]
+        self.pending -= served
+        self.completed += served.sum(axis=1)
+
+    def serve_window(self, dt, ticks):
+        """The first ticks ticks of the window: each one's orders join the queues, then dt seconds of service."""
+        for tick in range(ticks):
+            self.pending += self.incoming[tick]
+            self.serve(dt)
+
+    def queue_length(self):
+        return self.pending.sum(axis=(0, 2))
+
+
+class VectorizedFestival:
+    def __init__(self, num_attendees, num_baristas, num_cooks, num_stalls, num_security, num_doctors, num_stages, artists_info, num_bars, num_food_trucks, seed=None, dt=0.5):
+        self.rng = np.random.default_rng(seed)
+        self.dt = dt # tick length in simulated seconds, only affects the fluid stations
+        n = num_attendees
+        rng = self.rng
+
+        # struct of arrays, same fields as Attendee
+        self.age = rng.integers(18, 41, n, dtype=np.int8)
+        self.ticket = rng.integers(0, len(TICKETS), n, dtype=np.int8)
+        self.is_male = rng.random(n) < 0.5
+        self.has_free_ticket = rng.random(n) < 0.5
+        self.total_drinks = np.zeros(n, dtype=np.int32)
+        self.total_foods = np.zeros(n, dtype=np.int32)
+        self.total_treatments = np.zeros(n, dtype=np.int32)
+        self.total_bathroom_visits = np.zeros(n, dtype=np.int32)
+        self.total_stage_visits = np.zeros(n, dtype=np.int32)
+        self.is_inside = np.zeros(n, dtype=bool)
+        self.entered_at = np.full(n, np.nan)
+        self.exited_at = np.full(n, np.nan)
+        self.next_time = np.zeros(n) # when the attendee's next step is due
+        self.phase = np.zeros(n, dtype=np.int8)
+        self.activity = np.zeros(n, dtype=np.int8)
+        self.bar = rng.integers(0, num_bars, n, dtype=np.int16)
+        self.food_truck = rng.integers(0, num_food_trucks, n, dtype=np.int16)
+
+        self.num_security = num_security
+        self.bars = FluidStations(num_bars, num_baristas, Menu_Bar())
+        self.food_trucks = FluidStations(num_food_trucks, num_cooks, Menu_FoodTruck())
+
+        # sets are back to back, so a stage has someone performing from the start of the show until its last set ends
+        lineup = Lineup(artists_info, num_stages)
+        self.stage_length = np.array([lineup.stage_end(stage_index) for stage_index in range(lineup.num_stages)], dtype=float)
+        self.show_started_at = 0.0
+        self.now = 0.0
+        self.ticks = 0
+        self.steps = 0
+        self.wall_time = 0.0
+
+    # entrance: FIFO queue served by num_security guards, each check takes U(0.2, 1)
+
+    def run_entrance(self):
+        n = len(self.ticket)
+        checks = self.rng.uniform(0.2, 1, n)
+        done = np.zeros(n)
+        servers = max(min(self.num_security, n), 1)
+        # with equal-ish check times the guards take attendees round robin, guard j gets j, j+k, j+2k...
+        for guard in range(servers):
+            done[guard::servers] = np.cumsum(checks[guard::servers])
+        admitted = self.ticket != TICKETS.index("No ticket")
+        self.is_inside[:] = admitted
+        self.entered_at[admitted] = done[admitted]
+        # everything opens with the gates, each attendee starts as soon as security lets them in
+        self.show_started_at = 0.0
+        self.next_time[admitted] = done[admitted]
+        self.now = 0.0
+        # the admitted attendees in the order they get in; start() moves them to self.active as they do
+        order = np.flatnonzero(admitted)
+        self.admissions = order[np.argsort(done[order], kind='stable')]
+        self.admission_times = done[self.admissions]
+        self.admitted_so_far = 0
+        self.active = np.empty(0, dtype=np.intp)
+
+    # one step of the activity loop for every attendee in idx
+
+    def decide(self, idx):
+        rng = self.rng
+        when = self.next_time[idx]
+        probability = leave_probability(self.total_treatments[idx], self.total_drinks[idx], when - self.entered_at[idx])
+        leaving = rng.random(len(idx)) < probability
+        gone = idx[leaving]
+        self.is_inside[gone] = False
+        self.exited_at[gone] = self.next_time[gone]
+
+        staying = idx[~leaving]
+        self.activity[staying] = rng.integers(0, len(ACTIVITIES), len(staying))
+        self.next_time[staying] += rng.uniform(0.5, 1.5, len(staying))
+        self.phase[staying] = ACT
+
+    def act(self, idx):
+        rng = self.rng
+        pause = rng.uniform(2, 5, len(idx))
+        activity = self.activity[idx]
+
+        drinking = idx[activity == ACTIVITIES.index('drinks')]
+        items = rng.integers(0, len(self.bars.prices), len(drinking))
+        self.bars.add(self.window_tick(drinking), self.bar[drinking], items, self.has_free_ticket[drinking])
+        self.total_drinks[drinking] += 1
+
+        eating = idx[activity == ACTIVITIES.index('food')]
+        items = rng.integers(0, len(self.food_trucks.prices), len(eating))
+        self.food_trucks.add(self.window_tick(eating), self.food_truck[eating], items, self.has_free_ticket[eating])
+        self.total_foods[eating] += 1
+
+        music = activity == ACTIVITIES.index('music')
+        watching = idx[music]
+        stage = rng.integers(0, len(self.stage_length), len(watching))
+        offset = self.next_time[watching] - self.show_started_at
+        self.total_stage_visits[watching] += (offset < self.stage_length[stage])
+        pause[music] += rng.uniform(5.0, 10.0, len(watching))
+
+        bathroom = idx[activity == ACTIVITIES.index('bathroom')]
+        going = rng.random(len(bathroom)) < bathroom_probability(self.total_drinks[bathroom], self.total_bathroom_visits[bathroom])
+        self.total_bathroom_visits[bathroom[going]] += 1
+
+        emergency = idx[activity == ACTIVITIES.index('emergency')]
+        going = rng.random(len(emergency)) < emergency_probability(self.total_drinks[emergency], self.total_treatments[emergency])
+        self.total_treatments[emergency[going]] += 1
+
+        self.next_time[idx] += pause
+        self.phase[idx] = DECIDE
+
+    def window_tick(self, idx):
+        """Tick of the window the current steps of idx fall in: tick k of the window ends at now + (k+1) * dt."""
+        return np.clip(np.ceil((self.next_time[idx] - self.now) / self.dt).astype(np.intp) - 1, 0, None)
+
+    def next_step_at(self, show_end):
+        """When anything happens next: an active attendee's step, the next admission, or the end of the show."""
+        upcoming = [self.next_time[self.active].min()] if len(self.active) else []
+        if self.admitted_so_far < len(self.admissions):
+            upcoming.append(self.admission_times[self.admitted_so_far])
+        if self.now < show_end:
+            upcoming.append(show_end)
+        return min(upcoming)
+
+    def start(self):
+        started = time.perf_counter()
+        self.run_entrance()
+        show_end = self.show_started_at + self.stage_length.max(initial=0)
+        # only the attendees inside are stepped, and stretches where nobody is due are skipped: with a long
+        # entrance most of a million attendees are still at the gates or already gone at any time
+        while len(self.active) or self.admitted_so_far < len(self.admissions) or self.now < show_end:
+            skipped = max(int((self.next_step_at(show_end) - self.now) / self.dt) - 1, 0)
+            if skipped:
+                # nobody is due in these ticks, the stations serve their backlog in one go
+                self.now += skipped * self.dt
+                self.ticks += skipped
+                self.bars.serve(skipped * self.dt)
+                self.food_trucks.serve(skipped * self.dt)
+            window_end = self.now + WINDOW * self.dt
+            admitted = np.searchsorted(self.admission_times, window_end, side='right')
+            if admitted > self.admitted_so_far:
+                self.active = np.concatenate([self.active, self.admissions[self.admitted_so_far:admitted]])
+                self.admitted_so_far = admitted
+            self.bars.open_window(WINDOW)
+            self.food_trucks.open_window(WINDOW)
+            # every step due before the window ends, a pass at a time (a pass is one step for each due attendee)
+            last_exit = -np.inf
+            while True:
+                inside = self.active[self.is_inside[self.active]]
+                due = np.sort(inside[self.next_time[inside] <= window_end]) # in index order, like a full scan
+                if len(due) == 0:
+                    break
+                self.steps += len(due)
+                deciding = self.phase[due] == DECIDE
+                self.decide(due[deciding])
+                self.act(due[~deciding])
+                gone = due[~self.is_inside[due]]
+                if len(gone):
+                    last_exit = max(last_exit, self.exited_at[gone].max())
+            self.active = self.active[self.is_inside[self.active]]
+            ticks = WINDOW
+            if not len(self.active) and self.admitted_so_far == len(self.admissions):
+                # the festival ends in this window: the tick of the last departure, or the end of the show
+                end = max(last_exit, show_end)
+                ticks = min(max(int(np.ceil((end - self.now) / self.dt - 1e-9)), 1), WINDOW)
+            self.bars.serve_window(self.dt, ticks)
+            self.food_trucks.serve_window(self.dt, ticks)
+            self.now += ticks * self.dt
+            self.ticks += ticks
+        self.wall_time = time.perf_counter() - started
+        return self.summary()
+
+    def summary(self):
+        completed = self.bars.completed.sum() + self.food_trucks.completed.sum()
+        revenue = (self.bars.completed[0] * self.bars.prices).sum() + (self.food_trucks.completed[0] * self.food_trucks.prices).sum()
+        return {
+            'attendees': len(self.ticket),
+            'admitted': int((~np.isnan(self.entered_at)).sum()),
+            'completed_orders': int(round(completed)),
+            'drinks': int(self.total_drinks.sum()),
+            'foods': int(self.total_foods.sum()),
+            'revenue': round(float(revenue), 2),
+            'treatments': int(self.total_treatments.sum()),
+            'bathroom_visits': int(self.total_bathroom_visits.sum()),
+            'stage_visits': int(self.total_stage_visits.sum()),
+            'simulated_seconds': round(float(np.nanmax(self.exited_at, initial=self.now)), 2),
+            'events': self.steps,
+            'wall_seconds': round(self.wall_time, 3),
+        }
+
+
+def compare_with_object_model(seeds=range(5), **parameters):
+    """Mean summary of the vectorized and the discrete-event (object) model over the same seeds."""
+    from festival_des import DiscreteEventFestival
+    results = {}
+    for name, model in [('object', DiscreteEventFestival), ('vectorized', VectorizedFestival)]:
+        runs = [model(seed=seed, **parameters).start() for seed in seeds]
+        results[name] = {key: round(float(np.mean([run[key] for run in runs])), 2) for key in runs[0]}
+    return results
+
+
+if __name__ == '__main__':
+
+    parameters = dict(num_attendees=500, num_baristas=8, num_cooks=8, num_stalls=10, num_security=20, num_doctors=5, num_stages=3,
+                      artists_info=DEFAULT_ARTISTS_INFO, num_bars=3, num_food_trucks=3)
+    if len(sys.argv) > 1:
+        # python festival_vectorized.py 1000000 -> one big run
+        parameters['num_attendees'] = int(sys.argv[1])
+        for key, value in VectorizedFestival(seed=0, **parameters).start().items():
+            print(f"{key}: {value}")
+    else:
+        results = compare_with_object_model(**parameters)
+        print(f"{'metric':<20}{'object':>12}{'vectorized':>12}")
+        for key in results['vectorized']:
+            print(f"{key:<20}{results['object'][key]:>12}{results['vectorized'][key]:>12}")
@@ -0,0 +1,259 @@
+import argparse
+import ipaddress
+import multiprocessing
+import os
+import secrets
+import time
+from multiprocessing.connection import Listener, Client
+
+from punta_cana_festival import DEFAULT_ARTISTS_INFO, FestivalAnalytics, TRIAGE_CLASSES, create_attendees
+from festival_des import DiscreteEventFestival
+from festival_sweep import BASE_PARAMETERS
+
+# Zones: a discrete-event festival split into areas, each with its own gates, bars, food trucks,
+# bathroom, doctors and some of the stages, and each simulated by its own worker process. Attendees
+# who want to see a stage of another zone walk there; they travel as messages through a coordinator.
+#
+# Zones stay in sync with conservative time windows: walking between zones takes at least
+# TRAVEL_TIME[0] seconds, so an attendee leaving during a window of that length cannot arrive
+# anywhere before the window ends. Every zone plays a whole window on its own, then the coordinator
+# hands out the attendees who left, and all zones start the next window. The result does not depend
+# on the timing of the processes.
+#
+# Workers talk to the coordinator over multiprocessing.connection (TCP with an authentication key),
+# so they can run on other machines. The messages are pickles, so whoever has the key can run code in
+# the coordinator: on a loopback address a random key is made for the run, on any other address the
+# key has to be given, in $FESTIVAL_AUTHKEY or with --authkey:
+#
+#   python festival_zones.py --zones 4 --attendees 100000                          all zones on this machine
+#   export FESTIVAL_AUTHKEY=$(python -c "import secrets; print(secrets.token_hex(16))")
+#   python festival_zones.py --zones 8 --listen 0.0.0.0:6000 --local-workers 4     and on another machine,
+#   python festival_zones.py --connect HOST:6000                                   with the same key (four times)
+
+TRAVEL_TIME = (20.0, 40.0) # seconds to walk to another zone, the shortest walk is the lookahead of the windows
+
+
+def share(total, zones, zone):
+    """A zone's part of total stations or staff, at least one."""
+    return max(total // zones + (zone < total % zones), 1)
+
+
+class ZoneFestival(DiscreteEventFestival):
+    """One zone: every zones-th attendee (whose gates are here), stage i if i % zones == zone, and a share
+    of the bars, food trucks, bathroom stalls, guards and doctors. Baristas and cooks are per bar and truck."""
+    def __init__(self, zone, zones, num_attendees, num_baristas, num_cooks, num_stalls, num_security, num_doctors, num_stages,
+                 artists_info, num_bars, num_food_trucks, seed=None, **options):
+        self.zone = zone
+        self.zones = zones
+        super().__init__(0, num_baristas, num_cooks, share(num_stalls, zones, zone), share(num_security, zones, zone),
+                         share(num_doctors, zones, zone), num_stages, artists_info, share(num_bars, zones, zone),
+                         share(num_food_trucks, zones, zone), seed=seed, **options)
+        self.attendees = create_attendees(num_attendees, self.streams, select=range(zone, num_attendees, zones))
+        self.rng = self.streams.stream(f'Zone {zone+1}/festival')
+        for router in (self.bar_router, self.truck_router):
+            if router:
+                router.rng = self.rng
+        for station in self.entrance + self.stations():
+            station.name = station.metrics.name = f'Zone {zone+1} {station.name}'
+        self.outbox = [] # (zone, arrival time, attendee, stage index) of the attendees who left for another zone
+        self.migrations = 0
+
+    def station_stream(self, name):
+        # the stations of every zone draw from their own streams, the attendees' streams travel with them
+        return self.streams.stream(f'Zone {self.zone+1}/{name}')
+
+    def watch_stage(self, attendee, stage_index, bar, food_truck):
+        destination = stage_index % self.zones
+        if destination == self.zone:
+            super().watch_stage(attendee, stage_index, bar, food_truck)
+            return
+        self.inside -= 1
+        self.migrations += 1
+        self.outbox.append((destination, self.events.now + attendee.rng.uniform(*TRAVEL_TIME), attendee, stage_index))
+
+    def receive(self, arrival, attendee, stage_index):
+        self.inside += 1 # counted from now on: a walk can last longer than the next window
+        self.events.schedule(arrival - self.events.now, self.arrive_from_zone, attendee, stage_index)
+
+    def arrive_from_zone(self, attendee, stage_index):
+        bar = self.bar_router or self.rng.choice(self.bars)
+        food_truck = self.truck_router or self.rng.choice(self.food_trucks)
+        super().watch_stage(attendee, stage_index, bar, food_truck)
+
+    def check_festival_over(self):
+        pass # only the coordinator knows whether anybody is still inside or on the way, see finish
+
+    def take_outbox(self):
+        outbox, self.outbox = self.outbox, []
+        return outbox
+
+    def status(self):
+        return {'show_over': self.show_over, 'checked': self.checked == len(self.attendees), 'inside': self.inside}
+
+    def finish(self):
+        self.festival_running = False
+        for station in self.stations():
+            station.close()
+
+
+def zone_worker(address, authkey):
+    """Worker process: gets its zone from the coordinator, then plays it one window at a time."""
+    with Client(address, authkey=authkey) as connection:
+        _, zone, zones, parameters, seed, window = connection.recv()
+        festival = ZoneFestival(zone, zones, seed=seed, **parameters)
+        festival.begin()
+        until = 0.0
+        while True:
+            until += window
+            festival.run(until)
+            connection.send(('window', festival.take_outbox(), festival.status()))
+            command, inbox = connection.recv()
+            for arrival, attendee, stage_index in inbox:
+                festival.receive(arrival, attendee, stage_index)
+            if command == 'finish':
+                break
+        festival.finish()
+        connection.send(('result', festival.summary(), festival.analytics, festival.station_metrics(), festival.migrations))
+
+
+def mean_wait(station_metrics, kind, category=None):
+    """Mean wait over the stations whose name contains kind, e.g. ' Bar ', of the items of a category if given."""
+    waits = [metrics['wait'] if category is None else metrics.get('wait_by_class', {}).get(category, {'count': 0, 'mean': 0.0})
+             for name, metrics in station_metrics.items() if kind in name]
+    served = sum(wait['count'] for wait in waits)
+    return sum(wait['mean'] * wait['count'] for wait in waits) / served if served else 0.0
+
+
+def merge_results(results, windows, wall_time):
+    analytics = FestivalAnalytics()
+    station_metrics = {}
+    for _, zone_analytics, zone_metrics, _ in results:
+        analytics.merge(zone_analytics)
+        station_metrics.update(zone_metrics)
+    summary = {
+        'zones': len(results),
+        'attendees': analytics.attendees,
+        'admitted': analytics.admitted,
+        'completed_orders': analytics.orders,
+        'drinks': analytics.activities['total_drinks'],
+        'foods': analytics.activities['total_foods'],
+        'revenue': round(analytics.revenue, 2),
+        'treatments': analytics.activities['total_treatments'],
+        'bathroom_visits': analytics.activities['total_bathroom_visits'],
+        'stage_visits': analytics.activities['total_stage_visits'],
+        'migrations': sum(migrations for *_, migrations in results),
+        'bar_wait': round(mean_wait(station_metrics, ' Bar '), 3),
+        'food_wait': round(mean_wait(station_metrics, ' Food Truck '), 3),
+        'bathroom_wait': round(mean_wait(station_metrics, ' Bathroom'), 3),
+        'emergency_wait': round(mean_wait(station_metrics, ' Emergency Truck'), 3),
+        'entrance_wait': round(mean_wait(station_metrics, ' Entrance'), 3),
+        'simulated_seconds': max(summary['simulated_seconds'] for summary, *_ in results),
+        'events': sum(summary['events'] for summary, *_ in results),
+        'windows': windows,
+        'wall_seconds': round(wall_time, 3),
+    }
+    if any('wait_by_class' in metrics for name, metrics in station_metrics.items() if ' Emergency Truck' in name): # with triage
+        for severity in TRIAGE_CLASSES:
+            summary[f'{severity}_wait'] = round(mean_wait(station_metrics, ' Emergency Truck', severity), 3)
+    return summary, analytics, station_metrics
+
+
+def is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False # a host name or '' (every interface)
+
+
+def run_zones(parameters, zones=2, seed=0, window=TRAVEL_TIME[0], address=('127.0.0.1', 0), authkey=None, local_workers=None):
+    """Coordinate a festival split into zones. local_workers zone processes are started here (all of them by
+    default), the others have to connect from elsewhere (zone_worker). Returns (summary, analytics, station metrics).
+    Without an authkey a random one is used, which is only allowed on a loopback address."""
+    if not 0 < window <= TRAVEL_TIME[0]:
+        raise ValueError(f"The window can be at most the shortest walk between zones ({TRAVEL_TIME[0]} s), not {window}")
+    if authkey is None:
+        if not is_loopback(address[0]):
+            raise ValueError(f"Listening on '{address[0]}' needs an authkey shared with the workers, not a default one")
+        authkey = secrets.token_hex(16).encode()
+    started = time.perf_counter()
+    processes = []
+    with Listener(address, authkey=authkey) as listener:
+        try:
+            context = multiprocessing.get_context('spawn')
+            for _ in range(zones if local_workers is None else local_workers):
+                process = context.Process(target=zone_worker, args=(listener.address, authkey))
+                process.start()
+                processes.append(process)
+            connections = [listener.accept() for _ in range(zones)]
+            for zone, connection in enumerate(connections):
+                connection.send(('setup', zone, zones, parameters, seed, window))
+
+            windows = 0
+            while True:
+                windows += 1
+                reports = [connection.recv() for connection in connections] # the barrier: every zone is at the window end
+                inboxes = [[] for _ in range(zones)]
+                for _, outbox, _ in reports:
+                    for destination, arrival, attendee, stage_index in outbox:
+                        inboxes[destination].append((arrival, attendee, stage_index))
+                in_flight = sum(len(inbox) for inbox in inboxes)
+                done = in_flight == 0 and all(status['show_over'] and status['checked'] and status['inside'] == 0
+                                              for _, _, status in reports)
+                for connection, inbox in zip(connections, inboxes):
+                    inbox.sort(key=lambda message: (message[0], message[1].id)) # same order whichever zone reported first
+                    connection.send(('finish' if done else 'continue', inbox))
+                if done:
+                    break
+            results = [connection.recv()[1:] for connection in connections]
+            for connection in connections:
+                connection.close()
+        finally:
+            for process in processes:
+                process.join(timeout=60)
+                if process.is_alive():
+                    process.terminate()
+    return merge_results(results, windows, time.perf_counter() - started)
+
+
+def parse_address(text):
+    host, port = text.rsplit(':', 1)
+    return host, int(port)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Run a festival split into zones, one worker process per zone.")
+    parser.add_argument('--zones', type=int, default=os.cpu_count(), help="number of zones (default: one per core)")
+    parser.add_argument('--attendees', type=int, default=BASE_PARAMETERS['num_attendees'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--listen', default='127.0.0.1:0', metavar='HOST:PORT', help="address the coordinator listens on")
+    parser.add_argument('--local-workers', type=int, default=None, help="zone workers started here (default: all of them)")
+    parser.add_argument('--connect', default=None, metavar='HOST:PORT', help="run one zone worker for the coordinator at that address")
+    parser.add_argument('--authkey', default=os.environ.get('FESTIVAL_AUTHKEY'),
+                        help="shared key of the coordinator and the workers (default: $FESTIVAL_AUTHKEY, "
+                             "required unless everything runs on a loopback address)")
+    args = parser.parse_args()
+
+    if args.connect:
+        if args.authkey is None:
+            parser.error("--connect needs the coordinator's key, in $FESTIVAL_AUTHKEY or with --authkey")
+        zone_worker(parse_address(args.connect), args.authkey.encode())
+    else:
+        address = parse_address(args.listen)
+        if args.authkey is None:
+            if not is_loopback(address[0]):
+                parser.error(f"listening on {args.listen} needs a key, set $FESTIVAL_AUTHKEY or pass --authkey")
+            if args.local_workers is not None and args.local_workers < args.zones:
+                args.authkey = secrets.token_hex(16) # the workers started elsewhere on this machine need it
+                print(f"authkey for the other workers: {args.authkey}")
+        # the staff grows with the crowd, like the benchmark scenarios
+        scale = max(args.attendees // BASE_PARAMETERS['num_attendees'], 1)
+        parameters = dict(BASE_PARAMETERS, num_attendees=args.attendees, artists_info=DEFAULT_ARTISTS_INFO)
+        for name in ['num_baristas', 'num_cooks', 'num_stalls', 'num_security', 'num_doctors']:
+            parameters[name] = BASE_PARAMETERS[name] * scale
+        summary, _, _ = run_zones(parameters, args.zones, args.seed, address=address,
+                                  authkey=args.authkey.encode() if args.authkey else None, local_workers=args.local_workers)
+        for key, value in summary.items():
+            print(f"{key}: {value}")
@@ -4,24 +4,604 @@ import random
 import concurrent.futures
 import traceback
 import datetime
-import mysql.connector
+import queue
+import math
+import json
+import heapq
+import hashlib
+import bisect
+import itertools
+from collections import deque, namedtuple
+
+from festival_log import event_log, ConsoleSink, JSONLSink, DEBUG, MILESTONE, ERROR
+
+try:
+    import mysql.connector
+    import mysql.connector.pooling
+except ImportError:
+    mysql = None # only needed by FestivalDatabase, the other storage backends work without it
+
+# Random streams:
+
+class RandomStreams:
+    """One independent random.Random per actor, all derived from a master seed. An actor's draws do not
+    depend on how the threads interleave or on how many other actors there are, so a seeded run can be repeated."""
+    def __init__(self, seed=None):
+        self.seed = seed if seed is not None else random.randrange(2**63)
+
+    def stream(self, name, compact=False):
+        """random.Random for the actor called name; compact=True gives a CompactRandom (for the attendees, there are many)."""
+        digest = hashlib.sha256(f"{self.seed}/{name}".encode()).digest()
+        seed = int.from_bytes(digest[:8], 'big')
+        return CompactRandom(seed) if compact else random.Random(seed)
+
+
+class CompactRandom:
+    """SplitMix64 stream with the few random.Random methods the attendees use. Its state is one 64-bit
+    integer instead of the 2.5 kB Mersenne Twister state, which matters with a stream per attendee."""
+    __slots__ = ('state',)
+    MASK = (1 << 64) - 1
+
+    def __init__(self, seed):
+        self.state = seed & self.MASK
+
+    def next64(self):
+        self.state = z = (self.state + 0x9E3779B97F4A7C15) & self.MASK
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & self.MASK
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & self.MASK
+        return z ^ (z >> 31)
+
+    def random(self):
+        return (self.next64() >> 11) * (1.0 / (1 << 53)) # 53 random bits, like random.random
+
+    def uniform(self, a, b):
+        return a + (b - a) * self.random()
+
+    def randint(self, a, b):
+        return a + int(self.random() * (b - a + 1))
+
+    def choice(self, seq):
+        return seq[int(self.random() * len(seq))]
+
+    def choices(self, population, weights=None, k=1):
+        if weights is None:
+            return [self.choice(population) for _ in range(k)]
+        cumulative = list(itertools.accumulate(weights))
+        return [population[bisect.bisect(cumulative, self.random() * cumulative[-1])] for _ in range(k)]
+
+# Clock:
+
+class FestivalClock:
+    """Festival time for the threaded simulation. Every actor sleeps and reads the time through it, so with
+    time_scale=10 a 60 second set takes 6 real seconds, while every recorded time stays in festival time.
+    The clock is shared by the whole process: a simulation claims it with use() while it runs, and two
+    simulations can only run at the same time if they use the same scale."""
+    def __init__(self, time_scale=1.0):
+        self.lock = threading.Lock()
+        self.users = 0 # simulations running on this clock
+        self.set_time_scale(time_scale)
+
+    def use(self, time_scale):
+        """Claim the clock for a simulation about to run at time_scale, until release()."""
+        with self.lock:
+            if self.users and time_scale != self.time_scale:
+                raise RuntimeError(f"festival_clock runs at time_scale={self.time_scale} for another simulation, "
+                                   f"it cannot run one at {time_scale} at the same time")
+            if not self.users:
+                self.set_time_scale(time_scale)
+            self.users += 1
+
+    def release(self):
+        with self.lock:
+            self.users -= 1
+
+    def set_time_scale(self, time_scale):
+        if time_scale <= 0:
+            raise ValueError(f"time_scale has to be positive, not {time_scale}")
+        now = time.time()
+        self.origin = self.time() if hasattr(self, 'origin') else now # festival time does not jump when the scale changes
+        self.origin_real = now
+        self.time_scale = time_scale
+
+    def time(self):
+        """Festival time as a time.time()-like timestamp."""
+        return self.origin + (time.time() - self.origin_real) * self.time_scale
+
+    def real_seconds(self, seconds):
+        """Real seconds that seconds of festival time take, e.g. for asyncio.sleep."""
+        return seconds / self.time_scale
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(self.real_seconds(seconds))
+
+    def time_of_day(self):
+        return datetime.datetime.fromtimestamp(self.time()).time()
+
+
+festival_clock = FestivalClock() # shared by all the actors of the threaded simulation
+
+# Instrumentation:
+
+class Histogram:
+    """Log-bucketed histogram of durations: bounded memory, percentiles accurate to a few percent."""
+    def __init__(self, smallest=0.001, growth=1.05):
+        self.smallest = smallest # everything below goes in bucket 0
+        self.growth = growth # bucket i holds values up to smallest * growth**i
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        bucket = 0 if value <= self.smallest else math.ceil(math.log(value / self.smallest, self.growth))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        """Add the values of another histogram with the same buckets."""
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.smallest * self.growth ** bucket, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count, 4) if self.count else 0.0,
+            'p50': round(self.percentile(50), 4),
+            'p95': round(self.percentile(95), 4),
+            'p99': round(self.percentile(99), 4),
+            'max': round(self.max, 4),
+        }
+
+class Counter:
+    """Counter for the hot paths, shared by many threads: `self.total += 1` alone is a read and a write that
+    two threads can interleave and lose an increment in, so the int is guarded by its own small lock."""
+    __slots__ = ('count', 'lock')
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def increment(self):
+        with self.lock:
+            self.count += 1
+
+    @property
+    def value(self):
+        return self.count # an int read is atomic, no lock needed
+
+class StationMetrics:
+    """Queue wait, service time, queue depth and worker busy time of one station (a bar, a bathroom, the entrance...)."""
+    def __init__(self, name, workers=0, clock=None, depth_interval=1.0):
+        self.name = name
+        self.workers = workers
+        self.clock = clock or festival_clock.time # festival time for the threaded run, the virtual clock for the discrete-event one
+        self.depth_interval = depth_interval # seconds between two queue depth samples
+        self.lock = threading.Lock()
+        self.started_at = self.clock()
+        self.stopped_at = None
+        self.wait = Histogram()
+        self.service = Histogram()
+        self.depth = [] # (seconds since start, queue length)
+        self.last_depth_at = None
+        self.max_depth = 0
+        self.busy = {} # worker name -> seconds spent serving
+        self.category_wait = {} # class of item (e.g. a triage severity) -> Histogram of its waits
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['lock'] # locks do not pickle, a checkpointed station gets a new one
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.started_at = self.clock() # utilization counts from when the station opens
+
+    def stop(self):
+        self.stopped_at = self.clock()
+
+    def record_depth(self, depth):
+        with self.lock:
+            now = self.clock() - self.started_at
+            self.max_depth = max(self.max_depth, depth)
+            if self.last_depth_at is None or now - self.last_depth_at >= self.depth_interval:
+                self.depth.append((round(now, 3), depth))
+                self.last_depth_at = now
+
+    def record_wait(self, seconds, category=None):
+        with self.lock:
+            self.wait.add(seconds)
+            if category is not None:
+                self.category_wait.setdefault(category, Histogram()).add(seconds)
+
+    def record_service(self, worker, seconds):
+        with self.lock:
+            self.service.add(seconds)
+            self.busy[worker] = self.busy.get(worker, 0.0) + seconds
+
+    def summary(self):
+        with self.lock:
+            elapsed = max((self.stopped_at or self.clock()) - self.started_at, 1e-9)
+            busy = sum(self.busy.values())
+            summary = {
+                'wait': self.wait.summary(),
+                'service': self.service.summary(),
+                'max_depth': self.max_depth,
+                'depth': list(self.depth),
+                'utilization': round(busy / (max(self.workers, 1) * elapsed), 4),
+                'worker_utilization': {worker: round(seconds / elapsed, 4) for worker, seconds in sorted(self.busy.items())},
+            }
+            if self.category_wait:
+                summary['wait_by_class'] = {category: histogram.summary() for category, histogram in self.category_wait.items()}
+            return summary
+
+class FestivalAnalytics:
+    """Running totals of a festival, fed one completed order and one departing attendee at a time, so the
+    figures of results_analysis.ipynb come out at the end of a run without reading the tables back.
+    Memory does not grow with the crowd: per menu item, per ticket type or age, and bounded histograms."""
+    ACTIVITY_TOTALS = ['total_drinks', 'total_foods', 'total_treatments', 'total_bathroom_visits', 'total_stage_visits']
+
+    def __init__(self, top=15):
+        self.lock = threading.Lock() # orders come in from every barista and cook thread
+        self.orders = 0
+        self.sales = 0.0 # list price of every order
+        self.revenue = 0.0 # what was paid, free ticket orders excluded
+        self.free_ticket_cost = 0.0
+        self.alcohol_orders = 0
+        self.alcohol_sales = 0.0
+        self.items = {} # menu item -> [orders, sales, revenue]
+        self.attendees = 0
+        self.admitted = 0
+        self.tickets = {}
+        self.genders = {}
+        self.ages = {}
+        self.activities = dict.fromkeys(self.ACTIVITY_TOTALS, 0)
+        self.drinks_per_attendee = {} # number of drinks -> attendees, admitted ones only
+        self.foods_per_attendee = {}
+        self.stay = Histogram(smallest=0.1) # seconds between admission and departure
+        self.top = top
+        self.most_active = [] # min-heap of (activities, id) of the most active attendees
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['lock'] # checkpoints of the discrete-event engine pickle it
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def add_order(self, order):
+        item = order.menu_item
+        with self.lock:
+            self.orders += 1
+            self.sales += item.price
+            totals = self.items.setdefault(item.name, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += item.price
+            if order.free_ticket:
+                self.free_ticket_cost += item.price
+            else:
+                self.revenue += item.price
+                totals[2] += item.price
+            if item.contains_alcohol:
+                self.alcohol_orders += 1
+                self.alcohol_sales += item.price
+
+    def add_attendee(self, attendee, stay=None):
+        """An attendee done with the festival: refused at the gates (stay None) or leaving after stay seconds."""
+        with self.lock:
+            self.attendees += 1
+            self.tickets[attendee.ticket.type] = self.tickets.get(attendee.ticket.type, 0) + 1
+            self.genders[attendee.gender] = self.genders.get(attendee.gender, 0) + 1
+            self.ages[attendee.age] = self.ages.get(attendee.age, 0) + 1
+            if stay is None:
+                return
+            self.admitted += 1
+            self.stay.add(stay)
+            active = 0
+            for name in self.ACTIVITY_TOTALS:
+                count = getattr(attendee, name)
+                self.activities[name] += count
+                active += count
+            self.drinks_per_attendee[attendee.total_drinks] = self.drinks_per_attendee.get(attendee.total_drinks, 0) + 1
+            self.foods_per_attendee[attendee.total_foods] = self.foods_per_attendee.get(attendee.total_foods, 0) + 1
+            if len(self.most_active) < self.top:
+                heapq.heappush(self.most_active, (active, attendee.id))
+            elif active > self.most_active[0][0]:
+                heapq.heapreplace(self.most_active, (active, attendee.id))
+
+    def merge(self, other):
+        """Add the totals of another part of the same festival (e.g. another zone of festival_zones.py)."""
+        with self.lock:
+            for name in ['orders', 'sales', 'revenue', 'free_ticket_cost', 'alcohol_orders', 'alcohol_sales', 'attendees', 'admitted']:
+                setattr(self, name, getattr(self, name) + getattr(other, name))
+            for name, (orders, sales, revenue) in other.items.items():
+                totals = self.items.setdefault(name, [0, 0.0, 0.0])
+                totals[0] += orders
+                totals[1] += sales
+                totals[2] += revenue
+            for counts, other_counts in [(self.tickets, other.tickets), (self.genders, other.genders), (self.ages, other.ages),
+                                         (self.activities, other.activities), (self.drinks_per_attendee, other.drinks_per_attendee),
+                                         (self.foods_per_attendee, other.foods_per_attendee)]:
+                for key, count in other_counts.items():
+                    counts[key] = counts.get(key, 0) + count
+            self.stay.merge(other.stay)
+            self.most_active = heapq.nlargest(self.top, self.most_active + other.most_active)
+            heapq.heapify(self.most_active)
+
+    def summary(self):
+        with self.lock:
+            ages = sum(age * count for age, count in self.ages.items())
+            return {
+                'orders': self.orders,
+                'sales': round(self.sales, 2),
+                'revenue': round(self.revenue, 2),
+                'free_ticket_cost': round(self.free_ticket_cost, 2),
+                'alcohol_share': round(self.alcohol_orders / self.orders, 4) if self.orders else 0.0,
+                'alcohol_sales_share': round(self.alcohol_sales / self.sales, 4) if self.sales else 0.0,
+                'items': {name: {'orders': orders, 'sales': round(sales, 2), 'revenue': round(revenue, 2)}
+                          for name, (orders, sales, revenue) in sorted(self.items.items(), key=lambda item: -item[1][0])},
+                'attendees': self.attendees,
+                'admitted': self.admitted,
+                'mean_age': round(ages / self.attendees, 2) if self.attendees else 0.0,
+                'ages': dict(sorted(self.ages.items())),
+                'tickets': dict(self.tickets),
+                'genders': dict(self.genders),
+                'activities': dict(self.activities),
+                'drinks_per_attendee': dict(sorted(self.drinks_per_attendee.items())),
+                'foods_per_attendee': dict(sorted(self.foods_per_attendee.items())),
+                'stay': self.stay.summary(),
+                'most_active': [attendee_id for _, attendee_id in sorted(self.most_active, reverse=True)],
+            }
+
+# Work queues:
+
+class WorkQueue:
+    """FIFO shared between threads: get() blocks while the queue is empty and returns None once it is closed.
+    Queues whose workers steal from each other share one condition (see share_condition)."""
+    def __init__(self, metrics=None, cost=None, category=None, condition=None):
+        self.items = deque() # O(1) append and popleft
+        self.condition = condition or threading.Condition()
+        self.closed = False
+        self.drain = True
+        self.metrics = metrics # optional StationMetrics, gets the wait of every item and the queue depth
+        self.cost = cost # optional item -> seconds of work, summed up in self.work for the routing
+        self.work = 0.0
+        self.category = category # optional item -> class name, the waits are also recorded per class
+
+    def put(self, item):
+        with self.condition:
+            self.push(item, self.metrics.clock() if self.metrics else festival_clock.time())
+            if self.cost:
+                self.work += self.cost(item)
+            if self.metrics:
+                self.metrics.record_depth(len(self.items))
+            self.condition.notify() # wake up one idle worker
+
+    def get(self, timeout=None):
+        """Next item, None once the queue is closed; raises queue.Empty if nothing came within the timeout."""
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.items or self.closed, timeout): # idle workers sleep here instead of spinning
+                raise queue.Empty
+            if self.items and (self.drain or not self.closed):
+                return self.pop()
+            return None
+
+    def get_nowait(self):
+        with self.condition:
+            if self.items and (self.drain or not self.closed):
+                return self.pop()
+            raise queue.Empty
+
+    def take_matching(self, predicate, limit):
+        """Up to limit queued items for which predicate(item) is true, oldest first, without waiting."""
+        taken = []
+        with self.condition:
+            if limit <= 0 or not self.items or (self.closed and not self.drain):
+                return taken
+            kept = deque()
+            for item, queued_at in self.items:
+                if len(taken) < limit and predicate(item):
+                    taken.append(self.account(item, queued_at))
+                else:
+                    kept.append((item, queued_at))
+            self.items = kept
+            if taken and self.metrics:
+                self.metrics.record_depth(len(self.items))
+        return taken
+
+    def push(self, item, queued_at):
+        # called with the condition held
+        self.items.append((item, queued_at))
+
+    def pop(self):
+        # called with the condition held
+        item = self.account(*self.items.popleft())
+        if self.metrics:
+            self.metrics.record_depth(len(self.items))
+        return item
+
+    def account(self, item, queued_at):
+        if self.cost:
+            self.work = max(self.work - self.cost(item), 0.0)
+        if self.metrics:
+            self.metrics.record_wait(self.metrics.clock() - queued_at, self.category(item) if self.category else None)
+        return item
+
+    def close(self, drain=True):
+        """Wake every worker up; with drain=False the remaining items are dropped."""
+        with self.condition:
+            self.closed = True
+            self.drain = drain
+            if not drain:
+                self.items.clear()
+                self.work = 0.0
+            self.condition.notify_all()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class DeadlineQueue(WorkQueue):
+    """WorkQueue served earliest deadline first instead of FIFO. deadline(item, queued_at) is fixed when the
+    item is put, so an item that has waited long enough goes ahead of more urgent ones put after it."""
+    def __init__(self, deadline, metrics=None, cost=None, category=None, condition=None):
+        super().__init__(metrics, cost, category, condition)
+        self.deadline = deadline
+        self.items = [] # heap of (deadline, sequence, item, queued_at)
+        self.sequence = 0 # tie breaker, keeps items with the same deadline in FIFO order
+
+    def push(self, item, queued_at):
+        self.sequence += 1
+        heapq.heappush(self.items, (self.deadline(item, queued_at), self.sequence, item, queued_at))
+
+    def pop(self):
+        _, _, item, queued_at = heapq.heappop(self.items)
+        item = self.account(item, queued_at)
+        if self.metrics:
+            self.metrics.record_depth(len(self.items))
+        return item
+
+    def take_matching(self, predicate, limit):
+        """Up to limit queued items for which predicate(item) is true, earliest deadline first, without waiting."""
+        taken = []
+        with self.condition:
+            if limit <= 0 or not self.items or (self.closed and not self.drain):
+                return taken
+            kept = []
+            for entry in sorted(self.items): # (deadline, sequence) are unique, the items are never compared
+                if len(taken) < limit and predicate(entry[2]):
+                    taken.append(self.account(entry[2], entry[3]))
+                else:
+                    kept.append(entry)
+            self.items = kept # a sorted list is a heap
+            if taken and self.metrics:
+                self.metrics.record_depth(len(self.items))
+        return taken
+
+
+def share_condition(queues):
+    """Give the queues one condition, so that get_or_steal can sleep until an item is put in any of them."""
+    condition = threading.Condition()
+    for work_queue in queues:
+        work_queue.condition = condition # before any worker waits on them
+
+
+def get_or_steal(orders, peers, interval=0.1):
+    """Next item of orders, or while it is empty the oldest item of the longest peer queue (work stealing
+    between the staff of different stations). None once orders is closed and every peer is empty, so a
+    worker whose own queue closed first keeps helping the others. Queues that share a condition wake an
+    idle worker as soon as anything is put in any of them; with separate conditions the peers are polled
+    every interval real seconds, which can leave work waiting that long."""
+    if not peers:
+        return orders.get()
+    if all(peer.condition is orders.condition for peer in peers):
+        with orders.condition: # a reentrant lock, get_nowait takes it again
+            while True:
+                try:
+                    return orders.get_nowait()
+                except queue.Empty:
+                    pass
+                item = steal(peers)
+                if item is not None or orders.closed:
+                    return item
+                orders.condition.wait() # every put() of the group notifies this condition
+    while True:
+        try:
+            item = orders.get(timeout=interval)
+        except queue.Empty:
+            item = None
+        if item is not None:
+            return item
+        item = steal(peers)
+        if item is not None or orders.closed:
+            return item
+
+def steal(peers):
+    """Oldest item of the longest peer queue that has one, None if they are all empty."""
+    for peer in sorted(peers, key=len, reverse=True):
+        try:
+            return peer.get_nowait()
+        except queue.Empty:
+            continue
+    return None
+
+# Routing:
+
+ROUTING_POLICIES = ['static', 'shortest_queue', 'power_of_two', 'least_work']
+
+class StationRouter:
+    """Takes the place of one bar or food truck in the attendee's activity loop and sends every new order
+    to one of the stations: the shortest queue, the shorter of two random ones, or the least queued work
+    (expected wait). 'static' is the old behaviour, one random station per attendee, and needs no router.
+    Stations provide menu, add_order, queue_length and expected_wait."""
+    def __init__(self, stations, policy='shortest_queue', rng=random, name='Stations'):
+        if policy not in ROUTING_POLICIES[1:]:
+            raise ValueError(f"Unknown routing policy '{policy}', choose one of {ROUTING_POLICIES}")
+        self.name = name # station name in the event log, e.g. 'Bars': the station is only chosen by add_order
+        self.stations = stations
+        self.policy = policy
+        self.rng = rng
+        self.menu = stations[0].menu # all the stations of a router serve the same menu
+
+    def choose(self):
+        candidates = self.stations
+        if self.policy == 'power_of_two' and len(candidates) > 2:
+            candidates = self.rng.sample(candidates, 2)
+        if self.policy == 'least_work':
+            return min(candidates, key=lambda station: (station.expected_wait(), self.rng.random()))
+        return min(candidates, key=lambda station: (station.queue_length(), self.rng.random())) # ties at random
+
+    def add_order(self, order):
+        self.choose().add_order(order)
 
 # Person classes:
 
 class Person:
+    __slots__ = ('id', 'age') # no per-instance __dict__, a million attendees have to fit in memory
+
     def __init__(self, id, age):
         self.id = id
         self.age = age
 
 class Attendee(Person):
-    def __init__(self, id, age, ticket, total_drinks, total_foods,total_treatments, total_bathroom_visits, total_stage_visits, gender, activities):
+    __slots__ = ('rng', 'is_inside', 'ticket', 'active', 'entered_at', 'display_entered_at', 'display_exited_at',
+                 'total_drinks', 'total_foods', 'total_treatments', 'total_bathroom_visits', 'total_stage_visits',
+                 'activities', 'gender', 'has_free_ticket')
+
+    # base probabilities for bathroom and emergency
+    needs_emergency = 0.001
+    needs_bathroom = 0.1
+
+    def __init__(self, id, age, ticket, total_drinks, total_foods,total_treatments, total_bathroom_visits, total_stage_visits, gender, activities, rng=None):
         super().__init__(id, age)
+        self.rng = rng or random # own stream in a seeded run, the shared random module otherwise
         self.is_inside = False
         self.ticket = ticket
         self.active = False
         
-        self.entered_at = time.time()
-        self.display_entered_at = datetime.datetime.now().time() # record times for sql
+        self.entered_at = festival_clock.time()
+        self.display_entered_at = festival_clock.time_of_day() # record times for sql
         self.display_exited_at = None
         
         # counters for sql connection 
@@ -34,24 +614,38 @@ class Attendee(Person):
         self.activities = activities
         self.gender = gender
         
-        self.has_free_ticket = random.choices([True, False], weights=[0.5, 0.5])[0]
-        
-        # base probabilities for bathroom and emergency
-        self.needs_emergency = 0.001
-        self.needs_bathroom = 0.1
+        self.has_free_ticket = self.rng.choices([True, False], weights=[0.5, 0.5])[0]
     
     def pass_check(self, entrance):
         entrance.add_check(self)
         
+    # probability models, shared by the threaded and the event-driven engine
+    def leave_probability(self, time_spent):
+        base_probability = 0.0001  # Start with a very low base probability
+        return base_probability + 0.005 * self.total_treatments + 0.002 * self.total_drinks + 0.001 * time_spent
+
+    def bathroom_probability(self):
+        base_prob = self.needs_bathroom 
+        incremental_increase = 0.1
+        reduction_factor = 0.05
+        # realistic probability of needing the bathroom
+        return min(base_prob + incremental_increase * self.total_drinks - reduction_factor * self.total_bathroom_visits, 1.0)
+
+    def emergency_probability(self):
+        base_prob = self.needs_emergency  
+        incremental_increase = 0.05
+        reduction_factor = 0.05
+        # realistic probability of needing emergency help
+        return min(base_prob + incremental_increase * self.total_drinks - reduction_factor * self.total_treatments, 1.0)
+        
     def decide_to_leave(self):
-            time_spent = time.time() - self.entered_at # Time spent in hours
-            base_probability = 0.0001  # Start with a very low base probability
-            probability = base_probability + 0.005 * self.total_treatments + 0.002 * self.total_drinks + 0.001 * time_spent 
+            time_spent = festival_clock.time() - self.entered_at # festival seconds
+            probability = self.leave_probability(time_spent)
             
-            if random.random() < probability:
+            if self.rng.random() < probability:
                 self.is_inside = False
-                print(f"{self.id} is leaving the festival.")
-                self.display_exited_at = datetime.datetime.now().time()
+                event_log.emit('leave', self.id, message=f"{self.id} is leaving the festival.")
+                self.display_exited_at = festival_clock.time_of_day()
 
     def place_drink(self, menu_item, bar):
         try: 
@@ -60,7 +654,7 @@ class Attendee(Person):
             self.total_drinks += 1
             return order
         except Exception as e:
-            print(traceback.format_exc())
+            event_log.emit('error', self.id, message=traceback.format_exc(), level=ERROR)
     
     def place_food(self, menu_item, food_truck):
         try:
@@ -69,209 +663,303 @@ class Attendee(Person):
             self.total_foods += 1
             return order
         except Exception as e:
-            print(traceback.format_exc())
+            event_log.emit('error', self.id, message=traceback.format_exc(), level=ERROR)
             
     def go_to_stage(self, stage):
         try:
-            stage_index = random.randint(0, len(stage.stages) - 1)
-            artist = stage.get_current_performer(stage_index)
-            stage_genre = stage.stages[stage_index]['genre']
-            if artist:
-                print(f"{self.id} is watching {artist.name} perform on {stage_genre} Stage")
-                self.total_stage_visits += 1
-            else:
-                print(f"{self.id} went to {stage_genre} Stage, but there's no performance at the moment.")
-                
-            time.sleep(random.uniform(5.0, 10.0))
+            for pause in self.watch_stage(stage):
+                festival_clock.sleep(pause)
         except Exception as e:
-            print(traceback.format_exc())
+            event_log.emit('error', self.id, message=traceback.format_exc(), level=ERROR)
+
+    def watch_stage(self, stage):
+        stage_index = self.rng.randint(0, stage.lineup.num_stages - 1)
+        artist = stage.get_current_performer(stage_index)
+        stage_genre = stage.lineup.genres[stage_index]
+        if artist:
+            event_log.emit('stage_visit', self.id, f'{stage_genre} Stage', f"{self.id} is watching {artist.name} perform on {stage_genre} Stage")
+            self.total_stage_visits += 1
+        else:
+            event_log.emit('stage_empty', self.id, f'{stage_genre} Stage', f"{self.id} went to {stage_genre} Stage, but there's no performance at the moment.")
+            
+        yield self.rng.uniform(5.0, 10.0)
         
     def go_to_bathroom(self, bathroom):
-        base_prob = self.needs_bathroom 
-        incremental_increase = 0.1
-        reduction_factor = 0.05
-        prob = min(base_prob + incremental_increase * self.total_drinks - reduction_factor * self.total_bathroom_visits, 1.0)
-        # realistic probability of needing the bathroom
+        prob = self.bathroom_probability()
         
-        if random.random() < prob:
-            print(f"{self.id} is going to the bathroom")
+        if self.rng.random() < prob:
+            event_log.emit('bathroom_request', self.id, f'{self.gender} Bathroom', f"{self.id} is going to the bathroom")
             bathroom.request_use(self)
             self.total_bathroom_visits += 1
     
     def go_to_emergency(self, emergency_truck):
-        base_prob = self.needs_emergency  
-        incremental_increase = 0.05
-        reduction_factor = 0.05
-        prob = min(base_prob + incremental_increase * self.total_drinks - reduction_factor * self.total_treatments, 1.0)
-        # realistic probability of needing emergency help
+        prob = self.emergency_probability()
 
-        if random.random() < prob:
-            print(f"{self.id} is going to the emergency truck")
+        if self.rng.random() < prob:
+            event_log.emit('emergency_request', self.id, 'Emergency Truck', f"{self.id} is going to the emergency truck")
             emergency_truck.admit_patient(self)
             self.total_treatments += 1
     
     # main function for the attendee - runs in the threadpool - activity loop:
     def do_activities(self, bar, food_truck, bathroom, emergency_truck, stage):
         try:
-                while self.is_inside:
-                    
-                    self.decide_to_leave()  #check everytime before doing an activity
-                    
-                    if not self.is_inside:
-                        break # break if person is not inside anymore
-                    
-                    activity = random.choice(self.activities)
-                    time.sleep(random.uniform(0.5, 1.5)) 
-                                        
-                    if not self.active:
-                        self.active = True # avoid multiple activities at the same time
-                        
-                        if activity == 'drinks' and 'drinks' in self.activities:
-                            drink_item = random.choice(bar.menu.items)
-                            print(f"{self.id} is placing an order for {drink_item.name}")
-                            self.place_drink(drink_item, bar)
-                            
-                        elif activity == 'food' and 'food' in self.activities:
-                            food_item = random.choice(food_truck.menu.items)
-                            print(f"{self.id} is placing an order for {food_item.name}")
-                            self.place_food(food_item, food_truck)
-                        
-                        elif activity == 'music' and 'music' in self.activities:
-                            self.go_to_stage(stage)
-                        
-                        elif activity == 'bathroom' and 'bathroom' in self.activities:
-                            self.go_to_bathroom(bathroom)
-                        
-                        elif activity == 'emergency' and 'emergency' in self.activities:
-                            self.go_to_emergency(emergency_truck)
-                 
-                        time.sleep(random.uniform(2, 5))  
-                        self.active = False
-                        
+            for pause in self.activity_loop(bar, food_truck, bathroom, emergency_truck, stage):
+                festival_clock.sleep(pause)
         except Exception as e:
-            print(traceback.format_exc())
+            event_log.emit('error', self.id, message=traceback.format_exc(), level=ERROR)
+
+    def activity_loop(self, bar, food_truck, bathroom, emergency_truck, stage):
+        """The attendee's day at the festival. Yields every pause (in seconds) so the caller decides how to wait: time.sleep in a thread, asyncio.sleep in a coroutine."""
+        while self.is_inside:
+            
+            self.decide_to_leave()  #check everytime before doing an activity
+            
+            if not self.is_inside:
+                break # break if person is not inside anymore
+            
+            activity = self.rng.choice(self.activities)
+            yield self.rng.uniform(0.5, 1.5)
+                                
+            if not self.active:
+                self.active = True # avoid multiple activities at the same time
+                
+                if activity == 'drinks' and 'drinks' in self.activities:
+                    drink_item = self.rng.choice(bar.menu.items)
+                    event_log.emit('order_placed', self.id, bar.name, f"{self.id} is placing an order for {drink_item.name}")
+                    self.place_drink(drink_item, bar)
+                    
+                elif activity == 'food' and 'food' in self.activities:
+                    food_item = self.rng.choice(food_truck.menu.items)
+                    event_log.emit('order_placed', self.id, food_truck.name, f"{self.id} is placing an order for {food_item.name}")
+                    self.place_food(food_item, food_truck)
+                
+                elif activity == 'music' and 'music' in self.activities:
+                    yield from self.watch_stage(stage)
+                
+                elif activity == 'bathroom' and 'bathroom' in self.activities:
+                    self.go_to_bathroom(bathroom)
+                
+                elif activity == 'emergency' and 'emergency' in self.activities:
+                    self.go_to_emergency(emergency_truck)
+
+                yield self.rng.uniform(2, 5)
+                self.active = False
 
     def receive_notification(self, message):
-        print(f'{self.id}: {message}')   
+        event_log.emit('notification', self.id, message=lambda: f'{self.id}: {message}', level=DEBUG)
 
 # Security and Entrance: 
 
 class SecurityStaff(threading.Thread):
-    def __init__(self, name, entrance):
+    def __init__(self, name, entrance, lane=0):
         super().__init__(name=name)
         self.entrance = entrance
+        self.lane = lane # index of the lane this guard works, the others are helped when it is empty
+        self.rng = random
     
     def run(self):
+        metrics = self.entrance.metrics[self.lane]
         while True:
-            attendee = self.entrance.get_next_attendee() # get attendee from queue
+            attendee = self.entrance.get_next_attendee(self.lane) # get attendee from queue
             if attendee is None:
                 break
-            print(f"{self.name} is checking {attendee.id}")
-            time.sleep(random.uniform(0.2, 1))  
+            event_log.emit('security_check', self.name, metrics.name, lambda: f"{self.name} is checking {attendee.id}", DEBUG)
+            started = festival_clock.time()
+            festival_clock.sleep(self.rng.uniform(0.2, 1))  
+            metrics.record_service(self.name, festival_clock.time() - started)
             if attendee.ticket.type != "No ticket":
                 attendee.is_inside = True
                 attendee.receive_notification('You are now inside! Enjoy the festival!')
-                attendee.entered_at = time.time()
-                attendee.display_entered_at = datetime.datetime.now().time() 
+                attendee.entered_at = festival_clock.time()
+                attendee.display_entered_at = festival_clock.time_of_day() 
+                self.entrance.on_admit(attendee)
             else:
                 attendee.receive_notification('You are not allowed to enter the festival. You have no ticket:( sorry!')
                 attendee.display_entered_at = None # never entered
+                self.entrance.on_refuse(attendee)
  
 class TicketType:
+    __slots__ = ('type',)
+
     def __init__(self, type):
         self.type = type
     def __str__(self):
         return f"Ticket Type: {self.type}"
 
+TICKET_TYPES = [TicketType("VIP"), TicketType("3-day pass"), TicketType("1-day pass"), TicketType("No ticket")] # shared by all the attendees
+
+VIP_TICKETS = {'VIP'} # ticket types that may use the VIP lanes
+
+def lane_names(lanes, vip_lanes):
+    """Station names of the entrance lanes, the VIP lanes first; a single lane is just 'Entrance'."""
+    if lanes == 1:
+        return ['Entrance']
+    return [f'Entrance VIP lane {i+1}' for i in range(vip_lanes)] + [f'Entrance lane {i+1}' for i in range(lanes - vip_lanes)]
+
+def lane_layout(security_count, lanes, vip_lanes):
+    """(lanes, vip_lanes) that the guards can staff: at least one guard per lane and one regular lane."""
+    lanes = max(min(lanes, security_count), 1)
+    return lanes, min(vip_lanes, lanes - 1)
+
 class Entrance:
-    def __init__(self, security_count):
-        self.attendees = []
+    """Security gates with one queue per lane. Attendees join the shortest lane they may use, VIP ticket holders
+    the VIP lanes if there are any. Guards are spread over the lanes and help the others when theirs is empty.
+    on_admit is called for every attendee let in, so their festival can start while the gates are still busy,
+    on_refuse for every attendee turned away."""
+    def __init__(self, security_count, lanes=1, vip_lanes=0):
+        lanes, vip_lanes = lane_layout(security_count, lanes, vip_lanes)
+        names = lane_names(lanes, vip_lanes)
         self.securities = []
-        self.lock = threading.Lock()
         for i in range(security_count):
-            security = SecurityStaff(f'Security {i+1}', self)
+            security = SecurityStaff(f'Security {i+1}', self, lane=i % lanes)
             self.securities.append(security)
+        self.metrics = [StationMetrics(name, sum(1 for security in self.securities if security.lane == lane)) for lane, name in enumerate(names)]
+        condition = threading.Condition() # one for all the lanes, an idle guard wakes up for an attendee in any of them
+        self.lanes = [WorkQueue(metrics, condition=condition) for metrics in self.metrics]
+        self.vip_lanes = self.lanes[:vip_lanes]
+        self.regular_lanes = self.lanes[vip_lanes:]
+        self.on_admit = lambda attendee: None
+        self.on_refuse = lambda attendee: None
 
     def add_check(self, attendee):
-        self.lock.acquire() # lock the queue while being used
-        self.attendees.append(attendee)
-        self.lock.release()
-
-    def get_next_attendee(self):
-        self.lock.acquire() # lock the queue while being processed by a security staff
-        if self.attendees:
-            attendee = self.attendees.pop(0)
-            self.lock.release()
-            return attendee
-        self.lock.release()
-        return None
+        lanes = self.vip_lanes if self.vip_lanes and attendee.ticket.type in VIP_TICKETS else self.regular_lanes
+        min(lanes, key=len).put(attendee)
+
+    def get_next_attendee(self, lane=0):
+        # None once the lanes are closed and everyone has been checked
+        return get_or_steal(self.lanes[lane], [other for other in self.lanes if other is not self.lanes[lane]])
+
+    def close(self):
+        for lane in self.lanes:
+            lane.close()
 
     def start(self):
+        for metrics in self.metrics:
+            metrics.start()
         for security in self.securities:
             security.start()
         for security in self.securities:
             security.join()
+        for metrics in self.metrics:
+            metrics.stop()
+
+
+class ArrivalCurve:
+    """When the attendees reach the gates, in festival seconds after opening: a mix of waves, each given as
+    (peak, spread, share) with normally distributed arrivals around the peak. The default is everyone at once."""
+    def __init__(self, waves=((0, 0, 1),)):
+        self.waves = [tuple(wave) for wave in waves]
+
+    def times(self, count, rng=random):
+        shares = [share for _, _, share in self.waves]
+        times = []
+        for _ in range(count):
+            peak, spread, _ = rng.choices(self.waves, weights=shares)[0]
+            times.append(max(rng.gauss(peak, spread), 0.0) if spread else float(peak))
+        return sorted(times)
+
+    def __repr__(self):
+        return f"ArrivalCurve({self.waves})"
     
 
 # Artist and Stage:
 
-class Artist(threading.Thread):
-    def __init__(self, name, genre, set_duration, stage, stage_index):
-        super().__init__()
-        self.name = name
-        self.genre = genre
-        self.set_duration = set_duration
-        self.stage = stage  
-        self.stage_index = stage_index # keep track for attendees to know which stage they can be watching
-        self.currently_performing = False
+Act = namedtuple('Act', ['name', 'genre', 'stage_index', 'start', 'end']) # start and end in seconds since the show started
+
+STAGE_GENRES = ['Pop', 'Rap', 'Reggaeton']
+
+class Lineup:
+    """Precomputed timetable: every stage plays its artists back to back, in the order they are listed.
+    An artist goes to the stage of its genre, or to artist_info['stage'] (an index) if given, so a lineup
+    can have more stages than genres. Lookups are binary searches on the start times, no locks needed."""
+    def __init__(self, artists_info, num_stages=None):
+        for info in artists_info:
+            if 'stage' not in info and info['genre'] not in STAGE_GENRES:
+                raise ValueError(f"Artist '{info['name']}' plays {info['genre']}, which has no stage of its own: "
+                                 f"choose a genre of {STAGE_GENRES} or give the artist a 'stage' index")
+        count = max([len(STAGE_GENRES)] + [info['stage'] + 1 for info in artists_info if 'stage' in info])
+        self.genres = STAGE_GENRES + [None] * (count - len(STAGE_GENRES))
+        self.open_stages = count if num_stages is None else num_stages # acts on the other stages play to nobody
+        self.acts = [[] for _ in range(count)] # per stage, ordered by start
+        for info in artists_info:
+            stage_index = info['stage'] if 'stage' in info else STAGE_GENRES.index(info['genre'])
+            if self.genres[stage_index] is None:
+                self.genres[stage_index] = info['genre']
+            start = self.acts[stage_index][-1].end if self.acts[stage_index] else 0
+            self.acts[stage_index].append(Act(info['name'], info['genre'], stage_index, start, start + info['set_duration']))
+        self.starts = [[act.start for act in acts] for acts in self.acts]
+        self.length = max([acts[-1].end for acts in self.acts if acts] + [0])
+
+    @property
+    def num_stages(self):
+        return len(self.acts)
+
+    def stage_end(self, stage_index):
+        acts = self.acts[stage_index]
+        return acts[-1].end if acts and stage_index < self.open_stages else 0
+
+    def performer(self, stage_index, t):
+        """The Act on stage at t seconds into the show, or None."""
+        if stage_index >= self.open_stages:
+            return None
+        i = bisect.bisect_right(self.starts[stage_index], t) - 1
+        if i >= 0 and t < self.acts[stage_index][i].end:
+            return self.acts[stage_index][i]
+        return None
+
+    def next_act(self, stage_index, t):
+        """The first Act starting after t on that stage, or None once its last set has started."""
+        i = bisect.bisect_right(self.starts[stage_index], t)
+        return self.acts[stage_index][i] if i < len(self.acts[stage_index]) else None
+
+    def milestones(self):
+        """(time, 'set_start' or 'set_end', act) of the whole show in time order, ends before starts."""
+        boundaries = []
+        for acts in self.acts:
+            for act in acts:
+                boundaries.append((act.start, 1, act))
+                boundaries.append((act.end, 0, act))
+        boundaries.sort(key=lambda boundary: (boundary[0], boundary[1]))
+        return [(at, 'set_start' if kind else 'set_end', act) for at, kind, act in boundaries]
 
-    def run(self):
-        stage_info = self.stage.stages[self.stage_index]
-        stage_lock = stage_info['lock'] # get the lock for the stage from the dictionary
-        stage_genre = stage_info['genre']
-
-        with stage_lock:
-            self.currently_performing = True
-            self.stage.current_performers[self.stage_index] = self
-            print(f"{self.name} starting their set of {self.set_duration} seconds on {stage_genre} Stage!")
-            time.sleep(self.set_duration)
-            print(f"{self.name} has finished their performance on {stage_genre} Stage!")
-            self.currently_performing = False
-            self.stage.current_performers[self.stage_index] = None
 
 class Stage:
-    def __init__(self, num_stages, artists_info):
-        self.stages = [{'lock': threading.Lock(), 'genre': 'Pop'}, 
-                       {'lock': threading.Lock(), 'genre': 'Rap'}, 
-                       {'lock': threading.Lock(), 'genre': 'Reggaeton'}] # one lock for each genre stage 
-        
-        self.current_performers = [None] * num_stages  # Track who is performing at each stage
-        self.artists = []
-        for stage_index, stage_info in enumerate(self.stages):
-            for artist_info in artists_info:
-                if artist_info['genre'] == stage_info['genre']:
-                    self.artists.append(Artist(
-                        name=artist_info['name'],
-                        genre=artist_info['genre'],
-                        set_duration=artist_info['set_duration'],
-                        stage=self,
-                        stage_index=stage_index
-                    ))
+    def __init__(self, num_stages, artists_info, clock=None):
+        self.lineup = Lineup(artists_info, num_stages)
+        self.clock = clock or festival_clock.time
+        self.started_at = None
+
+    def show(self):
+        """The show as a generator of pauses, announcing every set; driven by start_show with festival_clock.sleep
+        or by the asyncio simulation with asyncio.sleep."""
+        self.started_at = self.clock()
+        event_log.emit('show_start', 'Stage', message="\n\nStage show starting!\n\n", level=MILESTONE)
+        for at, event_type, act in self.lineup.milestones():
+            pause = self.started_at + at - self.clock()
+            if pause > 0:
+                yield pause
+            if event_type == 'set_start':
+                event_log.emit('set_start', act.name, f'{act.genre} Stage', f"{act.name} starting their set of {act.end - act.start} seconds on {act.genre} Stage!", MILESTONE)
+            else:
+                event_log.emit('set_end', act.name, f'{act.genre} Stage', f"{act.name} has finished their performance on {act.genre} Stage!", MILESTONE)
+        event_log.emit('show_end', 'Stage', message="\n\nStage show finished!\n\n PUNTA CANA WAS A BLAST! \n\n See you next year!\n\n", level=MILESTONE) # signal to see it in the output
 
     def start_show(self):
-        print("\n\nStage show starting!\n\n")
-        for artist in self.artists:
-            artist.start()
-        for artist in self.artists:
-            artist.join()
-        print("\n\nStage show finished!\n\n PUNTA CANA WAS A BLAST! \n\n See you next year!\n\n") # signal to see it in the output
+        for pause in self.show():
+            festival_clock.sleep(pause)
 
     def get_current_performer(self, stage_index):
-        if stage_index < len(self.current_performers):
-            artist = self.current_performers[stage_index]
-            if artist and artist.currently_performing:
-                return artist
-        return None
+        if self.started_at is None:
+            return None
+        return self.lineup.performer(stage_index, self.clock() - self.started_at)
+
+    def get_next_performer(self, stage_index):
+        return self.lineup.next_act(stage_index, self.clock() - self.started_at if self.started_at is not None else -1)
+
+    def current_performers(self):
+        """(stage index, stage genre, Act or None) of every open stage, right now."""
+        return [(stage_index, self.lineup.genres[stage_index], self.get_current_performer(stage_index))
+                for stage_index in range(min(self.lineup.open_stages, self.lineup.num_stages))]
     
 
 # Bar and Food:
@@ -284,20 +972,27 @@ class Barista(threading.Thread):
 
     def run(self):
         try:
-            while festival.festival_running:
-                self.order = self.bar.get_next_order()
+            while True:
+                self.order = self.bar.get_next_order() # blocks until there is an order
                 if self.order is None:
-                    continue # used to be a break condition, but now we keep the thread running until the festival ends
+                    break # the bar has been closed, the festival is over
                 else:           
-                    self.order.status = 'in progress'
-                    print(f"{self.name} is working on {self.order}") 
-                    time.sleep(self.order.estimated_time)
-                    self.order.status = 'completed'
-                    festival.collect_order(self.order)
-                    price_msg = 'free of charge!' if self.order.free_ticket else f'{self.order.menu_item.price}$ please.'
-                    self.order.attendee.receive_notification(f'Your {self.order.menu_item.name} is ready. It will be {price_msg}')
+                    batch = self.bar.take_batch(self.order) # just this order unless the bar batches
+                    started_at = festival_clock.time()
+                    for order in batch:
+                        order.status = 'in progress'
+                        order.started_at = started_at
+                    event_log.emit('order_started', self.name, self.bar.name, lambda: f"{self.name} is working on {self.order}" + (f" and {len(batch) - 1} more" if len(batch) > 1 else ''), DEBUG)
+                    festival_clock.sleep(self.bar.prep_time(batch))
+                    completed_at = festival_clock.time()
+                    self.bar.metrics.record_service(self.name, completed_at - started_at)
+                    for order in batch:
+                        order.status = 'completed'
+                        order.completed_at = completed_at
+                        order.serve()
+                        self.bar.collect(order)
         except Exception as e:
-            print(traceback.format_exc())
+            event_log.emit('error', self.name, self.bar.name, traceback.format_exc(), ERROR)
     
 class Cook(threading.Thread):
     def __init__(self, name, food_truck):
@@ -306,19 +1001,28 @@ class Cook(threading.Thread):
         self.order = None
 
     def run(self):
-        while festival.festival_running:
+        while True:
             self.order = self.food_truck.get_next_order()
             if self.order is None:
-               continue
-            self.order.status = 'in progress'
-            print(f"{self.name} is working on {self.order}") 
-            time.sleep(self.order.estimated_time)
-            self.order.status = 'completed'
-            festival.collect_order(self.order) # collect for the sql database 
-            price_msg = 'free of charge!' if self.order.free_ticket else f'{self.order.menu_item.price}$ please.'
-            self.order.attendee.receive_notification(f'Your {self.order.menu_item.name} is ready. It will be {price_msg}')
+               break
+            batch = self.food_truck.take_batch(self.order)
+            started_at = festival_clock.time()
+            for order in batch:
+                order.status = 'in progress'
+                order.started_at = started_at
+            event_log.emit('order_started', self.name, self.food_truck.name, lambda: f"{self.name} is working on {self.order}" + (f" and {len(batch) - 1} more" if len(batch) > 1 else ''), DEBUG)
+            festival_clock.sleep(self.food_truck.prep_time(batch))
+            completed_at = festival_clock.time()
+            self.food_truck.metrics.record_service(self.name, completed_at - started_at)
+            for order in batch:
+                order.status = 'completed'
+                order.completed_at = completed_at
+                order.serve()
+                self.food_truck.collect(order) # collect for the sql database 
 
 class MenuItem:
+    __slots__ = ('name', 'price', 'contains_alcohol', 'prep_time')
+
     def __init__(self, name, price, contains_alcohol, prep_time):
         self.name = name
         self.price = price
@@ -329,16 +1033,27 @@ class MenuItem:
     def __str__(self) -> str:
         return f"{self.name} (Prep time: {self.prep_time}s, Price: ${self.price})"
         
+BAR_ITEMS = [
+    MenuItem('Soda', 3.50, False, 0.5),
+    MenuItem('Water', 3, False, 0.5),
+    MenuItem('Beer', 5.50, True, 0.8),
+    MenuItem('Wine', 6, True, 0.9),
+    MenuItem('Whiskey', 10, True, 1),
+    MenuItem('Gin Tonic', 11, True, 2)
+]
+
+FOOD_TRUCK_ITEMS = [
+    MenuItem('Burger', 8, False, 1),
+    MenuItem('Fries', 3.20 , False, 0.5),
+    MenuItem('Hot Dog', 4.50, False, 0.8),
+    MenuItem('Tacos', 4, False, 0.7),
+    MenuItem('Wings', 3.60, False, 0.7),
+    MenuItem('Wrap', 5, False, 0.5)
+]
+
 class Menu_Bar:
     def __init__(self):
-        self.items = [
-            MenuItem('Soda', 3.50, False, 0.5),
-            MenuItem('Water', 3, False, 0.5),
-            MenuItem('Beer', 5.50, True, 0.8),
-            MenuItem('Wine', 6, True, 0.9),
-            MenuItem('Whiskey', 10, True, 1),
-            MenuItem('Gin Tonic', 11, True, 2)
-        ]
+        self.items = BAR_ITEMS # every bar serves the same item objects, the orders only reference them
     
     def get_item_by_name(self, name):
         for item in self.items:
@@ -348,14 +1063,7 @@ class Menu_Bar:
 
 class Menu_FoodTruck:
     def __init__(self):
-        self.items = [
-            MenuItem('Burger', 8, False, 1),
-            MenuItem('Fries', 3.20 , False, 0.5),
-            MenuItem('Hot Dog', 4.50, False, 0.8),
-            MenuItem('Tacos', 4, False, 0.7),
-            MenuItem('Wings', 3.60, False, 0.7),
-            MenuItem('Wrap', 5, False, 0.5)
-        ]
+        self.items = FOOD_TRUCK_ITEMS
     
     def get_item_by_name(self, name):
         for item in self.items:
@@ -364,75 +1072,153 @@ class Menu_FoodTruck:
         return None
 
 class Order:
+    __slots__ = ('attendee_id', 'attendee', 'menu_item', 'status', 'free_ticket', 'queued_at', 'started_at', 'completed_at')
+
     def __init__(self, attendee, menu_item, free_ticket):
-        self.attendee = attendee
+        self.attendee_id = attendee.id
+        self.attendee = attendee # only until the order is served, the tables need the id alone
         self.menu_item = menu_item
         self.status = 'waiting'
-        self.estimated_time = menu_item.prep_time
         self.free_ticket = free_ticket
+        # timestamps for the station metrics
+        self.queued_at = None
+        self.started_at = None
+        self.completed_at = None
+
+    @property
+    def estimated_time(self):
+        return self.menu_item.prep_time
+
+    def serve(self):
+        """Tell the attendee the order is ready and drop the reference to them."""
+        price_msg = 'free of charge!' if self.free_ticket else f'{self.menu_item.price}$ please.'
+        self.attendee.receive_notification(f'Your {self.menu_item.name} is ready. It will be {price_msg}')
+        self.attendee = None
 
     def __str__(self):
-        return f"{self.attendee.id}'s order: {self.menu_item} ({self.status})"
+        return f"{self.attendee_id}'s order: {self.menu_item} ({self.status})"
+
+
+class BatchPolicy:
+    """Optional batching for baristas and cooks: a worker takes up to the item's limit of queued orders for
+    the same menu item and prepares them together in prep_time * count ** exponent seconds (exponent 1:
+    no gain, 0: a batch takes as long as one order)."""
+    def __init__(self, max_batch=4, exponent=0.6, limits=None):
+        self.max_batch = max_batch
+        self.exponent = exponent
+        self.limits = limits or {} # item name -> batch size limit, e.g. {'Gin Tonic': 2}
+
+    def limit(self, menu_item):
+        return self.limits.get(menu_item.name, self.max_batch)
+
+    def prep_time(self, menu_item, count):
+        return menu_item.prep_time * count ** self.exponent
+
+    def __repr__(self):
+        return f"BatchPolicy(max_batch={self.max_batch}, exponent={self.exponent}, limits={self.limits})"
+
         
 class Bar:
-    def __init__(self, barista_count):
+    def __init__(self, barista_count, name='Bar', batching=None):
+        self.name = name
+        self.batching = batching # BatchPolicy, None to make one order at a time
         self.menu = Menu_Bar()
-        self.orders = []
+        self.metrics = StationMetrics(name, barista_count)
+        self.orders = WorkQueue(self.metrics, cost=lambda order: order.estimated_time)
+        self.peers = [] # other bars whose orders idle baristas may take
+        self.collect = lambda order: None # gets every completed order, set by FestivalSimulation
         self.baristas = []
-        self.orders_lock = threading.Lock()
         for i in range(barista_count):
             barista = Barista(f'Barista {i+1}', self)
             self.baristas.append(barista)
 
     def add_order(self, order):
-        with self.orders_lock: 
-            self.orders.append(order)
+        order.queued_at = festival_clock.time()
+        self.orders.put(order)
 
     def get_next_order(self):
-        self.orders_lock.acquire()
-        if len(self.orders) > 0:
-            order = self.orders.pop(0)
-            self.orders_lock.release()
-            return order
-        self.orders_lock.release()
-        return None
+        return get_or_steal(self.orders, [peer.orders for peer in self.peers])
+
+    def take_batch(self, order):
+        """The order plus the queued orders for the same item that go with it."""
+        if not self.batching:
+            return [order]
+        same_item = lambda other: other.menu_item.name == order.menu_item.name
+        return [order] + self.orders.take_matching(same_item, self.batching.limit(order.menu_item) - 1)
+
+    def prep_time(self, batch):
+        if not self.batching:
+            return batch[0].estimated_time
+        return self.batching.prep_time(batch[0].menu_item, len(batch))
+
+    def queue_length(self):
+        return len(self.orders)
+
+    def expected_wait(self):
+        return self.orders.work / max(len(self.baristas), 1)
+
+    def close(self):
+        self.orders.close(drain=False) # orders still waiting when the festival ends are not made
 
     def start(self):
+        self.metrics.start()
         for barista in self.baristas:
             barista.start()
 
         for barista in self.baristas:
             barista.join()
+        self.metrics.stop()
 
 class FoodTruck:
-    def __init__(self, cook_count):
+    def __init__(self, cook_count, name='Food Truck', batching=None):
+        self.name = name
+        self.batching = batching
         self.menu = Menu_FoodTruck()
-        self.orders = []
+        self.metrics = StationMetrics(name, cook_count)
+        self.orders = WorkQueue(self.metrics, cost=lambda order: order.estimated_time)
+        self.peers = [] # other food trucks whose orders idle cooks may take
+        self.collect = lambda order: None
         self.cooks = []
-        self.orders_lock = threading.Lock()
         for i in range(cook_count):
             cook = Cook(f'Cook {i+1}', self)
             self.cooks.append(cook)
 
     def add_order(self, order):
-        with self.orders_lock:  
-            self.orders.append(order)
+        order.queued_at = festival_clock.time()
+        self.orders.put(order)
 
     def get_next_order(self):
-        self.orders_lock.acquire()
-        if len(self.orders) > 0:
-            order = self.orders.pop(0)
-            self.orders_lock.release()
-            return order
-        self.orders_lock.release()
-        return None
+        return get_or_steal(self.orders, [peer.orders for peer in self.peers])
+
+    def take_batch(self, order):
+        """The order plus the queued orders for the same item that go with it."""
+        if not self.batching:
+            return [order]
+        same_item = lambda other: other.menu_item.name == order.menu_item.name
+        return [order] + self.orders.take_matching(same_item, self.batching.limit(order.menu_item) - 1)
+
+    def prep_time(self, batch):
+        if not self.batching:
+            return batch[0].estimated_time
+        return self.batching.prep_time(batch[0].menu_item, len(batch))
+
+    def queue_length(self):
+        return len(self.orders)
+
+    def expected_wait(self):
+        return self.orders.work / max(len(self.cooks), 1)
+
+    def close(self):
+        self.orders.close(drain=False)
 
     def start(self):
+        self.metrics.start()
         for cook in self.cooks:
             cook.start()
 
         for cook in self.cooks:
             cook.join()
+        self.metrics.stop()
 
 # Bathroom:
 
@@ -441,23 +1227,26 @@ class BathroomStall(threading.Thread):
         super().__init__(name=name)
         self.bathroom = bathroom
         self.gender = gender
+        self.rng = random
 
     def run(self):
         try:
-            while festival.festival_running:
+            while True:
                 person = self.bathroom.get_next_person(self.gender)
                 if person is None:
-                    continue
-                print(f"Bathroom stall {self.name} for {self.gender} is being used by {person.id}")
-                time.sleep(random.uniform(2, 5))  # Simulating bathroom time
-                print(f"{person.id} has left the bathroom {self.name}")
+                    break
+                event_log.emit('bathroom_use', self.name, f'{self.gender} Bathroom', lambda: f"Bathroom stall {self.name} for {self.gender} is being used by {person.id}", DEBUG)
+                started = festival_clock.time()
+                festival_clock.sleep(self.rng.uniform(2, 5))  # Simulating bathroom time
+                self.bathroom.metrics[self.gender].record_service(self.name, festival_clock.time() - started)
+                event_log.emit('bathroom_done', person.id, f'{self.gender} Bathroom', lambda: f"{person.id} has left the bathroom {self.name}", DEBUG)
         except Exception as e:
-            print(e)
+            event_log.emit('error', self.name, f'{self.gender} Bathroom', traceback.format_exc(), ERROR)
 
 class Bathroom:
     def __init__(self, stalls_per_gender):
-        self.persons = {'Male': [], 'Female': []}
-        self.persons_lock = {'Male': threading.Lock(), 'Female': threading.Lock()} # one lock for each gender bathroom
+        self.metrics = {gender: StationMetrics(f'{gender} Bathroom', stalls_per_gender) for gender in ['Male', 'Female']}
+        self.persons = {gender: WorkQueue(self.metrics[gender]) for gender in ['Male', 'Female']} # one queue for each gender bathroom
         self.stalls = {'Male': [], 'Female': []}
 
         for gender in ['Male', 'Female']:
@@ -466,84 +1255,213 @@ class Bathroom:
                 self.stalls[gender].append(stall)
 
     def request_use(self, person):
-        gender = person.gender
-        self.persons_lock[gender].acquire()
-        self.persons[gender].append(person)
-        self.persons_lock[gender].release()
+        self.persons[person.gender].put(person)
 
     def get_next_person(self, gender):
-        self.persons_lock[gender].acquire()
-        if len(self.persons[gender]) > 0:
-            person = self.persons[gender].pop(0)
-            self.persons_lock[gender].release()
-            return person
-        self.persons_lock[gender].release()
-        return None
+        return self.persons[gender].get()
         
     def start(self):
         for gender in ['Male', 'Female']:
+            self.metrics[gender].start()
             for stall in self.stalls[gender]:
                 stall.start()
 
+    def close(self):
+        for gender in ['Male', 'Female']:
+            self.persons[gender].close(drain=False)
+
     def stop(self):
+        self.close()
         for gender in ['Male', 'Female']:
             for stall in self.stalls[gender]:
                 stall.join()  
+            self.metrics[gender].stop()
 
 # Emergency truck:
 
+TRIAGE_CLASSES = ['critical', 'serious', 'minor'] # most urgent first
+
+Case = namedtuple('Case', ['patient', 'severity']) # a patient waiting at the emergency truck, severity None without triage
+
+
+class Triage:
+    """Optional triage for the emergency truck. A patient's severity comes from their drinks and earlier
+    treatments when they are admitted (drinks + 2 * treatments against the thresholds), and the treatment
+    takes U(low, high) seconds of their class. With priority the doctors take the patient with the earliest
+    deadline, admission plus the target time to treatment of the class: urgent patients go first, but one
+    who has waited past their target goes ahead of urgent ones admitted later, so nobody starves. A doctor
+    always finishes the patient they are treating. priority=False keeps the FIFO queue, for comparison."""
+    def __init__(self, thresholds=(4, 8), targets=None, treatment_times=None, priority=True):
+        self.thresholds = thresholds # scores from which a patient is serious, critical
+        self.targets = targets or {'critical': 1.0, 'serious': 5.0, 'minor': 20.0} # seconds
+        self.treatment_times = treatment_times or {'critical': (1.5, 3.0), 'serious': (1.0, 2.0), 'minor': (0.5, 1.5)}
+        self.priority = priority
+
+    def severity(self, patient):
+        score = patient.total_drinks + 2 * patient.total_treatments
+        if score >= self.thresholds[1]:
+            return 'critical'
+        return 'serious' if score >= self.thresholds[0] else 'minor'
+
+    def deadline(self, case, queued_at):
+        return queued_at + self.targets[case.severity]
+
+    def treatment_time(self, case, rng):
+        return rng.uniform(*self.treatment_times[case.severity])
+
+    def __repr__(self):
+        return (f"Triage(thresholds={self.thresholds}, targets={self.targets}, treatment_times={self.treatment_times}, "
+                f"priority={self.priority})")
+
+
+def case_severity(case):
+    return case.severity
+
+
 class Doctor(threading.Thread):
     def __init__(self, name, emergency_truck):
         super().__init__(name=name)
         self.emergency_truck = emergency_truck
         self.patient = None
+        self.rng = random
     
     def run(self):
         try:
-            while festival.festival_running:
-                self.patient = self.emergency_truck.get_next_patient()
-                if self.patient is None:
-                    continue
-                print(f"{self.name} is treating {self.patient.id}")
-                time.sleep(random.uniform(0.5, 1.5))
+            while True:
+                case = self.emergency_truck.get_next_patient()
+                if case is None:
+                    break
+                self.patient = case.patient
+                event_log.emit('treatment', self.name, 'Emergency Truck', lambda: f"{self.name} is treating {self.patient.id}", DEBUG)
+                started = festival_clock.time()
+                festival_clock.sleep(self.emergency_truck.treatment_time(case, self.rng))
+                self.emergency_truck.metrics.record_service(self.name, festival_clock.time() - started)
                 self.patient.receive_notification('You have been treated! You can go back to the festival but do not drink more')
         except Exception as e:
-            print(traceback.format_exc())
+            event_log.emit('error', self.name, 'Emergency Truck', traceback.format_exc(), ERROR)
                 
 class EmergencyTruck:
-    def __init__(self, doctors_count):
+    def __init__(self, doctors_count, triage=None):
         self.doctors = []
-        self.patients = []
-        self.patients_lock = threading.Lock()
+        self.triage = triage # Triage, None for FIFO and the same treatment time for everyone
+        self.metrics = StationMetrics('Emergency Truck', doctors_count)
+        if triage and triage.priority:
+            self.patients = DeadlineQueue(triage.deadline, self.metrics, category=case_severity)
+        else:
+            self.patients = WorkQueue(self.metrics, category=case_severity if triage else None)
         for i in range(doctors_count):
             doctor = Doctor(f'Doctor {i+1}', self)
             self.doctors.append(doctor)
         
     def admit_patient(self, patient):
-            self.patients_lock.acquire()
-            self.patients.append(patient)
-            self.patients_lock.release()
+            self.patients.put(Case(patient, self.triage.severity(patient) if self.triage else None))
         
     def get_next_patient(self):
-            self.patients_lock.acquire()
-            if len(self.patients) > 0:
-                patient = self.patients.pop(0)
-                self.patients_lock.release()
-                return patient
-            self.patients_lock.release()
-            return None
+            """Next Case to treat, None once the truck is closed."""
+            return self.patients.get()
+
+    def treatment_time(self, case, rng):
+            return self.triage.treatment_time(case, rng) if self.triage else rng.uniform(0.5, 1.5)
+
+    def close(self):
+            self.patients.close(drain=False)
         
     def start(self):
+            self.metrics.start()
             for doctor in self.doctors:
                 doctor.start()
             
             for doctor in self.doctors:
                 doctor.join()
+            self.metrics.stop()
                 
 # Sql connection & creation of database:
 
-class FestivalDatabase:
-    def __init__(self, user, host, database='festival_db'):
+def attendee_row(attendee):
+    """Values of one attendee, in the column order of the attendees table."""
+    entered_at_str = attendee.display_entered_at.strftime("%H:%M:%S") if attendee.display_entered_at else None
+    exited_at_str = attendee.display_exited_at.strftime("%H:%M:%S") if attendee.display_exited_at else None
+    return (
+        attendee.id,
+        attendee.age,
+        attendee.ticket.type,
+        attendee.total_drinks,
+        attendee.total_foods,
+        attendee.total_treatments,
+        attendee.total_bathroom_visits,
+        attendee.total_stage_visits,
+        attendee.gender,
+        entered_at_str,
+        exited_at_str
+    )
+
+def order_row(order):
+    """Values of one order, in the column order of the orders table (order_id is auto increment)."""
+    return (
+        order.attendee_id,
+        order.menu_item.name,
+        order.menu_item.price,
+        order.menu_item.contains_alcohol,
+        order.status
+    )
+
+class FestivalStorage:
+    """Where a simulation writes its attendees and orders tables. FestivalDatabase is the MySQL one, festival_storage.py has the others."""
+    def create_attendees_table(self):
+        raise NotImplementedError
+
+    def create_orders_table(self):
+        raise NotImplementedError
+
+    def clear_orders_table(self):
+        raise NotImplementedError
+
+    def insert_attendees(self, attendees, chunk_size=None):
+        raise NotImplementedError
+
+    def insert_orders(self, orders, chunk_size=None):
+        raise NotImplementedError
+
+    def insert_attendee(self, attendee):
+        self.insert_attendees([attendee])
+
+    def insert_order(self, order):
+        self.insert_orders([order])
+
+    def close(self):
+        pass
+
+class FestivalDatabase(FestivalStorage):
+    INSERT_ATTENDEE = """
+       INSERT INTO attendees (id, age, ticket_type, total_drinks, total_foods, total_treatments, total_bathroom_visits, total_stage_visits, gender, entered_at, exited_at)
+       VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+       ON DUPLICATE KEY UPDATE
+           age = VALUES(age),
+           ticket_type = VALUES(ticket_type),
+           total_drinks = VALUES(total_drinks),
+           total_foods = VALUES(total_foods),
+           total_treatments = VALUES(total_treatments),
+           total_bathroom_visits = VALUES(total_bathroom_visits),
+           total_stage_visits = VALUES(total_stage_visits),
+           gender = VALUES(gender),
+           entered_at = VALUES(entered_at),
+           exited_at = VALUES(exited_at);
+       """
+
+    INSERT_ORDER = """
+            INSERT INTO orders (attendee_id, menu_item_name, price, contains_alcohol, status)
+            VALUES (%s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+            attendee_id = VALUES(attendee_id),
+            menu_item_name = VALUES(menu_item_name),
+            price = VALUES(price),
+            contains_alcohol = VALUES(contains_alcohol),
+            status = VALUES(status);
+            """
+
+    def __init__(self, user, host, database='festival_db', pool_size=4, chunk_size=1000):
+       if mysql is None:
+           raise ImportError("FestivalDatabase needs mysql-connector-python, install it or use another storage from festival_storage.py")
        self.conn = mysql.connector.connect(
            user=user,
            host=host
@@ -557,12 +1475,23 @@ class FestivalDatabase:
        # switch to the created database
        self.conn.database = database
 
+       # pooled connections for the bulk writes, so several chunks can be in flight at once
+       self.chunk_size = chunk_size
+       self.pool = mysql.connector.pooling.MySQLConnectionPool(
+           pool_name=f"{database}_pool",
+           pool_size=pool_size,
+           user=user,
+           host=host,
+           #,password = password
+           database=database
+       )
+
     def create_database(self, database):
        try:
            self.cursor.execute(f"CREATE DATABASE IF NOT EXISTS {database};")
-           print(f"Database '{database}' created or already exists.")
+           event_log.emit('database', 'Database', message=f"Database '{database}' created or already exists.", level=MILESTONE)
        except mysql.connector.Error as err:
-           print(f"Error creating database: {err}")
+           event_log.emit('error', 'Database', message=f"Error creating database: {err}", level=ERROR)
 
     def create_attendees_table(self):
        query = """
@@ -584,39 +1513,13 @@ class FestivalDatabase:
        self.conn.commit()
                 
     def insert_attendee(self, attendee):
-       query = """
-       INSERT INTO attendees (id, age, ticket_type, total_drinks, total_foods, total_treatments, total_bathroom_visits, total_stage_visits, gender, entered_at, exited_at)
-       VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-       ON DUPLICATE KEY UPDATE
-           age = VALUES(age),
-           ticket_type = VALUES(ticket_type),
-           total_drinks = VALUES(total_drinks),
-           total_foods = VALUES(total_foods),
-           total_treatments = VALUES(total_treatments),
-           total_bathroom_visits = VALUES(total_bathroom_visits),
-           total_stage_visits = VALUES(total_stage_visits),
-           gender = VALUES(gender),
-           entered_at = VALUES(entered_at),
-           exited_at = VALUES(exited_at);
-       """
-       entered_at_str = attendee.display_entered_at.strftime("%H:%M:%S") if attendee.display_entered_at else None
-       exited_at_str = attendee.display_exited_at.strftime("%H:%M:%S") if attendee.display_exited_at else None
-
-       values = (
-           attendee.id,
-           attendee.age,
-           attendee.ticket.type,
-           attendee.total_drinks,
-           attendee.total_foods,
-           attendee.total_treatments,
-           attendee.total_bathroom_visits,
-           attendee.total_stage_visits,
-           attendee.gender,
-           entered_at_str,
-           exited_at_str
-       )
-       self.cursor.execute(query, values)
+       self.cursor.execute(self.INSERT_ATTENDEE, attendee_row(attendee))
        self.conn.commit()
+
+    def insert_attendees(self, attendees, chunk_size=None):
+       """Bulk version of insert_attendee: one multi-row INSERT and one commit per chunk, chunks written in parallel."""
+       rows = [attendee_row(attendee) for attendee in attendees]
+       self.write_chunks(self.INSERT_ATTENDEE, rows, chunk_size, parallel=True)
     
     def create_orders_table(self):
         query = """
@@ -641,92 +1544,311 @@ class FestivalDatabase:
         # start from 1 for the orders, when you run the simulation again
     
     def insert_order(self, order):
-        query = """
-            INSERT INTO orders (attendee_id, menu_item_name, price, contains_alcohol, status)
-            VALUES (%s, %s, %s, %s, %s)
-            ON DUPLICATE KEY UPDATE
-            attendee_id = VALUES(attendee_id),
-            menu_item_name = VALUES(menu_item_name),
-            price = VALUES(price),
-            contains_alcohol = VALUES(contains_alcohol),
-            status = VALUES(status);
-            """
-        values = (
-                order.attendee.id,
-                order.menu_item.name,
-                order.menu_item.price,
-                order.menu_item.contains_alcohol,
-                order.status
-            )
-        self.cursor.execute(query, values)
+        self.cursor.execute(self.INSERT_ORDER, order_row(order))
         self.conn.commit()
 
+    def insert_orders(self, orders, chunk_size=None):
+        """Bulk version of insert_order. Chunks go in one after the other so order_id keeps the order of completion."""
+        rows = [order_row(order) for order in orders]
+        self.write_chunks(self.INSERT_ORDER, rows, chunk_size, parallel=False)
+
+    def write_chunks(self, query, rows, chunk_size=None, parallel=False):
+        chunk_size = chunk_size or self.chunk_size
+        chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+        if parallel and len(chunks) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.pool.pool_size) as executor:
+                list(executor.map(lambda chunk: self.write_chunk(query, chunk), chunks))
+        else:
+            for chunk in chunks:
+                self.write_chunk(query, chunk)
+
+    def write_chunk(self, query, rows):
+        conn = self.pool.get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.executemany(query, rows) # mysql.connector turns this into a single multi-row INSERT
+            conn.commit() # one transaction per chunk
+            cursor.close()
+        except mysql.connector.Error:
+            conn.rollback()
+            raise
+        finally:
+            conn.close() # gives the connection back to the pool
+
     def close(self):
        if self.cursor:
            self.cursor.close()
        if self.conn:
            self.conn.close()
 
+# Streaming persistence:
+
+class OrderWriter(threading.Thread):
+    """Saves completed orders in batches while the festival is still running. A batch the database refuses is
+    tried again a few times; whatever still fails is kept in unwritten, with the last error in error."""
+    def __init__(self, festival_db, batch_size=500, max_pending=5000, flush_interval=1.0, retries=3, retry_delay=0.5):
+        super().__init__(name='Order Writer')
+        self.festival_db = festival_db
+        self.orders = queue.Queue(maxsize=max_pending) # bounded: staff wait here if the database falls behind
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval # seconds, so a quiet festival still gets written
+        self.retries = retries
+        self.retry_delay = retry_delay # seconds before the first retry, doubled for every next one
+        self.written = 0
+        self.unwritten = [] # orders of the batches that failed every retry
+        self.error = None
+
+    def submit(self, order):
+        self.orders.put(order) # blocks while the queue is full (backpressure)
+
+    def run(self):
+        batch = []
+        stopping = False
+        deadline = time.monotonic() + self.flush_interval
+        while not stopping:
+            try:
+                order = self.orders.get(timeout=max(deadline - time.monotonic(), 0))
+                if order is None:
+                    stopping = True # final flush
+                else:
+                    batch.append(order)
+            except queue.Empty:
+                pass
+            if len(batch) >= self.batch_size or stopping or time.monotonic() >= deadline:
+                if batch:
+                    self.flush(batch)
+                    batch = []
+                deadline = time.monotonic() + self.flush_interval
+        if self.unwritten:
+            unwritten, self.unwritten = self.unwritten, []
+            self.flush(unwritten) # last try, the database may be back
+
+    def flush(self, batch):
+        for attempt in range(self.retries + 1):
+            try:
+                self.festival_db.insert_orders(batch)
+                self.written += len(batch)
+                return
+            except Exception as e:
+                self.error = e
+                event_log.emit('error', self.name, message=traceback.format_exc(), level=ERROR)
+                if attempt < self.retries:
+                    time.sleep(self.retry_delay * 2 ** attempt)
+        self.unwritten.extend(batch)
+
+    def stop(self):
+        """Final flush: everything submitted before this call is written, or in unwritten, when it returns."""
+        if self.is_alive():
+            self.orders.put(None)
+            self.join()
+
 # Main simulation class:
 
+ACTIVITIES = ['food', 'drinks', 'music', 'bathroom', 'emergency'] # one list shared by all the attendees
+
+def create_attendees(num_attendees, streams=None, select=None):
+    """Create the festival crowd, shared by every simulation engine. With RandomStreams every attendee gets its own stream.
+    select (e.g. a range of indices) builds only part of the crowd, the same attendees as in the whole one."""
+    crowd = streams.stream('crowd') if streams else random
+    attendees = []
+    for i in range(num_attendees):
+        age, ticket, gender = crowd.randint(18, 40), crowd.choice(TICKET_TYPES), crowd.choice(['Male', 'Female'])
+        if select is None or i in select:
+            attendees.append(Attendee(f"A{i+1}", age, ticket, 0, 0, 0, 0, 0, gender, ACTIVITIES,
+                                      rng=streams.stream(f"A{i+1}", compact=True) if streams else None))
+    return attendees
+
 class FestivalSimulation:
-    def __init__(self, num_attendees, num_baristas, num_cooks, num_stalls, num_security, num_doctors, num_stages, artists_info,  num_bars, num_food_trucks):
-        self.attendees = [Attendee(f"A{i+1}", random.randint(18, 40), 
-                                   random.choice([TicketType("VIP"), TicketType("3-day pass"), TicketType("1-day pass"), TicketType("No ticket")]), 
-                                   0, 0,0,0, 0,
-                                   random.choice(['Male', 'Female']), 
-                                   ['food', 'drinks', 'music', 'bathroom', 'emergency']) for i in range(num_attendees)]
+    def __init__(self, num_attendees, num_baristas, num_cooks, num_stalls, num_security, num_doctors, num_stages, artists_info,  num_bars, num_food_trucks, stream_orders=True, storage=None, metrics_path=None, seed=None, deterministic=False, cache=None, routing='static', work_stealing=False, batching=None,
+                 time_scale=1.0, entrance_lanes=1, vip_lanes=0, arrivals=None, live_port=None,
+                 checkpoint_directory=None, analytics_path=None, triage=None):
+        # seed: per-actor random streams derived from it; deterministic: run on the discrete-event engine,
+        # where the order of events does not depend on the thread scheduler, so two runs give the same tables
+        self.parameters = dict(num_attendees=num_attendees, num_baristas=num_baristas, num_cooks=num_cooks, num_stalls=num_stalls,
+                               num_security=num_security, num_doctors=num_doctors, num_stages=num_stages, artists_info=artists_info,
+                               num_bars=num_bars, num_food_trucks=num_food_trucks, routing=routing, work_stealing=work_stealing,
+                               batching=batching, entrance_lanes=entrance_lanes, vip_lanes=vip_lanes, arrivals=arrivals, triage=triage)
+        self.seed = seed
+        self.deterministic = deterministic
+        if time_scale <= 0:
+            raise ValueError(f"time_scale has to be positive, not {time_scale}")
+        self.time_scale = time_scale # e.g. 10 for a festival ten times faster than real time, set on festival_clock by start()
+        self.cache = cache # festival_cache.ResultCache for the deterministic runs, None to always simulate
+        self.checkpoint_directory = checkpoint_directory # deterministic runs checkpoint there and resume from there
+        self.streams = RandomStreams(seed) if seed is not None or deterministic else None
+        self.rng = self.streams.stream('festival') if self.streams else random
+        self.attendees = create_attendees(num_attendees, self.streams)
         
-        self.bars = [Bar(num_baristas) for _ in range(num_bars)]
-        self.food_trucks = [FoodTruck(num_cooks) for _ in range(num_food_trucks)]
+        self.bars = [Bar(num_baristas, f'Bar {i+1}', batching) for i in range(num_bars)]
+        self.food_trucks = [FoodTruck(num_cooks, f'Food Truck {i+1}', batching) for i in range(num_food_trucks)]
         self.bathroom = Bathroom(num_stalls)
         self.stage = Stage(num_stages, artists_info)
-        self.emergency_truck = EmergencyTruck(doctors_count=num_doctors)
-        self.entrance = Entrance(num_security)
+        self.emergency_truck = EmergencyTruck(doctors_count=num_doctors, triage=triage) # triage: Triage, None for FIFO
+        self.entrance = Entrance(num_security, entrance_lanes, vip_lanes)
+        self.arrivals = arrivals or ArrivalCurve() # everyone at the gates when they open unless told otherwise
+        if self.streams:
+            self.seed_staff()
+
+        for station in self.bars + self.food_trucks:
+            station.collect = self.collect_order
+
+        # routing of the orders: one random bar and food truck per attendee ('static'), or a router per order
+        self.routing = routing
+        self.bar_router = StationRouter(self.bars, routing, self.rng, 'Bars') if routing != 'static' else None
+        self.truck_router = StationRouter(self.food_trucks, routing, self.rng, 'Food Trucks') if routing != 'static' else None
+        if work_stealing:
+            for stations in (self.bars, self.food_trucks):
+                for station in stations:
+                    station.peers = [other for other in stations if other is not station]
+                share_condition([station.orders for station in stations])
         
         self.festival_running = True 
+
+        # live counters, bumped by the attendee and staff threads and read by the live metrics endpoint
+        self.admitted = Counter()
+        self.left = Counter()
+        self.completed_orders = Counter()
+        self.live_port = live_port # serve festival_live metrics on this local port during start(), 0 for any free port
+        self.live_server = None
         
         # for sql connection
-        self.all_orders = []
+        self.all_orders = [] # only used when the orders are not streamed
+        self.stream_orders = stream_orders
+        self.order_writer = None
+        self.metrics_path = metrics_path # json file for the station metrics of the run
+        self.analytics = FestivalAnalytics() # running totals, fed as orders complete and attendees leave
+        self.analytics_path = analytics_path # json file for the analytics summary of the run
         
-        self.festival_db = FestivalDatabase(
-           user='root',
-           host='127.0.0.1',
-           #adjust to add password here too, if needed
-           database='festival_db'
-        )
+        self.festival_db = storage # any FestivalStorage, MySQL unless told otherwise
+        if self.festival_db is None:
+            self.festival_db = FestivalDatabase(
+               user='root',
+               host='127.0.0.1',
+               #adjust to add password here too, if needed
+               database='festival_db'
+            )
         self.festival_db.create_attendees_table()
         self.festival_db.create_orders_table()
         
+    def seed_staff(self):
+        for security in self.entrance.securities:
+            security.rng = self.streams.stream(f'Entrance/{security.name}')
+        for gender, stalls in self.bathroom.stalls.items():
+            for stall in stalls:
+                stall.rng = self.streams.stream(f'{gender} Bathroom/{stall.name}')
+        for doctor in self.emergency_truck.doctors:
+            doctor.rng = self.streams.stream(f'Emergency Truck/{doctor.name}')
+
+    def arrive(self, arrival_times):
+        """Bring the attendees to the gates along the arrival curve, then close the gates behind the last one."""
+        opened_at = festival_clock.time()
+        for attendee, arrival_time in zip(self.attendees, arrival_times):
+            festival_clock.sleep(opened_at + arrival_time - festival_clock.time())
+            attendee.pass_check(self.entrance)
+        self.entrance.close() # security goes home once the lanes are empty
+
+    def attend(self, attendee, bar, food_truck):
+        """One admitted attendee's festival, run in the executor."""
+        self.admitted.increment()
+        try:
+            attendee.do_activities(bar, food_truck, self.bathroom, self.emergency_truck, self.stage)
+        finally:
+            self.left.increment()
+            self.analytics.add_attendee(attendee, festival_clock.time() - attendee.entered_at)
+
     def collect_order(self, order):
-        """Collect an order instead of directly writing to the database."""
-        self.all_orders.append(order)
+        """Hand a completed order to the background writer, or keep it for store_all_orders."""
+        self.completed_orders.increment()
+        self.analytics.add_order(order)
+        if self.order_writer:
+            self.order_writer.submit(order)
+        else:
+            self.all_orders.append(order)
 
     def store_all_orders(self):
         """Store all collected orders in the database."""
         self.festival_db.clear_orders_table()
-        for order in self.all_orders:
-            self.festival_db.insert_order(order)
+        self.festival_db.insert_orders(self.all_orders)
+
+    def station_metrics(self):
+        stations = self.entrance.metrics + [bar.metrics for bar in self.bars] + [truck.metrics for truck in self.food_trucks]
+        stations += list(self.bathroom.metrics.values()) + [self.emergency_truck.metrics]
+        return {station.name: station.summary() for station in stations}
+
+    def export_metrics(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.station_metrics(), file, indent=2)
+
+    def export_analytics(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.analytics.summary(), file, indent=2)
+
+    def run_deterministic(self):
+        """Same festival on the discrete-event engine: the threads of start() interleave differently on every
+        run, the event queue does not, so a seed always gives the same attendees and orders tables."""
+        from festival_cache import CachedRun, run_cached
+        parameters = {name: value for name, value in self.parameters.items() if name != 'artists_info'}
+        gates_open = datetime.datetime(2024, 1, 1, 18) # fixed, the tables only keep the time of day
+        if self.checkpoint_directory:
+            from festival_checkpoint import run_checkpointed
+            festival = run_checkpointed(self.checkpoint_directory, parameters, self.streams.seed, self.parameters['artists_info'], start=gates_open)
+            run = CachedRun(festival.summary(), festival.station_metrics(), festival.attendees, festival.all_orders, festival.analytics)
+        else:
+            run = run_cached(self.cache, 'des', parameters, self.streams.seed, self.parameters['artists_info'], start=gates_open)
+        self.attendees = run.attendees
+        self.all_orders = run.orders
+        self.analytics = run.analytics
+        self.festival_db.create_attendees_table()
+        self.festival_db.create_orders_table()
+        self.festival_db.insert_attendees(self.attendees)
+        self.store_all_orders()
+        self.festival_db.close()
+        if self.metrics_path:
+            with open(self.metrics_path, 'w') as file:
+                json.dump(run.station_metrics, file, indent=2)
+        if self.analytics_path:
+            self.export_analytics(self.analytics_path)
+        return run.summary
 
     def start(self):        
+        clock_used = not self.deterministic # the discrete-event engine has its own virtual clock
+        if clock_used:
+            # not in __init__, a simulation built later must not change the scale of this one, and
+            # before the try, so a conflict with another running simulation reaches the caller
+            festival_clock.use(self.time_scale)
         try: 
+            if self.deterministic:
+                return self.run_deterministic()
+            event_log.set_clock(festival_clock.time) # event timestamps in festival seconds since the gates opened
+            if self.stream_orders:
+                # the orders reference the attendees, so their rows have to exist before the first flush
+                self.festival_db.clear_orders_table()
+                self.festival_db.insert_attendees(self.attendees)
+                self.order_writer = OrderWriter(self.festival_db)
+                self.order_writer.start()
+            if self.live_port is not None:
+                from festival_live import LiveMetricsServer
+                self.live_server = LiveMetricsServer(self, port=self.live_port)
+                self.live_server.start()
+                event_log.emit('live_metrics', 'Festival', message=f"Live metrics at {self.live_server.url}", level=MILESTONE)
+
+            # bar and food truck of every attendee, drawn up front so they do not depend on the admission order
+            assignments = {}
             for attendee in self.attendees:
-                attendee.pass_check(self.entrance)
-            
+                bar = self.bar_router or self.rng.choice(self.bars)
+                food_truck = self.truck_router or self.rng.choice(self.food_trucks)
+                assignments[attendee.id] = (bar, food_truck)
+            arrival_times = self.arrivals.times(len(self.attendees), self.rng)
+
             entrance_thread = threading.Thread(target=self.entrance.start)
+            arrival_thread = threading.Thread(target=self.arrive, args=(arrival_times,))
             bar_threads = [threading.Thread(target=bar.start) for bar in self.bars] # one thread for each bar
             food_truck_threads = [threading.Thread(target=truck.start) for truck in self.food_trucks]
             bathroom_thread = threading.Thread(target=self.bathroom.start)
             emergency_truck_thread = threading.Thread(target=self.emergency_truck.start)
             stage_thread = threading.Thread(target=self.stage.start_show)
 
-            
-            entrance_thread.start()
-            
-            # finish entrance process
-            entrance_thread.join()
-
-            # start all services
+            # start all services, the gates open at the same time
             for thread in bar_threads:
                 thread.start()
             for thread in food_truck_threads:
@@ -736,15 +1858,27 @@ class FestivalSimulation:
             emergency_truck_thread.start()
             stage_thread.start()
 
-            with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.attendees)) as executor:
-                print("\n\nWELCOME TO PUNTA CANA FESTIVAL EVERYONE! Starting festival activities...\n\n")
-                for attendee in self.attendees:
-                    executor.submit(attendee.do_activities, random.choice(self.bars), random.choice(self.food_trucks), self.bathroom, self.emergency_truck, self.stage)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(self.attendees), 1)) as executor:
+                event_log.emit('festival_open', 'Festival', message="\n\nWELCOME TO PUNTA CANA FESTIVAL EVERYONE! Starting festival activities...\n\n", level=MILESTONE)
+                # every admitted attendee starts their day as soon as security lets them in
+                self.entrance.on_admit = lambda attendee: executor.submit(self.attend, attendee, *assignments[attendee.id])
+                self.entrance.on_refuse = self.analytics.add_attendee
+                entrance_thread.start()
+                arrival_thread.start()
+                arrival_thread.join()
+                entrance_thread.join() # everyone has been checked, the executor waits for the last attendee to leave
   
             stage_thread.join()
             self.festival_running = False
             
-            print("\n\nLast festival activities have ended...\n\n")
+            # wake up the idle staff so their threads can finish
+            for bar in self.bars:
+                bar.close()
+            for truck in self.food_trucks:
+                truck.close()
+            self.emergency_truck.close()
+            
+            event_log.emit('festival_close', 'Festival', message="\n\nLast festival activities have ended...\n\n", level=MILESTONE)
 
             for thread in bar_threads:
                 thread.join()
@@ -753,43 +1887,69 @@ class FestivalSimulation:
                 
             emergency_truck_thread.join()
             bathroom_thread.join()
+            self.bathroom.stop()
 
             # store the desired data in the database:
-            for attendee in self.attendees:
-                self.festival_db.insert_attendee(attendee)
-            
-            self.store_all_orders()
+            if self.order_writer:
+                self.order_writer.stop() # before the attendees, so the two do not compete for the pooled connections
+            self.festival_db.insert_attendees(self.attendees) # updates the counters and exit times
+            if not self.order_writer:
+                self.store_all_orders()
             self.festival_db.close()
+
+            if self.metrics_path:
+                self.export_metrics(self.metrics_path)
+            if self.analytics_path:
+                self.export_analytics(self.analytics_path)
             
         except Exception as e:
-            print(traceback.format_exc())
+            event_log.emit('error', 'Festival', message=traceback.format_exc(), level=ERROR)
+        finally:
+            if self.order_writer:
+                self.order_writer.stop() # no-op after a normal run, otherwise its thread would keep the process alive
+            if self.live_server:
+                self.live_server.stop()
+            if clock_used:
+                festival_clock.release()
+            event_log.flush()
+        if self.order_writer and self.order_writer.unwritten:
+            # outside the try: the caller has to know that part of the orders table is missing
+            raise RuntimeError(f"{len(self.order_writer.unwritten)} completed orders could not be written") from self.order_writer.error
         
+DEFAULT_ARTISTS_INFO = [
+    {'name': 'Bad Bunny', 'genre': 'Reggaeton', 'set_duration': 60},
+    {'name': 'Tyler the Creator', 'genre': 'Rap', 'set_duration': 60},
+    {'name': 'Doja Cat', 'genre': 'Rap', 'set_duration': 60},
+    {'name': 'Kendrick Lamar', 'genre': 'Rap', 'set_duration': 30},
+    {'name': 'Bad Gyal', 'genre': 'Reggaeton', 'set_duration': 60},
+    {'name': 'Daddy Yankee', 'genre': 'Reggaeton', 'set_duration': 40},
+    {'name': 'Karol G', 'genre': 'Reggaeton', 'set_duration': 25},
+    {'name': 'Saiko', 'genre': 'Reggaeton', 'set_duration': 40},
+    {'name': 'Ariana Grande', 'genre': 'Pop', 'set_duration': 35},
+    {'name': 'The Weeknd', 'genre': 'Rap', 'set_duration': 20},
+    {'name': 'Billie Eilish', 'genre': 'Pop', 'set_duration': 60},
+    {'name': 'Post Malone', 'genre': 'Rap', 'set_duration': 30},
+    {'name': 'Lil Nas X', 'genre': 'Rap', 'set_duration': 30},
+    {'name': 'Dua Lipa', 'genre': 'Pop', 'set_duration': 60},
+    {'name': 'Ed Sheeran', 'genre': 'Pop', 'set_duration': 35},
+    {'name': 'Lizzo', 'genre': 'Pop', 'set_duration': 60}
+    ] # change your set list to include your favorite artists:))):):)<3
+
 if __name__ == '__main__':
     
     random.seed(0)
     
-    artists_info = [
-        {'name': 'Bad Bunny', 'genre': 'Reggaeton', 'set_duration': 60},
-        {'name': 'Tyler the Creator', 'genre': 'Rap', 'set_duration': 60},
-        {'name': 'Doja Cat', 'genre': 'Rap', 'set_duration': 60},
-        {'name': 'Kendrick Lamar', 'genre': 'Rap', 'set_duration': 30},
-        {'name': 'Bad Gyal', 'genre': 'Reggaeton', 'set_duration': 60},
-        {'name': 'Daddy Yankee', 'genre': 'Reggaeton', 'set_duration': 40},
-        {'name': 'Karol G', 'genre': 'Reggaeton', 'set_duration': 25},
-        {'name': 'Saiko', 'genre': 'Reggaeton', 'set_duration': 40},
-        {'name': 'Ariana Grande', 'genre': 'Pop', 'set_duration': 35},
-        {'name': 'The Weeknd', 'genre': 'Rap', 'set_duration': 20},
-        {'name': 'Billie Eilish', 'genre': 'Pop', 'set_duration': 60},
-        {'name': 'Post Malone', 'genre': 'Rap', 'set_duration': 30},
-        {'name': 'Lil Nas X', 'genre': 'Rap', 'set_duration': 30},
-        {'name': 'Dua Lipa', 'genre': 'Pop', 'set_duration': 60},
-        {'name': 'Ed Sheeran', 'genre': 'Pop', 'set_duration': 35},
-        {'name': 'Lizzo', 'genre': 'Pop', 'set_duration': 60}
-        ] # change your set list to include your favorite artists:))):):)<3
+    # festival milestones on the console, every event in the log file
+    # (use ConsoleSink(level=DEBUG) to see everything on the console, like example_output.txt)
+    event_log.add_sink(ConsoleSink(level=MILESTONE))
+    event_log.add_sink(JSONLSink('festival_events.jsonl', level=DEBUG))
+    
+    artists_info = DEFAULT_ARTISTS_INFO
     
     festival = FestivalSimulation(num_attendees=500, num_baristas=8, num_cooks=8, num_stalls=10, num_security=20, num_doctors=5, num_stages=3, 
-                                  artists_info=artists_info, num_bars = 3, num_food_trucks=3)
+                                  artists_info=artists_info, num_bars = 3, num_food_trucks=3, metrics_path='festival_metrics.json')
     
     # you can change the numbers as you like, but make sure to have enough resources for the simulation to run smoothly
     
-    festival.start()
\ No newline at end of file
+    festival.start()
+    event_log.close()
\ No newline at end of file